@@ -1,6 +1,12 @@
 from django.contrib import admin
-from .models import User, Connection, Message
+from .models import User, Connection, Message, ArchivedMessage, ConversationSummary, StoredImage, GroupChat, GroupMember, GroupMessage
 
 admin.site.register(User)
 admin.site.register(Connection)
 admin.site.register(Message)
+admin.site.register(ArchivedMessage)
+admin.site.register(ConversationSummary)
+admin.site.register(StoredImage)
+admin.site.register(GroupChat)
+admin.site.register(GroupMember)
+admin.site.register(GroupMessage)
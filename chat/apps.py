@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        # Keep the in-process search index and membership cache in step with the database
+        from . import search, members  # noqa: F401
+        from .fulltext import restore_message_search
+
+        # Any migration that rebuilds chat_message on SQLite drops the message search triggers
+        post_migrate.connect(restore_message_search, sender=self)
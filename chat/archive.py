@@ -0,0 +1,108 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Exists, OuterRef
+from django.utils import timezone
+from .models import Message, ArchivedMessage, ConversationSummary
+
+
+MESSAGE_HOT_DAYS = getattr(settings, 'MESSAGE_HOT_DAYS', 90)
+MESSAGE_ARCHIVE_BATCH_SIZE = getattr(settings, 'MESSAGE_ARCHIVE_BATCH_SIZE', 1000)
+
+ARCHIVED_FIELDS = ['id', 'connection_id', 'sender_id', 'content', 'image_url',
+                   'image_variants', 'client_msg_id', 'created_at']
+
+
+def hot_cutoff(now=None):
+    """
+    This function returns the creation time before which messages belong in the archive.
+    """
+    return (now or timezone.now()) - timedelta(days=MESSAGE_HOT_DAYS)
+
+
+def archive_batch(cutoff, batch_size=MESSAGE_ARCHIVE_BATCH_SIZE):
+    """
+    This function moves up to batch_size messages created before cutoff, lowest ids first,
+    from Message to ArchivedMessage in one transaction. Returns the number of messages moved.
+
+    The last message of a conversation stays, its summary points at it. So does a message
+    whose (sender, client_msg_id) is already archived, the archive can't hold both.
+    """
+    last_messages = ConversationSummary.objects.filter(
+        last_message__isnull=False
+    ).values('last_message_id')
+    archived_client_msg_id = ArchivedMessage.objects.filter(
+        sender_id=OuterRef('sender_id'),
+        client_msg_id=OuterRef('client_msg_id')
+    )
+
+    # Copy and delete commit together, a failed batch leaves every message where it was
+    with transaction.atomic():
+        rows = list(Message.objects.filter(
+            created_at__lt=cutoff
+        ).exclude(
+            id__in=last_messages
+        ).exclude(
+            Exists(archived_client_msg_id)
+        ).order_by('id').values_list(*ARCHIVED_FIELDS)[:batch_size])
+        if not rows:
+            return 0
+
+        ArchivedMessage.objects.bulk_create([
+            ArchivedMessage(**dict(zip(ARCHIVED_FIELDS, row))) for row in rows
+        ])
+        Message.objects.filter(id__in=[row[0] for row in rows]).delete()
+
+    return len(rows)
+
+
+def archived_client_msg_ids(sender_id, client_msg_ids):
+    """
+    This function returns which of the sender's client message ids belong to archived messages.
+    The hot table's unique constraint no longer sees those.
+    """
+    if not client_msg_ids:
+        return set()
+    return set(ArchivedMessage.objects.filter(
+        sender_id=sender_id,
+        client_msg_id__in=client_msg_ids
+    ).values_list('client_msg_id', flat=True))
+
+
+def with_archived(connection_id, messages, limit, cursor=None, newer=False, offset=0):
+    """
+    This function merges the archived messages of a connection into a page of hot ones.
+
+    messages is the hot page, newest first, or oldest first when newer is set. The archive
+    is read with the same (created_at, id) cursor and the merged page keeps at most limit
+    messages, so the caller still sees one extra row when another page follows.
+    """
+    archived = ArchivedMessage.objects.filter(connection_id=connection_id)
+
+    if cursor is not None:
+        created_at, message_id = cursor
+        if newer:
+            archived = archived.filter(
+                Q(created_at__gt=created_at) |
+                Q(created_at=created_at, id__gt=message_id)
+            )
+        else:
+            archived = archived.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, id__lt=message_id)
+            )
+
+    if newer:
+        archived = archived.order_by('created_at', 'id')
+    else:
+        archived = archived.order_by('-created_at', '-id')
+
+    archived = list(archived[offset:offset + limit])
+    if not archived:
+        return messages
+
+    return sorted(
+        messages + archived,
+        key=lambda message: (message.created_at, message.id),
+        reverse=not newer
+    )[:limit]
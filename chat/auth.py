@@ -0,0 +1,146 @@
+from collections import Counter, defaultdict
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from .codec import get_query_param
+from .lru import LRUCache
+from .models import User
+import asyncio
+import hashlib
+import time
+
+
+AUTH_CACHE_SIZE = getattr(settings, 'AUTH_CACHE_SIZE', 10000)
+AUTH_CACHE_TTL_SECONDS = getattr(settings, 'AUTH_CACHE_TTL_SECONDS', 60)
+AUTH_NEGATIVE_TTL_SECONDS = getattr(settings, 'AUTH_NEGATIVE_TTL_SECONDS', 10)
+
+# Process wide connect counters: hits, misses, rejected, negative_hits and coalesced
+auth_stats = Counter()
+
+USER_FIELDS = [field.attname for field in User._meta.concrete_fields]
+
+
+class TokenCache:
+    """
+    Token hash -> (expires_at, user id, user field values), indexed by user so saves can drop them.
+    Rejected tokens are kept too, with no user, so retrying them costs nothing.
+    """
+
+    def __init__(self, max_size):
+        # Token expiry is wall clock time, so is the cache's
+        self.entries = LRUCache(max_size, clock=time.time, on_discard=self.discard)
+        self.user_tokens = defaultdict(set)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, expires_at, user_id=None, values=None):
+        entry = (expires_at, user_id, values)
+        with self.entries.lock:
+            self.entries.set(key, entry, expires_at)
+            if user_id is not None:
+                self.user_tokens[user_id].add(key)
+        return entry
+
+    def discard(self, key, entry):
+        # Called by the LRU under its lock for every entry leaving it
+        user_id = entry[1]
+        if user_id is not None:
+            tokens = self.user_tokens[user_id]
+            tokens.discard(key)
+            if not tokens:
+                del self.user_tokens[user_id]
+
+    def forget_user(self, user_id):
+        with self.entries.lock:
+            for key in list(self.user_tokens.get(user_id, ())):
+                self.entries.pop(key)
+
+
+token_cache = TokenCache(AUTH_CACHE_SIZE)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user_tokens(sender, instance, **kwargs):
+    # A saved or deleted user must not be served from an old snapshot
+    token_cache.forget_user(instance.pk)
+
+
+@database_sync_to_async
+def load_user_values(user_id):
+    user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+    if user is None or not user.is_active:
+        return None
+    return user.pk, [getattr(user, attname) for attname in USER_FIELDS]
+
+
+def build_user(entry):
+    # A fresh instance per socket, consumers may change and save their user
+    _, user_id, values = entry
+    if user_id is None:
+        return AnonymousUser()
+    return User.from_db('default', USER_FIELDS, list(values))
+
+
+class JWTAuthMiddleware:
+    """
+    Authenticates sockets from their ?token= access token.
+
+    A verified token is cached with a snapshot of its user until the token expires or
+    AUTH_CACHE_TTL_SECONDS pass, rejected tokens for AUTH_NEGATIVE_TTL_SECONDS. Sockets
+    connecting with the same token at once share a single lookup, so a reconnect
+    storm costs one query per user instead of one per socket.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.pending = {}
+
+    async def __call__(self, scope, receive, send):
+        token = get_query_param(scope, 'token')
+        user = await self.authenticate(token) if token else AnonymousUser()
+        return await self.app(dict(scope, user=user), receive, send)
+
+    async def authenticate(self, token):
+        key = hashlib.sha256(token.encode()).hexdigest()
+
+        entry = token_cache.get(key)
+        if entry is not None:
+            auth_stats['hits' if entry[1] is not None else 'negative_hits'] += 1
+            return build_user(entry)
+
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.verify(key, token))
+            self.pending[key] = future
+            future.add_done_callback(lambda _: self.pending.pop(key, None))
+        else:
+            auth_stats['coalesced'] += 1
+
+        # Shielded, one socket giving up must not cancel the lookup the others wait on
+        return build_user(await asyncio.shield(future))
+
+    async def verify(self, key, token):
+        now = time.time()
+        try:
+            access_token = AccessToken(token)
+            user_id = access_token[api_settings.USER_ID_CLAIM]
+        except (TokenError, KeyError):
+            auth_stats['rejected'] += 1
+            return token_cache.set(key, now + AUTH_NEGATIVE_TTL_SECONDS)
+
+        loaded = await load_user_values(user_id)
+        if loaded is None:
+            auth_stats['rejected'] += 1
+            return token_cache.set(key, now + AUTH_NEGATIVE_TTL_SECONDS)
+
+        auth_stats['misses'] += 1
+        pk, values = loaded
+        expires_at = min(now + AUTH_CACHE_TTL_SECONDS, access_token['exp'])
+        return token_cache.set(key, expires_at, pk, values)
@@ -0,0 +1,140 @@
+from django.conf import settings
+from django.db.models import Q
+from .lru import LRUCache
+from .models import User, Connection
+from .serializers import UserSerializer
+import json
+
+
+USER_CACHE_SIZE = getattr(settings, 'USER_CACHE_SIZE', 4096)
+USER_CACHE_TTL_SECONDS = getattr(settings, 'USER_CACHE_TTL_SECONDS', 60)
+USER_CACHE_REDIS_URL = getattr(settings, 'USER_CACHE_REDIS_URL', None)
+
+
+class UserCache:
+    """
+    LRU with a TTL in front of per-user rows, optionally backed by Redis shared by all workers.
+
+    Changes invalidate this process and Redis. Other processes drop their copy when they
+    relay the event that announced the change, at worst it lives until the TTL.
+    """
+
+    def __init__(self, max_size, ttl, redis_url=None, prefix='usercache'):
+        self.ttl = ttl
+        self.prefix = prefix
+        self.entries = LRUCache(max_size, ttl)
+        self.redis = None
+        if redis_url:
+            import redis
+            self.redis = redis.Redis.from_url(redis_url)
+
+    def get(self, key, load):
+        """
+        Return the cached value of key, calling load() on a miss. Values must be JSON serializable.
+        """
+        value = self.entries.get(key)
+        if value is not None:
+            return value
+
+        if self.redis is not None:
+            cached = self.redis.get(f'{self.prefix}:{key}')
+            if cached is not None:
+                value = json.loads(cached)
+        if value is None:
+            value = load()
+            if self.redis is not None:
+                self.redis.set(f'{self.prefix}:{key}', json.dumps(value), ex=self.ttl)
+
+        self.entries.set(key, value)
+        return value
+
+    def invalidate(self, keys):
+        self.drop_local(keys)
+        if self.redis is not None and keys:
+            self.redis.delete(*[f'{self.prefix}:{key}' for key in keys])
+
+    def drop_local(self, keys):
+        for key in keys:
+            self.entries.pop(key)
+
+
+user_cache = UserCache(
+    max_size=USER_CACHE_SIZE,
+    ttl=USER_CACHE_TTL_SECONDS,
+    redis_url=USER_CACHE_REDIS_URL
+)
+
+
+def user_keys(user_ids):
+    return [f'{kind}:{user_id}' for user_id in user_ids for kind in ('profile', 'connections')]
+
+
+def invalidate_users(*user_ids):
+    """
+    This function forgets the users' profiles and connections here and in Redis.
+    """
+    user_cache.invalidate(user_keys(user_ids))
+
+
+def drop_local_users(user_ids):
+    # Another process already cleared Redis, only this process' copies remain
+    user_cache.drop_local(user_keys(user_ids))
+
+
+def get_profile(user_id):
+    """
+    This function returns the user serialized by UserSerializer.
+    """
+    return user_cache.get(
+        f'profile:{user_id}',
+        lambda: dict(UserSerializer(User.objects.get(id=user_id)).data)
+    )
+
+
+def load_connections(user_id):
+    connections = Connection.objects.filter(
+        Q(sender_id=user_id) | Q(receiver_id=user_id),
+        accepted=True
+    ).values_list('id', 'sender_id', 'receiver_id', 'sender__username', 'receiver__username')
+
+    # JSON keys are strings, so connection ids are too
+    return {
+        str(connection_id): [sender_id, receiver_id,
+                             receiver_username if sender_id == user_id else sender_username]
+        for connection_id, sender_id, receiver_id, sender_username, receiver_username in connections
+    }
+
+
+def get_connections(user_id):
+    """
+    This function returns {connection id: [sender id, receiver id, friend username]} of the user's accepted connections.
+    """
+    return user_cache.get(f'connections:{user_id}', lambda: load_connections(user_id))
+
+
+def get_conversation(user_id, connection_id):
+    """
+    This function returns (connection, friend id, friend username) when the user belongs to the
+    accepted connection, None otherwise. The connection is built from the cache, not queried.
+    """
+    row = get_connections(user_id).get(str(connection_id))
+    if row is None:
+        return None
+
+    sender_id, receiver_id, friend_username = row
+    connection = Connection.from_db(
+        'default', ['id', 'sender_id', 'receiver_id', 'accepted'],
+        [int(connection_id), sender_id, receiver_id, True]
+    )
+    friend_id = receiver_id if sender_id == user_id else sender_id
+    return connection, friend_id, friend_username
+
+
+def get_friend_connection_id(user_id, username):
+    """
+    This function returns the id of the user's accepted connection with username, or None.
+    """
+    for connection_id, (_, _, friend_username) in get_connections(user_id).items():
+        if friend_username == username:
+            return int(connection_id)
+    return None
@@ -0,0 +1,115 @@
+from urllib.parse import parse_qs
+from itertools import count
+from uuid import uuid4
+from django.conf import settings
+from .lru import LRUCache
+import json
+import msgpack
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# orjson is optional, fall back to the standard library when it isn't installed
+USE_ORJSON = getattr(settings, 'JSON_ENCODER', 'json') == 'orjson' and orjson is not None
+
+
+class JSONCodec:
+    """
+    Text frames, the default wire format.
+    """
+    name = 'json'
+
+    def encode(self, data):
+        if USE_ORJSON:
+            return orjson.dumps(data).decode()
+        return json.dumps(data)
+
+    def decode(self, frame):
+        return json.loads(frame)
+
+    def batch(self, frames):
+        # Splice the already encoded frames, nothing is encoded twice
+        return '{"source": "batch", "data": [' + ', '.join(frames) + ']}'
+
+
+class MessagePackCodec:
+    """
+    Binary frames, smaller and cheaper to parse for mobile clients, bytes travel without base64.
+    """
+    name = 'msgpack'
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, frame):
+        return msgpack.unpackb(frame, raw=False)
+
+    def batch(self, frames):
+        # A two key map whose 'data' array holds the already encoded frames
+        packer = msgpack.Packer(use_bin_type=True)
+        return b''.join([
+            b'\x82',
+            packer.pack('source'),
+            packer.pack('batch'),
+            packer.pack('data'),
+            packer.pack_array_header(len(frames)),
+            *frames
+        ])
+
+
+CODECS = {
+    codec.name: codec
+    for codec in (JSONCodec(), MessagePackCodec())
+    if codec.name in getattr(settings, 'WEBSOCKET_CODECS', ['json', 'msgpack'])
+}
+CODECS.setdefault('json', JSONCodec())
+
+
+# Broadcast ids: unique to this process, counted from there, cheaper than a uuid per frame
+BROADCAST_ID_PREFIX = uuid4().hex[:12]
+broadcast_ids = count()
+
+# (broadcast id, codec name) -> encoded frame, shared by every socket of this process
+encoded_broadcasts = LRUCache(getattr(settings, 'WEBSOCKET_BROADCAST_CACHE_SIZE', 1024))
+
+
+def broadcast_frame(source, data):
+    """
+    This function builds a frame to send through the channel layer unencoded, tagged with an id
+    so the receiving sockets can share its encoding.
+    """
+    return {'id': f'{BROADCAST_ID_PREFIX}.{next(broadcast_ids)}', 'frame': {'source': source, 'data': data}}
+
+
+def encode_broadcast(broadcast, codec):
+    """
+    This function encodes a broadcast_frame for a socket's codec. Each process encodes it
+    once per codec its sockets actually use, not once per socket or per enabled codec.
+    """
+    key = (broadcast['id'], codec.name)
+    frame = encoded_broadcasts.get(key)
+    if frame is None:
+        frame = codec.encode(broadcast['frame'])
+        encoded_broadcasts.set(key, frame)
+    return frame
+
+
+def get_query_param(scope, name, default=None):
+    query = parse_qs(scope.get('query_string', b'').decode('utf8'))
+    return query.get(name, [default])[0]
+
+
+def negotiate(scope):
+    """
+    This function picks the connection's codec from its subprotocols or its ?codec= query param.
+    Returns (codec, subprotocol to accept with).
+    """
+    for subprotocol in scope.get('subprotocols', []):
+        if subprotocol in CODECS:
+            return CODECS[subprotocol], subprotocol
+
+    name = get_query_param(scope, 'codec', 'json')
+    return CODECS.get(name, CODECS['json']), None
@@ -1,117 +1,368 @@
-from channels.generic.websocket import WebsocketConsumer
-from asgiref.sync import async_to_sync
-from django.core.files.base import ContentFile
-from .serializers import UserSerializer, SearchSerializer, RequestSerializer, FriendSerializer, MessageSerializer
-from django.db.models import Q, Exists, OuterRef, Subquery
-from .models import User, Connection, Message
-from .utils import save_image
-from PIL import Image
-import os
-import environ
-import io
-import base64
-import json
-import boto3
-
-
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from .serializers import UserSerializer, SearchSerializer, RequestSerializer, FriendSerializer, MessageSerializer, SyncMessageSerializer, GroupSerializer, GroupMemberSerializer, MembershipSerializer, GroupMessageSerializer
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Q, F, Case, When, Value, Count, Min
+from .models import User, Connection, Message, ArchivedMessage, ConversationSummary, GroupChat, GroupMember, GroupMessage
+from .utils import save_image, close_image, encode_cursor, decode_cursor
+from .search import search_users, search_stats, SEARCH_DEBOUNCE_SECONDS
+from .fulltext import search_messages
+from .ingest import recent_messages, clean_client_msg_id
+from .archive import hot_cutoff, with_archived, archived_client_msg_ids
+from .cache import get_profile, get_connections, get_conversation, get_friend_connection_id, invalidate_users, drop_local_users
+from .pipeline import image_pipeline
+from .uploads import uploads, parse_chunk, IMAGE_UPLOAD_MAX_BYTES
+from .codec import CODECS, negotiate, broadcast_frame, encode_broadcast, get_query_param
+from .presence import presence
+from .typing_indicators import TypingState
+from .groups import registry, user_group, conversation_group, group_chat_group
+from .members import memberships, get_role
+from collections import Counter, defaultdict
+from datetime import timedelta
+import asyncio
+import time
+
+
+IMAGE_PIPELINE_MAX_PENDING_PER_SOCKET = getattr(
+    settings, 'IMAGE_PIPELINE_MAX_PENDING_PER_SOCKET', 4)
+MESSAGE_BATCH_MAX_SIZE = getattr(settings, 'MESSAGE_BATCH_MAX_SIZE', 100)
+WEBSOCKET_COALESCE_SECONDS = getattr(
+    settings, 'WEBSOCKET_COALESCE_SECONDS', 0.005)
+WEBSOCKET_COALESCE_MAX_FRAMES = getattr(
+    settings, 'WEBSOCKET_COALESCE_MAX_FRAMES', 50)
+SYNC_CHUNK_SIZE = getattr(settings, 'SYNC_CHUNK_SIZE', 200)
+SYNC_MAX_CHUNKS = getattr(settings, 'SYNC_MAX_CHUNKS', 50)
+SYNC_RESCAN_SECONDS = getattr(settings, 'SYNC_RESCAN_SECONDS', 10)
+GROUP_MAX_MEMBERS = getattr(settings, 'GROUP_MAX_MEMBERS', 500)
+READ_RECEIPT_DELAY_SECONDS = getattr(
+    settings, 'READ_RECEIPT_DELAY_SECONDS', 1)
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
         user = self.scope['user']
         print("connect", user)
         if not user.is_authenticated:
             return
 
-        # Save username to use as a group name for this user
         self.username = user.username
         print(f"{self.username} connected")
 
-        # Join this user to a group with their username
-        async_to_sync(self.channel_layer.group_add)(
-            self.username,
+        # Only the newest search of this socket is answered
+        self.search_task = None
+        self.dropped_searches = Counter()
+
+        # Images this socket has waiting in the image pipeline
+        self.pending_images = 0
+
+        # Typing bursts towards each peer, and their timeout tasks
+        self.typing = TypingState()
+        self.typing_tasks = {}
+
+        # Highest message read per conversation, written once per READ_RECEIPT_DELAY_SECONDS
+        self.read_marks = {}
+        self.read_task = None
+
+        # JSON text frames unless the client asked for MessagePack
+        self.codec, subprotocol = negotiate(self.scope)
+
+        # Clients that understand 'batch' frames get writes coalesced
+        self.coalesce = get_query_param(self.scope, 'coalesce') in ('1', 'true')
+        self.outbox = []
+        self.flush_task = None
+
+        # Every socket of the user shares one group, conversations are joined when opened
+        await self.channel_layer.group_add(
+            user_group(self.username),
             self.channel_name
         )
+        registry.register(self.channel_name)
+
+        # Group chats fan out once per chat, so each socket joins every chat the user is in
+        self.group_ids = set(await self.get_group_ids(user))
+        for group_id in self.group_ids:
+            await self.channel_layer.group_add(
+                group_chat_group(group_id),
+                self.channel_name
+            )
 
-        self.accept()
+        await self.accept(subprotocol)
 
-    def disconnect(self, close_code):
+        # Friends hear about it when this is the user's first socket
+        await presence.connect(self.username, self.channel_name)
+
+    async def disconnect(self, close_code):
         print("disconnect", close_code)
-        # Leave the group
-        async_to_sync(self.channel_layer.group_discard)(
-            self.username,
+        if self.search_task:
+            self.search_task.cancel()
+        if self.flush_task:
+            self.flush_task.cancel()
+
+        # Write the pending read marks now rather than drop them
+        if self.read_task:
+            self.read_task.cancel()
+            self.read_task = None
+        await self.flush_reads()
+
+        # Don't leave peers watching a typing indicator
+        for task in list(self.typing_tasks.values()):
+            task.cancel()
+        for username in self.typing.active():
+            self.typing.stop(username)
+            await self.send_typing(username, False)
+
+        if self.dropped_searches:
+            print("dropped searches", dict(self.dropped_searches))
+
+        await presence.disconnect(self.username, self.channel_name)
+
+        # Leave the groups
+        for connection_id in registry.unregister(self.channel_name):
+            await self.channel_layer.group_discard(
+                conversation_group(connection_id),
+                self.channel_name
+            )
+        for group_id in self.group_ids:
+            await self.channel_layer.group_discard(
+                group_chat_group(group_id),
+                self.channel_name
+            )
+        await self.channel_layer.group_discard(
+            user_group(self.username),
             self.channel_name
         )
 
-    def receive(self, text_data):
-        data = json.loads(text_data)
-        print("receive", json.dumps(data, indent=2))
+    async def receive(self, text_data=None, bytes_data=None):
+        if text_data is not None:
+            data = CODECS['json'].decode(text_data)
+        elif self.codec.name == 'json':
+            # JSON clients only send binary frames for image upload chunks
+            await self.receive_upload_chunk(bytes_data)
+            return
+        else:
+            data = self.codec.decode(bytes_data)
 
         data_source = data.get('source')
+        print("receive", data_source)
 
         if data_source == 'search':
-            self.receive_search(data)
+            await self.receive_search(data)
 
         elif data_source == 'thumbnail':
-            self.receive_thumbnail(data)
+            await self.receive_thumbnail(data)
 
         elif data_source == 'request-connect':
-            self.receive_request_connect(data)
+            await self.receive_request_connect(data)
 
         elif data_source == 'request-list':
-            self.receive_request_list(data)
+            await self.receive_request_list(data)
 
         elif data_source == 'request-accept':
-            self.receive_accept_request(data)
+            await self.receive_accept_request(data)
 
         elif data_source == 'friend-list':
-            self.receive_friend_list(data)
+            await self.receive_friend_list(data)
 
         elif data_source == 'message-send':
-            self.receive_message_send(data)
+            await self.receive_message_send(data)
+
+        elif data_source == 'message-send-batch':
+            await self.receive_message_send_batch(data)
 
         elif data_source == 'message-list':
-            self.receive_message_list(data)
+            await self.receive_message_list(data)
 
         elif data_source == 'message-typing':
-            self.receive_message_typing(data)
+            await self.receive_message_typing(data)
+
+        elif data_source == 'message-search':
+            await self.receive_message_search(data)
+
+        elif data_source == 'message-read':
+            await self.receive_message_read(data)
+
+        elif data_source == 'group-message-read':
+            await self.receive_group_message_read(data)
+
+        elif data_source == 'conversation-open':
+            await self.receive_conversation_open(data)
+
+        elif data_source == 'conversation-close':
+            await self.receive_conversation_close(data)
+
+        elif data_source == 'group-create':
+            await self.receive_group_create(data)
+
+        elif data_source == 'group-add':
+            await self.receive_group_add(data)
+
+        elif data_source == 'group-leave':
+            await self.receive_group_leave(data)
+
+        elif data_source == 'group-list':
+            await self.receive_group_list(data)
+
+        elif data_source == 'group-members':
+            await self.receive_group_members(data)
+
+        elif data_source == 'group-message-send':
+            await self.receive_group_message_send(data)
+
+        elif data_source == 'group-message-list':
+            await self.receive_group_message_list(data)
+
+        elif data_source == 'sync':
+            await self.receive_sync(data)
 
-    def receive_thumbnail(self, data):
+        elif data_source == 'heartbeat':
+            await self.receive_heartbeat(data)
+
+        elif data_source == 'presence-list':
+            await self.receive_presence_list(data)
+
+        elif data_source == 'upload-start':
+            await self.receive_upload_start(data)
+
+        elif data_source == 'upload-chunk':
+            # MessagePack carries the chunk as a bin field, no frame header needed
+            await self.receive_upload_chunk_data(data, data.get('chunk'))
+
+    async def receive_thumbnail(self, data):
         user = self.scope['user']
         if not user.is_authenticated:
             return
 
-        # Convert base64 data to image
-        image_str = data.get('base64')
+        # Base64 image inside the JSON frame, kept for older clients
+        await self.start_thumbnail(user, data.get('base64'))
 
-        user.thumbnail = save_image(image_str, 'thumbnail', user)
+    async def start_thumbnail(self, user, image, reserved=False):
+        if not reserved and not self.reserve_image():
+            close_image(image)
+            await self.send_busy('thumbnail')
+            return
 
-        user.save()
+        image_pipeline.spawn(self.finish_thumbnail(user, image))
 
-        # Serialize the user
-        serialized = UserSerializer(user)
+    async def finish_thumbnail(self, user, image):
+        try:
+            serialized = await image_pipeline.run(
+                self.save_thumbnail, user, image)
+        except Exception as e:
+            print("Thumbnail processing failed", user.username, e)
+            return
+        finally:
+            self.pending_images -= 1
+            close_image(image)
 
         # Send the thumbnail to the group
-        self.send_group(user.username, 'thumbnail', serialized.data)
+        await self.send_group(user_group(user.username), 'thumbnail', serialized,
+                              invalidate=[user.id])
 
-    def send_group(self, group, source, data):
-        response = {
-            'type': 'broadcast_group',
+    def save_thumbnail(self, user, image):
+        user.thumbnail, user.thumbnail_variants = save_image(
+            image, 'thumbnail')
+
+        user.save(update_fields=['thumbnail', 'thumbnail_variants'])
+        invalidate_users(user.id)
+
+        # Serialize the user
+        return UserSerializer(user).data
+
+    def reserve_image(self):
+        # Bound the images one socket can have in the pipeline, on top of the pipeline's own limit
+        if self.pending_images >= IMAGE_PIPELINE_MAX_PENDING_PER_SOCKET:
+            return False
+        if not image_pipeline.reserve():
+            return False
+        self.pending_images += 1
+        return True
+
+    def release_image(self):
+        self.pending_images -= 1
+        image_pipeline.release()
+
+    async def send_busy(self, source):
+        # Tell the client to retry later rather than queueing without bound
+        await self.send_data('image-busy', {
+            'source': source
+        })
+
+    async def send_data(self, source, data):
+        await self.send_frame(self.codec.encode({
             'source': source,
             'data': data
+        }))
+
+    async def send_frame(self, frame):
+        if not self.coalesce:
+            await self.write_frame(frame)
+            return
+
+        # Hold the frame briefly so frames close together go out as one
+        self.outbox.append(frame)
+        if len(self.outbox) >= WEBSOCKET_COALESCE_MAX_FRAMES:
+            await self.flush_outbox()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(WEBSOCKET_COALESCE_SECONDS)
+        self.flush_task = None
+        await self.flush_outbox()
+
+    async def flush_outbox(self):
+        frames, self.outbox = self.outbox, []
+        if len(frames) == 1:
+            await self.write_frame(frames[0])
+        elif frames:
+            await self.write_frame(self.codec.batch(frames))
+
+    async def write_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def send_group(self, group, source, data, invalidate=None):
+        # Encoded on the receiving side, once per process and codec in use
+        response = {
+            'type': 'broadcast_group',
+            'frame': broadcast_frame(source, data)
         }
-        async_to_sync(self.channel_layer.group_send)(
+        if invalidate:
+            # User ids whose cached profile and connections the event made stale
+            response['invalidate'] = invalidate
+        await self.channel_layer.group_send(
             group,
             response
         )
 
-    def broadcast_group(self, event):
-        source = event['source']
-        data = event['data']
-        self.send(text_data=json.dumps({
-            'source': source,
-            'data': data
-        }))
+    async def broadcast_group(self, event):
+        if 'invalidate' in event:
+            drop_local_users(event['invalidate'])
+        await self.send_frame(encode_broadcast(event['frame'], self.codec))
+
+    async def send_conversation(self, connection_id, source, data):
+        # One event for the sockets showing the conversation, data is keyed by the username it is for
+        response = {
+            'type': 'broadcast_conversation',
+            'frames': {
+                username: broadcast_frame(source, user_data)
+                for username, user_data in data.items()
+            }
+        }
+        await self.channel_layer.group_send(
+            conversation_group(connection_id),
+            response
+        )
+
+    async def broadcast_conversation(self, event):
+        frame = event['frames'].get(self.username)
+        if frame:
+            await self.send_frame(encode_broadcast(frame, self.codec))
 
-    def receive_search(self, data):
+    async def receive_search(self, data):
         user = self.scope['user']
         if not user.is_authenticated:
             return
@@ -119,101 +370,122 @@ class ChatConsumer(WebsocketConsumer):
         # Get the search query
         query = data.get('query')
 
-        # Get all users
-        users = UserSerializer(User.objects.filter(
-            Q(username__icontains=query) |
-            # Q(email__icontains=query) |
-            Q(first_name__icontains=query) |
-            Q(last_name__icontains=query)
-        ).exclude(
-            username=user.username
-        ).annotate(
-            pending_them=Exists(
-                Connection.objects.filter(
-                    sender=OuterRef('id'),
-                    receiver=user,
-                    accepted=False
-                )
-            ),
-            pending_me=Exists(
-                Connection.objects.filter(
-                    sender=user,
-                    receiver=OuterRef('id'),
-                    accepted=False
-                )
-            ),
-            connected=Exists(
-                Connection.objects.filter(
-                    Q(sender=OuterRef('id'), receiver=user) |
-                    Q(sender=user, receiver=OuterRef('id')),
-                    accepted=True
-                )
-            )
-        ), many=True)
+        # A new keystroke supersedes the pending or in-flight search
+        if self.search_task and not self.search_task.done():
+            self.search_task.cancel()
+
+        self.search_task = asyncio.create_task(self.run_search(user, query))
+
+    async def run_search(self, user, query):
+        stage = 'pending'
+        try:
+            await asyncio.sleep(SEARCH_DEBOUNCE_SECONDS)
+            stage = 'in_flight'
+            serialized = await self.get_search_results(user, query)
+        except asyncio.CancelledError:
+            self.dropped_searches[stage] += 1
+            search_stats[stage] += 1
+            raise
 
         # Send the search result to the user
-        self.send(text_data=json.dumps({
-            'source': 'search',
-            'data': SearchSerializer(users.instance, many=True).data
-        }))
+        await self.send_data('search', serialized)
 
-    def receive_request_connect(self, data):
+    @database_sync_to_async
+    def get_search_results(self, user, query):
+        users, statuses = search_users(user, query)
+
+        return SearchSerializer(users, context={
+            'statuses': statuses
+        }, many=True).data
+
+    async def receive_request_connect(self, data):
         user = self.scope['user']
         if not user.is_authenticated:
             return
 
         # Get the receiver's username
         receiver_username = data.get('username')
+
+        serialized = await self.create_request(user, receiver_username)
+        if serialized is None:
+            return
+
+        #  Send back the connection request to the user
+        await self.send_data('request-connect', serialized)
+
+        # Send the connection request to the receiver
+        await self.send_group(user_group(receiver_username), 'request-connect', serialized)
+
+    @database_sync_to_async
+    def create_request(self, user, receiver_username):
         try:
             receiver = User.objects.get(username=receiver_username)
         except User.DoesNotExist:
-            return
+            return None
 
         # Create a connection request
         connection, _ = Connection.objects.get_or_create(
             sender=user, receiver=receiver)
 
         # Serialize the connection request
-        serialized = RequestSerializer(connection)
-
-        #  Send back the connection request to the user
-        self.send(text_data=json.dumps({
-            'source': 'request-connect',
-            'data': serialized.data
-        }))
-
-        # Send the connection request to the receiver
-        self.send_group(receiver_username, 'request-connect', serialized.data)
+        return RequestSerializer(connection).data
 
-    def receive_request_list(self, data):
+    async def receive_request_list(self, data):
         user = self.scope['user']
         if not user.is_authenticated:
             return
 
+        serialized = await self.get_request_list(user)
+
+        # Send the connection requests to the user
+        await self.send_data('request-list', serialized)
+
+    @database_sync_to_async
+    def get_request_list(self, user):
         # Get the connection requests
-        requests = Connection.objects.filter(receiver=user, accepted=False)
+        requests = Connection.objects.filter(
+            receiver=user, accepted=False
+        ).select_related('sender', 'receiver')
 
         # Serialize the connection requests
-        serialized = RequestSerializer(requests, many=True)
+        return RequestSerializer(requests, many=True).data
 
-        # Send the connection requests to the user
-        self.send(text_data=json.dumps({
-            'source': 'request-list',
-            'data': serialized.data
-        })
-        )
-
-    def receive_accept_request(self, data):
+    async def receive_accept_request(self, data):
         user = self.scope['user']
         if not user.is_authenticated:
             return
 
         sender_username = data.get('username')
 
+        result = await self.accept_request(user, sender_username)
+        if result is None:
+            return
+
+        receiver_username, serialized, friend_sender, friend_receiver = result
+
+        # Both users' cached connections are stale, every process relaying these drops them
+        invalidate = [serialized['sender']['id'], serialized['receiver']['id']]
+
+        await self.send_group(user_group(sender_username),
+                              'request-accept', serialized, invalidate=invalidate)
+
+        await self.send_group(user_group(receiver_username),
+                              'request-accept', serialized, invalidate=invalidate)
+
+        # Send the new friend to the sender
+        await self.send_group(user_group(sender_username),
+                              'friend-new', friend_sender)
+
+        # Send the new friend to the receiver
+        await self.send_group(user_group(receiver_username),
+                              'friend-new', friend_receiver)
+
+    @database_sync_to_async
+    def accept_request(self, user, sender_username):
         try:
             sender = User.objects.get(username=sender_username)
         except User.DoesNotExist:
-            return
+            return None
 
         connection = Connection.objects.get(
             sender=sender, receiver=user, accepted=False)
@@ -221,166 +493,1178 @@ class ChatConsumer(WebsocketConsumer):
         connection.accepted = True
         connection.save()
 
-        serialized = RequestSerializer(connection)
-
-        self.send_group(sender_username, 'request-accept', serialized.data)
+        ConversationSummary.ensure(connection)
+        invalidate_users(sender.id, user.id)
 
-        self.send_group(connection.receiver.username,
-                        'request-accept', serialized.data)
+        serialized = RequestSerializer(connection)
 
-        # Send the new friend to the sender
-        serialized_friend = FriendSerializer(connection, context={
+        serialized_friend_sender = FriendSerializer(connection, context={
             'user': sender
         })
 
-        self.send_group(sender_username, 'friend-new', serialized_friend.data)
-
-        # Send the new friend to the receiver
-        serialized_friend = FriendSerializer(connection, context={
+        serialized_friend_receiver = FriendSerializer(connection, context={
             'user': connection.receiver
         })
 
-        self.send_group(connection.receiver.username,
-                        'friend-new', serialized_friend.data)
+        return (
+            connection.receiver.username,
+            serialized.data,
+            serialized_friend_sender.data,
+            serialized_friend_receiver.data
+        )
 
-    def receive_friend_list(self, data):
+    async def receive_friend_list(self, data):
         user = self.scope['user']
         if not user.is_authenticated:
             return
 
-        last_message = Message.objects.filter(
-            connection=OuterRef('id')
-        ).order_by('-created_at')
+        serialized = await self.get_friend_list(user)
 
-        friends = Connection.objects.filter(
+        # Only the socket that asked needs the list
+        await self.send_data('friend-list', serialized)
+
+    @database_sync_to_async
+    def get_friend_list(self, user):
+        summaries = ConversationSummary.objects.filter(
             Q(sender=user) | Q(receiver=user),
-            accepted=True
-        ).annotate(
-            last_message_updated_at=Subquery(
-                last_message.values('created_at')[:1]
-            )
-        ).order_by('-last_message_updated_at')
+            connection__accepted=True
+        ).select_related(
+            'connection', 'connection__sender', 'connection__receiver'
+        ).order_by('-last_activity_at')
 
-        serialized = FriendSerializer(
-            friends, context={'user': user}, many=True)
+        friends = [summary.connection for summary in summaries]
 
-        self.send_group(user.username, 'friend-list', serialized.data)
+        return FriendSerializer(
+            friends, context={'user': user}, many=True).data
 
-    def receive_message_send(self, data):
+    async def receive_message_send(self, data):
         user = self.scope['user']
         if not user.is_authenticated:
             return
 
-        sender_id = data.get('senderId')
+        image = None
+        if data.get('message_type') == 'image':
+            # Base64 image inside the JSON frame, kept for older clients
+            image = data.get('image')
+
+        await self.send_message(user, data, image)
+
+    async def send_message(self, user, data, image=None, reserved=False):
+        """
+        Store and fan out a message, reserved says the image already holds a pipeline slot.
+        """
+        client_msg_id = clean_client_msg_id(data.get('clientMsgId'))
+
+        # A retry of a recent send, answer this socket only, everyone else already has it
+        if client_msg_id is not None:
+            data_sender = recent_messages.get((user.id, client_msg_id))
+            if data_sender is not None:
+                if image is not None:
+                    if reserved:
+                        self.release_image()
+                    close_image(image)
+                await self.send_data('message-send', data_sender)
+                return
+
+        if image is not None and not reserved and not self.reserve_image():
+            close_image(image)
+            await self.send_busy('message-send')
+            return
+
+        try:
+            result = await self.create_message(user, data, client_msg_id)
+        except BaseException:
+            # Cancelled or failed, the reserved slot must not leak with the socket
+            if image is not None:
+                self.release_image()
+                close_image(image)
+            raise
+        if result is None:
+            if image is not None:
+                self.release_image()
+                close_image(image)
+            return
+
+        message_id, receiver_username, data_sender, data_receiver, created = result
+
+        if client_msg_id is not None:
+            recent_messages.set((user.id, client_msg_id), data_sender)
+
+        if not created:
+            # Stored by an earlier attempt this process didn't see
+            if image is not None:
+                self.release_image()
+                close_image(image)
+            await self.send_data('message-send', data_sender)
+            return
+
+        # New messages go to every socket, friend lists and notifications need them too
+        await self.send_group(user_group(user.username), 'message-send',
+                              data_sender)
+
+        await self.send_group(user_group(receiver_username), 'message-send',
+                              data_receiver)
 
-        sender = User.objects.get(id=sender_id)
-        print("sender", sender.username)
+        # The message went out as a placeholder, its image_url follows as a message-update
+        if image is not None:
+            image_pipeline.spawn(
+                self.finish_image_message(message_id, image))
+
+    @database_sync_to_async
+    def create_message(self, user, data, client_msg_id=None):
+        # The socket's user sends, senderId from the client is no longer trusted
+        print("sender", user.username)
 
         connection_id = data.get('connectionId')
-        message_type = data.get('message_type')
 
-        try:
-            connection = Connection.objects.get(id=connection_id)
-        except Connection.DoesNotExist:
+        # The cached connections are also the check that the user is in the conversation
+        conversation = get_conversation(user.id, connection_id)
+        if conversation is None:
             print("Connection does not exist")
-            return
+            return None
 
+        connection, receiver_id, receiver_username = conversation
+
+        # Image messages may come without a caption
         content = data.get('message')
+        if not isinstance(content, str):
+            content = ''
         print("content", content)
 
-        if message_type == 'image':
-            image_str = data.get('image')
-            image_url = save_image(image_str, 'message',
-                                   sender, connection.receiver)
-            message = Message.objects.create(
-                connection=connection,
-                sender=sender,
-                image_url=image_url,
-                content=content
-            )
-        else:
-            message = Message.objects.create(
-                connection=connection,
-                sender=sender,
-                content=content
-            )
+        # The hot table's constraint doesn't cover archived messages. Only a send the client
+        # marks as a retry can be one of those, first sends don't pay for the archive read
+        if client_msg_id is not None and data.get('retry') is True:
+            message = ArchivedMessage.objects.filter(
+                sender=user, client_msg_id=client_msg_id).first()
+            if message is not None:
+                message.sender = user
+                data_sender, data_receiver = self.message_payloads(
+                    message, get_profile(user.id), get_profile(receiver_id))
+                return message.id, receiver_username, data_sender, data_receiver, False
+
+        # Keep the conversation summary in step with the new message, the only writes of a warm send
+        created = True
+        try:
+            with transaction.atomic():
+                message = Message.objects.create(
+                    connection=connection,
+                    sender=user,
+                    content=content,
+                    client_msg_id=client_msg_id
+                )
+                ConversationSummary.record_message(message)
+        except IntegrityError:
+            if client_msg_id is None:
+                raise
+            # Insert first and look up on conflict, a first send costs no extra read
+            message = Message.objects.get(sender=user, client_msg_id=client_msg_id)
+            message.sender = user
+            created = False
 
-        serialized_message = MessageSerializer(message, context={
-            'user': sender
-        })
+        data_sender, data_receiver = self.message_payloads(
+            message, get_profile(user.id), get_profile(receiver_id))
 
-        serialized_user = UserSerializer(sender)
+        return message.id, receiver_username, data_sender, data_receiver, created
 
-        # Send the message to the receiver
-        receiver = connection.sender
-        if user == connection.sender:
-            receiver = connection.receiver
+    async def receive_message_send_batch(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
 
-        serialized_friend = UserSerializer(receiver)
-        serialized_message_receiver = MessageSerializer(message, context={
-            'user': receiver
-        })
+        items = data.get('messages')
+        if not isinstance(items, list) or not 0 < len(items) <= MESSAGE_BATCH_MAX_SIZE:
+            return
+
+        payloads = await self.create_messages(user, items)
+
+        # One event per user for the whole batch, not two per message
+        for username, user_payloads in payloads.items():
+            await self.send_group(user_group(username), 'message-send-batch', user_payloads)
+
+    @database_sync_to_async
+    def create_messages(self, user, items):
+        # Only text messages, sent by this user on their own accepted connections
+        connections = Connection.objects.filter(
+            Q(sender=user) | Q(receiver=user),
+            id__in=[item.get('connectionId') for item in items if isinstance(item, dict)],
+            accepted=True
+        ).select_related('sender', 'receiver').in_bulk()
+
+        items = [
+            item for item in items
+            if isinstance(item, dict) and item.get('connectionId') in connections
+        ]
+
+        # A retried batch only inserts what didn't make it, one attempt more if another socket raced us
+        for attempt in range(2):
+            messages = self.new_messages(user, connections, items)
+            if not messages:
+                return {}
+            try:
+                with transaction.atomic():
+                    messages = Message.objects.bulk_create(messages)
+                    ConversationSummary.record_messages(messages)
+                break
+            except IntegrityError:
+                if attempt:
+                    raise
+
+        payloads = defaultdict(list)
+        for message in messages:
+            connection = message.connection
+            receiver = connection.sender
+            if user.id == connection.sender_id:
+                receiver = connection.receiver
+
+            data_sender, data_receiver = self.message_payloads(
+                message, get_profile(user.id), get_profile(receiver.id))
+            payloads[user.username].append(data_sender)
+            payloads[receiver.username].append(data_receiver)
+
+        return payloads
+
+    def new_messages(self, user, connections, items):
+        client_msg_ids = {
+            clean_client_msg_id(item.get('clientMsgId')) for item in items
+        } - {None}
+
+        stored = set()
+        if client_msg_ids:
+            stored = set(Message.objects.filter(
+                sender=user, client_msg_id__in=client_msg_ids
+            ).values_list('client_msg_id', flat=True))
+            stored |= archived_client_msg_ids(user.id, client_msg_ids)
+
+        messages = []
+        for item in items:
+            client_msg_id = clean_client_msg_id(item.get('clientMsgId'))
+            if client_msg_id is not None:
+                if client_msg_id in stored:
+                    continue
+                stored.add(client_msg_id)
+            messages.append(Message(
+                connection=connections[item['connectionId']],
+                sender=user,
+                content=item.get('message') if isinstance(item.get('message'), str) else '',
+                client_msg_id=client_msg_id
+            ))
+        return messages
+
+    def message_payloads(self, message, sender_profile, receiver_profile):
+        # Serialize the message once, the sides only differ in is_my_message
+        serialized_message = MessageSerializer(message, context={
+            'user': message.sender
+        }).data
 
-        data = {
-            'messages': serialized_message_receiver.data,
-            'user': serialized_user.data
+        data_sender = {
+            'messages': serialized_message,
+            'user': receiver_profile
         }
 
         data_receiver = {
-            'messages': serialized_message.data,
-            'user': serialized_friend.data
+            'messages': {**serialized_message, 'is_my_message': False},
+            'user': sender_profile
         }
 
-        self.send_group(user.username, 'message-send',
-                        data_receiver)
+        return data_sender, data_receiver
+
+    async def finish_image_message(self, message_id, image):
+        try:
+            result = await image_pipeline.run(
+                self.process_image_message, message_id, image)
+        except Exception as e:
+            print("Image processing failed", message_id, e)
+            return
+        finally:
+            self.pending_images -= 1
+            close_image(image)
+
+        connection_id, sender_username, receiver_username, data_sender, data_receiver = result
 
-        self.send_group(receiver.username, 'message-send',
-                        data)
+        # Only sockets showing the conversation render the image
+        await self.send_conversation(connection_id, 'message-update', {
+            sender_username: data_sender,
+            receiver_username: data_receiver
+        })
 
-    def receive_message_list(self, data):
+    def process_image_message(self, message_id, image):
+        message = Message.objects.select_related(
+            'sender', 'connection__sender', 'connection__receiver'
+        ).get(id=message_id)
+
+        sender = message.sender
+        receiver = message.connection.sender
+        if sender.id == message.connection.sender_id:
+            receiver = message.connection.receiver
+
+        message.image_url, message.image_variants = save_image(
+            image, 'message')
+        message.save(update_fields=['image_url', 'image_variants'])
+
+        data_sender, data_receiver = self.message_payloads(
+            message, get_profile(sender.id), get_profile(receiver.id))
+
+        return (
+            message.connection_id,
+            sender.username,
+            receiver.username,
+            data_sender,
+            data_receiver
+        )
+
+    async def receive_message_list(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        result = await self.get_message_list(user, data)
+        if result is None:
+            return
+
+        connection_id, serialized, read = result
+
+        # Send the messages to the socket that asked
+        await self.send_data('message-list', serialized)
+
+        if read is not None:
+            await self.send_read_receipt(connection_id, read)
+
+        # Fetching the newest page means the chat was opened
+        if not (data.get('before') or data.get('after') or data.get('page')):
+            await self.open_conversation(connection_id)
+
+    async def receive_conversation_open(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        connection_id = await self.get_conversation_id(user, data.get('connectionId'))
+        if connection_id is None:
+            return
+
+        await self.open_conversation(connection_id)
+
+    async def receive_conversation_close(self, data):
         user = self.scope['user']
         if not user.is_authenticated:
             return
 
         connection_id = data.get('connectionId')
-        page = data.get('page')
-        PAGE_SIZE = 10
+        if registry.close(self.channel_name, connection_id):
+            await self.channel_layer.group_discard(
+                conversation_group(connection_id),
+                self.channel_name
+            )
 
-        try:
-            connection = Connection.objects.get(id=connection_id)
-        except Connection.DoesNotExist:
-            print("Connection does not exist")
+    @database_sync_to_async
+    def get_conversation_id(self, user, connection_id):
+        conversation = get_conversation(user.id, connection_id)
+        if conversation is None:
+            return None
+        return conversation[0].id
+
+    async def open_conversation(self, connection_id):
+        if registry.is_open(self.channel_name, connection_id):
+            registry.open(self.channel_name, connection_id)
             return
 
-        messages = Message.objects.filter(
-            connection=connection).order_by('-created_at')[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+        await self.channel_layer.group_add(
+            conversation_group(connection_id),
+            self.channel_name
+        )
+
+        # A socket keeps at most CONVERSATION_MAX_OPEN conversations, the oldest is left
+        closed = registry.open(self.channel_name, connection_id)
+        if closed is not None:
+            await self.channel_layer.group_discard(
+                conversation_group(closed),
+                self.channel_name
+            )
+
+    @database_sync_to_async
+    def get_message_list(self, user, data):
+        PAGE_SIZE = 10
+
+        connection_id = data.get('connectionId')
+
+        # New clients page with a (created_at, id) cursor, older ones still send a page number
+        before = data.get('before')
+        after = data.get('after')
+        page = data.get('page') or 0
+
+        conversation = get_conversation(user.id, connection_id)
+        if conversation is None:
+            print("Connection does not exist")
+            return None
+
+        connection, _, friend_username = conversation
+
+        messages = Message.objects.filter(connection=connection)
+
+        if before or after:
+            cursor = decode_cursor(before or after)
+            if cursor is None:
+                return None
+            created_at, message_id = cursor
+
+        if before:
+            # Older than the cursor, newest first
+            messages = messages.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, id__lt=message_id)
+            ).order_by('-created_at', '-id')
+        elif after:
+            # Newer than the cursor, oldest first so the page sits right after it
+            messages = messages.filter(
+                Q(created_at__gt=created_at) |
+                Q(created_at=created_at, id__gt=message_id)
+            ).order_by('created_at', 'id')
+        else:
+            messages = messages.order_by(
+                '-created_at', '-id')[page * PAGE_SIZE:]
+
+        # Fetch one extra row to know if there is another page, no COUNT needed
+        messages = list(messages[:PAGE_SIZE + 1])
+
+        # Past the hot window the page continues in the archive
+        if after:
+            if created_at < hot_cutoff():
+                messages = with_archived(connection.id, messages, PAGE_SIZE + 1,
+                                         cursor, newer=True)
+        elif len(messages) <= PAGE_SIZE:
+            offset = 0
+            if page and not before and not messages:
+                # Old page numbers skip the hot messages first
+                hot_count = Message.objects.filter(connection=connection).count()
+                offset = max(page * PAGE_SIZE - hot_count, 0)
+            messages = with_archived(connection.id, messages, PAGE_SIZE + 1,
+                                     cursor if before else None, offset=offset)
+
+        has_more = len(messages) > PAGE_SIZE
+        messages = messages[:PAGE_SIZE]
+
+        if after:
+            messages.reverse()
+
+        # Opening the conversation at its newest page reads it
+        read = None
+        if not (before or after or page):
+            read = self.mark_read(connection, user, friend_username)
 
         serialized = MessageSerializer(messages, context={
             'user': user
         }, many=True)
 
-        serialized_user = UserSerializer(user)
 
-        messages_count = Message.objects.filter(connection=connection).count()
+        next_page = page + 1 if has_more and not (before or after) else 0
 
-        next_page = page + 1 if messages_count > (page + 1) * PAGE_SIZE else 0
+        next_before = None
+        next_after = None
+        if messages and has_more:
+            if after:
+                next_after = encode_cursor(messages[0])
+            else:
+                next_before = encode_cursor(messages[-1])
 
-        data = {
+        return connection.id, {
             'messages': serialized.data,
             'next': next_page,
-            'user': serialized_user.data
+            'before': next_before,
+            'after': next_after,
+            'user': get_profile(user.id)
+        }, read
+
+    async def receive_message_search(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        query = data.get('query')
+        if not isinstance(query, str):
+            return
+
+        serialized = await self.get_message_search(user, query, data.get('cursor'))
+
+        await self.send_data('message-search', serialized)
+
+    @database_sync_to_async
+    def get_message_search(self, user, query, cursor):
+        # Only messages of the user's own connections, best match first
+        messages, next_cursor = search_messages(user, query, cursor)
+
+        serialized = SyncMessageSerializer(messages, context={
+            'user': user
+        }, many=True)
+
+        return {
+            'query': query,
+            'messages': serialized.data,
+            'cursor': next_cursor
         }
 
-        # Send the messages to the user
-        self.send_group(user.username, 'message-list', data)
+    async def receive_message_read(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        connection_id = data.get('connectionId')
+        message_id = data.get('messageId')
+        if not isinstance(connection_id, int) or not isinstance(message_id, int):
+            return
 
-    def receive_message_typing(self, data):
+        self.queue_read(('connection', connection_id), message_id)
+
+    async def receive_group_message_read(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        group_id = data.get('groupId')
+        message_id = data.get('messageId')
+        if not isinstance(group_id, int) or not isinstance(message_id, int):
+            return
+
+        self.queue_read(('group', group_id), message_id)
+
+    def queue_read(self, key, message_id):
+        # Scrolling reports every message, only the highest per conversation gets written
+        if message_id > self.read_marks.get(key, 0):
+            self.read_marks[key] = message_id
+        if self.read_task is None:
+            self.read_task = asyncio.create_task(self.flush_reads_later())
+
+    async def flush_reads_later(self):
+        await asyncio.sleep(READ_RECEIPT_DELAY_SECONDS)
+        self.read_task = None
+        await self.flush_reads()
+
+    async def flush_reads(self):
+        user = self.scope['user']
+        marks, self.read_marks = self.read_marks, {}
+
+        for (kind, target_id), message_id in marks.items():
+            if kind == 'group':
+                read = await self.mark_group_read(user, target_id, message_id)
+                if read is not None:
+                    await self.send_group_read_receipt(target_id, read)
+                continue
+
+            read = await self.mark_connection_read(user, target_id, message_id)
+            if read is not None:
+                await self.send_read_receipt(target_id, read)
+
+    @database_sync_to_async
+    def mark_connection_read(self, user, connection_id, message_id):
+        conversation = get_conversation(user.id, connection_id)
+        if conversation is None:
+            return None
+
+        connection, _, friend_username = conversation
+        return self.mark_read(connection, user, friend_username, message_id)
+
+    def mark_read(self, connection, user, friend_username, message_id=None):
+        read = ConversationSummary.mark_read(connection, user, message_id)
+        if read is None:
+            return None
+
+        return (friend_username, *read)
+
+    async def send_read_receipt(self, connection_id, read):
+        friend_username, last_read, unread = read
+
+        receipt = {
+            'connectionId': connection_id,
+            'username': self.username,
+            'messageId': last_read
+        }
+
+        # The friend sees it where the conversation is open
+        await self.send_conversation(connection_id, 'message-read', {
+            friend_username: receipt
+        })
+
+        # The user's other sockets update their unread badge
+        await self.send_group(user_group(self.username), 'message-read', {
+            **receipt,
+            'unread': unread
+        })
+
+    @database_sync_to_async
+    def mark_group_read(self, user, group_id, message_id):
+        return GroupMember.mark_read(group_id, user, message_id)
+
+    async def send_group_read_receipt(self, group_id, read):
+        last_read, unread = read
+
+        # Not fanned out to the members, a large group would get one event per member per read
+        await self.send_group(user_group(self.username), 'group-message-read', {
+            'groupId': group_id,
+            'messageId': last_read,
+            'unread': unread
+        })
+
+    async def receive_message_typing(self, data):
         user = self.scope['user']
         if not user.is_authenticated:
             return
 
         username = data.get('username')
 
-        self.send_group(username, 'message-typing', {
-            'username': user.username
+        if username not in self.typing.allowed:
+            self.typing.allowed[username] = await self.get_connection_id(user, username)
+        if self.typing.allowed[username] is None:
+            return
+
+        # Older clients only send keystrokes, a missing flag means typing
+        if data.get('typing', True) is False:
+            if self.typing.stop(username):
+                await self.send_typing(username, False)
+            return
+
+        if self.typing.start(username, time.monotonic()):
+            await self.send_typing(username, True)
+            if username not in self.typing_tasks:
+                self.typing_tasks[username] = asyncio.create_task(
+                    self.expire_typing(username))
+
+    @database_sync_to_async
+    def get_connection_id(self, user, username):
+        return get_friend_connection_id(user.id, username)
+
+    async def expire_typing(self, username):
+        try:
+            # Sleep until no keystroke arrived for TYPING_TIMEOUT_SECONDS
+            while True:
+                remaining = self.typing.remaining(username, time.monotonic())
+                if remaining is None:
+                    return
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining)
+
+            if self.typing.stop(username):
+                await self.send_typing(username, False)
+        finally:
+            self.typing_tasks.pop(username, None)
+
+    async def send_typing(self, username, typing):
+        # Only the peer's sockets that have the conversation open see it
+        await self.send_conversation(self.typing.allowed[username], 'message-typing', {
+            username: {
+                'username': self.username,
+                'typing': typing
+            }
+        })
+
+    @database_sync_to_async
+    def get_group_ids(self, user):
+        return list(GroupMember.objects.filter(
+            user=user).values_list('group_id', flat=True))
+
+    async def send_group_joined(self, username, group_id, serialized):
+        # The member's sockets join the chat's group themselves, wherever they are connected
+        await self.channel_layer.group_send(user_group(username), {
+            'type': 'group_joined',
+            'groupId': group_id,
+            'frame': broadcast_frame('group-new', serialized)
+        })
+
+    async def group_joined(self, event):
+        group_id = event['groupId']
+        if group_id not in self.group_ids:
+            self.group_ids.add(group_id)
+            await self.channel_layer.group_add(
+                group_chat_group(group_id),
+                self.channel_name
+            )
+        await self.send_frame(encode_broadcast(event['frame'], self.codec))
+
+    async def group_left(self, event):
+        group_id = event['groupId']
+        if group_id in self.group_ids:
+            self.group_ids.discard(group_id)
+            await self.channel_layer.group_discard(
+                group_chat_group(group_id),
+                self.channel_name
+            )
+        await self.send_frame(encode_broadcast(event['frame'], self.codec))
+
+    async def receive_group_create(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        name = data.get('name')
+        usernames = data.get('usernames')
+        if not name or not isinstance(usernames, list) or len(usernames) >= GROUP_MAX_MEMBERS:
+            return
+
+        group_id, serialized = await self.create_group(user, name, usernames)
+
+        for member in serialized['members']:
+            await self.send_group_joined(
+                member['user']['username'], group_id, serialized)
+
+    @database_sync_to_async
+    def create_group(self, user, name, usernames):
+        # Only friends of the creator can be added
+        friends = self.get_friends(user, usernames)
+
+        with transaction.atomic():
+            group = GroupChat.objects.create(name=name[:100], created_by=user)
+            members = GroupMember.objects.bulk_create(
+                [GroupMember(group=group, user=user, role=GroupMember.OWNER)] +
+                [GroupMember(group=group, user=friend) for friend in friends]
+            )
+
+        return group.id, {
+            'group': GroupSerializer(group).data,
+            'members': GroupMemberSerializer(members, many=True).data
+        }
+
+    def get_friends(self, user, usernames):
+        connections = Connection.objects.filter(
+            Q(sender=user, receiver__username__in=usernames) |
+            Q(receiver=user, sender__username__in=usernames),
+            accepted=True
+        ).select_related('sender', 'receiver')
+
+        return [
+            connection.receiver if connection.sender_id == user.id else connection.sender
+            for connection in connections
+        ]
+
+    async def receive_group_add(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        group_id = data.get('groupId')
+        usernames = data.get('usernames')
+        if not isinstance(usernames, list):
+            return
+
+        serialized = await self.add_group_members(user, group_id, usernames)
+        if serialized is None:
+            return
+
+        # Current members hear about the new ones once, through the chat's group
+        await self.send_group(group_chat_group(group_id), 'group-member-add', {
+            'groupId': group_id,
+            'members': serialized['members']
+        })
+
+        # New members get the chat and join its group
+        for member in serialized['members']:
+            await self.send_group_joined(
+                member['user']['username'], group_id, serialized)
+
+    @database_sync_to_async
+    def add_group_members(self, user, group_id, usernames):
+        if get_role(group_id, user.id) not in GroupMember.MANAGERS:
+            return None
+
+        member_ids = memberships.get(group_id)
+        friends = [
+            friend for friend in self.get_friends(user, usernames)
+            if friend.id not in member_ids
+        ]
+        if not friends or len(member_ids) + len(friends) > GROUP_MAX_MEMBERS:
+            return None
+
+        group = GroupChat.objects.get(id=group_id)
+        members = GroupMember.objects.bulk_create(
+            [GroupMember(group=group, user=friend) for friend in friends],
+            ignore_conflicts=True
+        )
+
+        # bulk_create sends no post_save
+        memberships.invalidate(group_id)
+
+        return {
+            'group': GroupSerializer(group).data,
+            'members': GroupMemberSerializer(members, many=True).data
+        }
+
+    async def receive_group_leave(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        group_id = data.get('groupId')
+
+        result = await self.leave_group(user, group_id)
+        if result is None:
+            return
+
+        await self.send_group(group_chat_group(group_id), 'group-member-remove', {
+            'groupId': group_id,
+            'username': user.username,
+            'owner': result
+        })
+
+        # Every socket of the user leaves the chat's group
+        await self.channel_layer.group_send(user_group(user.username), {
+            'type': 'group_left',
+            'groupId': group_id,
+            'frame': broadcast_frame('group-leave', {'groupId': group_id})
+        })
+
+    @database_sync_to_async
+    def leave_group(self, user, group_id):
+        """
+        Returns the new owner's username when the owner left, '' otherwise, None if the user wasn't a member.
+        """
+        role = get_role(group_id, user.id)
+        if role is None:
+            return None
+
+        with transaction.atomic():
+            GroupMember.objects.filter(group_id=group_id, user=user).delete()
+            if role != GroupMember.OWNER:
+                return ''
+
+            # Ownership passes to the longest standing admin, else the longest standing member
+            successor = GroupMember.objects.filter(
+                group_id=group_id
+            ).select_related('user').order_by(
+                Case(When(role=GroupMember.ADMIN, then=Value(0)), default=Value(1)),
+                'joined_at'
+            ).first()
+            if successor is None:
+                GroupChat.objects.filter(id=group_id).delete()
+                return ''
+            successor.role = GroupMember.OWNER
+            successor.save(update_fields=['role'])
+            return successor.user.username
+
+    async def receive_group_list(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        serialized = await self.get_group_list(user)
+
+        await self.send_data('group-list', serialized)
+
+    @database_sync_to_async
+    def get_group_list(self, user):
+        # Unread counts come from the read marks, each counted on the (group, id) index
+        groups = GroupMember.objects.filter(
+            user=user
+        ).select_related('group').annotate(
+            unread=Count('group__messages', filter=Q(
+                group__messages__id__gt=F('last_read_id')
+            ) & ~Q(group__messages__sender=user))
+        ).order_by('-group__updated_at')
+
+        return MembershipSerializer(groups, many=True).data
+
+    async def receive_group_members(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        group_id = data.get('groupId')
+
+        serialized = await self.get_group_members(user, group_id)
+        if serialized is None:
+            return
+
+        await self.send_data('group-members', {
+            'groupId': group_id,
+            'members': serialized
+        })
+
+    @database_sync_to_async
+    def get_group_members(self, user, group_id):
+        if get_role(group_id, user.id) is None:
+            return None
+
+        members = GroupMember.objects.filter(
+            group_id=group_id).select_related('user').order_by('joined_at')
+
+        return GroupMemberSerializer(members, many=True).data
+
+    async def receive_group_message_send(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        group_id = data.get('groupId')
+        content = data.get('message')
+        if not content:
+            return
+
+        serialized = await self.create_group_message(user, group_id, content)
+        if serialized is None:
+            return
+
+        # One event for the whole chat, the layer delivers it to every member's sockets
+        await self.send_group(group_chat_group(group_id),
+                              'group-message-send', serialized)
+
+    @database_sync_to_async
+    def create_group_message(self, user, group_id, content):
+        # Membership comes from the cache, the members themselves are never loaded
+        if get_role(group_id, user.id) is None:
+            return None
+
+        with transaction.atomic():
+            message = GroupMessage.objects.create(
+                group_id=group_id,
+                sender=user,
+                content=content
+            )
+            GroupChat.objects.filter(id=group_id).update(
+                updated_at=message.created_at)
+
+        return {
+            'messages': GroupMessageSerializer(message).data,
+            'user': UserSerializer(user).data
+        }
+
+    async def receive_group_message_list(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        serialized = await self.get_group_message_list(user, data)
+        if serialized is None:
+            return
+
+        await self.send_data('group-message-list', serialized)
+
+    @database_sync_to_async
+    def get_group_message_list(self, user, data):
+        PAGE_SIZE = 10
+
+        group_id = data.get('groupId')
+        before = data.get('before')
+
+        if get_role(group_id, user.id) is None:
+            return None
+
+        messages = GroupMessage.objects.filter(group_id=group_id)
+
+        if before:
+            cursor = decode_cursor(before)
+            if cursor is None:
+                return None
+            created_at, message_id = cursor
+            messages = messages.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, id__lt=message_id)
+            )
+
+        messages = list(messages.order_by(
+            '-created_at', '-id')[:PAGE_SIZE + 1])
+        has_more = len(messages) > PAGE_SIZE
+        messages = messages[:PAGE_SIZE]
+
+        return {
+            'groupId': group_id,
+            'messages': GroupMessageSerializer(messages, many=True).data,
+            'before': encode_cursor(messages[-1]) if messages and has_more else None
+        }
+
+    async def receive_sync(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        # Message ids only grow, so the newest id the client has is its cursor
+        last_message_id = data.get('lastMessageId') or 0
+        if not isinstance(last_message_id, int):
+            return
+
+        # Group chats have their own id sequence, clients that send its cursor sync them too
+        last_group_message_id = data.get('lastGroupMessageId')
+        if last_group_message_id is not None and not isinstance(last_group_message_id, int):
+            return
+
+        connection_ids = await self.get_connection_ids(user)
+        await self.stream_sync(user, 'sync', Message.objects.filter(
+            connection_id__in=connection_ids), last_message_id, SyncMessageSerializer)
+
+        if last_group_message_id is not None:
+            group_ids = await self.get_group_ids(user)
+            await self.stream_sync(user, 'group-sync', GroupMessage.objects.filter(
+                group_id__in=group_ids), last_group_message_id, GroupMessageSerializer)
+
+    async def stream_sync(self, user, source, messages, last_message_id, serializer_class):
+        last_message_id = await self.get_sync_start(messages, last_message_id)
+
+        # Stream in chunks, past SYNC_MAX_CHUNKS the client asks again from 'last'
+        for _ in range(SYNC_MAX_CHUNKS):
+            serialized, last_message_id, done = await self.get_sync_chunk(
+                user, messages, last_message_id, serializer_class)
+
+            await self.send_data(source, {
+                'messages': serialized,
+                'last': last_message_id,
+                'done': done
+            })
+
+            if done:
+                return
+
+    @database_sync_to_async
+    def get_connection_ids(self, user):
+        return [int(connection_id) for connection_id in get_connections(user.id)]
+
+    @database_sync_to_async
+    def get_sync_start(self, messages, last_message_id):
+        """
+        Ids are taken before commit, so a message below the cursor can commit after the client
+        saw the cursor. Messages created up to SYNC_RESCAN_SECONDS before the cursor's are sent
+        again, clients drop the ones they already have by id.
+        """
+        created_at = messages.model.objects.filter(
+            id=last_message_id).values_list('created_at', flat=True).first()
+        if created_at is None:
+            return last_message_id
+
+        first_id = messages.filter(
+            id__lte=last_message_id,
+            created_at__gte=created_at - timedelta(seconds=SYNC_RESCAN_SECONDS)
+        ).aggregate(first_id=Min('id'))['first_id']
+        if first_id is None:
+            return last_message_id
+        return first_id - 1
+
+    @database_sync_to_async
+    def get_sync_chunk(self, user, messages, last_message_id, serializer_class=SyncMessageSerializer):
+        # One extra row tells whether another chunk follows
+        messages = list(messages.filter(
+            id__gt=last_message_id
+        ).order_by('id')[:SYNC_CHUNK_SIZE + 1])
+
+        done = len(messages) <= SYNC_CHUNK_SIZE
+        messages = messages[:SYNC_CHUNK_SIZE]
+        if messages:
+            last_message_id = messages[-1].id
+
+        serialized = serializer_class(messages, context={
+            'user': user
+        }, many=True)
+
+        return serialized.data, last_message_id, done
+
+    async def receive_heartbeat(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        await presence.heartbeat(self.username, self.channel_name)
+
+    async def receive_presence_list(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        await self.send_data('presence-list', {
+            'online': await presence.online_friends(user.username)
+        })
+
+    async def receive_upload_start(self, data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        upload_id = data.get('uploadId')
+        size = data.get('size')
+        target = data.get('target')
+
+        if not isinstance(upload_id, str) or target not in ('message-send', 'thumbnail'):
+            await self.send_upload_error(upload_id, 'invalid')
+            return
+
+        # The message is sent from these fields once the last chunk arrives
+        if target == 'message-send' and (
+                not data.get('connectionId') or
+                not isinstance(data.get('message', ''), str)):
+            await self.send_upload_error(upload_id, 'invalid')
+            return
+
+        if not isinstance(size, int) or not 0 < size <= IMAGE_UPLOAD_MAX_BYTES:
+            await self.send_upload_error(upload_id, 'too-large')
+            return
+
+        # Starting an upload that already exists resumes it
+        upload = uploads.start(user.username, upload_id, size, data)
+        if upload is None:
+            await self.send_upload_error(upload_id, 'busy')
+            return
+
+        # The pipeline slot is taken now, a busy pipeline turns the upload away before any bytes are sent
+        if not upload.reserved:
+            if not image_pipeline.reserve():
+                uploads.pop(user.username, upload_id)
+                upload.close()
+                await self.send_upload_error(upload_id, 'busy')
+                return
+            upload.reserved = True
+
+        await self.send_data('upload-start', {
+            'uploadId': upload_id,
+            'offset': upload.received
+        })
+
+    async def receive_upload_chunk(self, bytes_data):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        try:
+            header, chunk = parse_chunk(bytes_data)
+        except ValueError:
+            return
+
+        await self.receive_upload_chunk_data(header, chunk)
+
+    async def receive_upload_chunk_data(self, header, chunk):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            return
+
+        if not isinstance(chunk, (bytes, memoryview)):
+            return
+
+        upload_id = header.get('uploadId')
+        if not isinstance(upload_id, str):
+            return
+
+        upload = uploads.get(user.username, upload_id)
+        if upload is None:
+            await self.send_upload_error(upload_id, 'unknown')
+            return
+
+        if not upload.write(header.get('offset'), chunk):
+            # Out of order chunk, tell the client where to resume from
+            await self.send_data('upload-offset', {
+                'uploadId': upload_id,
+                'offset': upload.received
+            })
+            return
+
+        if not upload.complete:
+            return
+
+        uploads.pop(user.username, upload_id)
+
+        # The upload's pipeline slot goes with the image, to whichever socket finished it
+        upload.reserved = False
+        self.pending_images += 1
+
+        # The image goes to the pipeline as a file, never as one big bytes object
+        if upload.data.get('target') == 'thumbnail':
+            await self.start_thumbnail(user, upload.open(), reserved=True)
+        else:
+            await self.send_message(user, upload.data, upload.open(), reserved=True)
+
+    async def send_upload_error(self, upload_id, reason):
+        await self.send_data('upload-error', {
+            'uploadId': upload_id,
+            'reason': reason
         })
@@ -0,0 +1,168 @@
+from django.conf import settings
+from django.db import connection as db_connection, connections, transaction
+from .models import Message
+
+
+MESSAGE_SEARCH_PAGE_SIZE = getattr(settings, 'MESSAGE_SEARCH_PAGE_SIZE', 20)
+
+# Created by migration 0009, next to chat_message
+FTS_TABLE = 'chat_message_fts'
+
+# SQLite keeps the FTS5 table in step through these. Rebuilding chat_message for a migration drops
+# them, restore_message_search puts them back after every migrate
+FTS_TRIGGERS = {
+    f'{FTS_TABLE}_insert': (
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON chat_message BEGIN "
+        f"INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content); END"
+    ),
+    f'{FTS_TABLE}_delete': (
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON chat_message BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content); END"
+    ),
+    f'{FTS_TABLE}_update': (
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF content ON chat_message BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content); "
+        f"INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content); END"
+    ),
+}
+
+# Connections the user may read, in the same shape for every backend
+USER_CONNECTIONS = (
+    'SELECT id FROM chat_connection '
+    'WHERE (sender_id = %s OR receiver_id = %s) AND accepted = %s'
+)
+
+
+def encode_search_cursor(rank, message_id):
+    """
+    This function builds an opaque cursor from the last result's (rank, id).
+    """
+    return f'{rank!r}_{message_id}'
+
+
+def decode_search_cursor(cursor):
+    """
+    This function parses a cursor built by encode_search_cursor, returns None if it is malformed.
+    """
+    try:
+        rank, message_id = str(cursor).rsplit('_', 1)
+        return float(rank), int(message_id)
+    except ValueError:
+        return None
+
+
+def fts5_query(query):
+    # Every word quoted, so user input can't use FTS5 syntax, and all of them must match
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+
+
+_has_fts_table = False
+
+
+def has_fts_table():
+    # Only a missing table is checked again, migrating later starts using it
+    global _has_fts_table
+    if not _has_fts_table:
+        _has_fts_table = FTS_TABLE in db_connection.introspection.table_names()
+    return _has_fts_table
+
+
+def find_messages(user, query, cursor, limit):
+    """
+    This function returns [(message id, rank)] best first, higher rank is better.
+    """
+    params = [user.id, user.id, True]
+    after = ''
+    if cursor is not None:
+        rank, message_id = cursor
+        after = 'WHERE rank < %s OR (rank = %s AND id < %s)'
+
+    if db_connection.vendor == 'postgresql':
+        # Same expression as chat_message_content_fts_idx, so the GIN index serves the match
+        sql = (
+            "SELECT id, rank FROM ("
+            "SELECT m.id, ts_rank(to_tsvector('simple', m.content), q)::float8 AS rank "
+            "FROM chat_message m, websearch_to_tsquery('simple', %s) q "
+            f"WHERE to_tsvector('simple', m.content) @@ q AND m.connection_id IN ({USER_CONNECTIONS})"
+            f") matches {after} ORDER BY rank DESC, id DESC LIMIT %s"
+        )
+        params = [query] + params
+    elif db_connection.vendor == 'sqlite' and has_fts_table():
+        # bm25 is lower for better matches, negated to rank like PostgreSQL
+        sql = (
+            "SELECT id, rank FROM ("
+            f"SELECT m.id, -bm25({FTS_TABLE}) AS rank FROM {FTS_TABLE} "
+            f"JOIN chat_message m ON m.id = {FTS_TABLE}.rowid "
+            f"WHERE {FTS_TABLE} MATCH %s AND m.connection_id IN ({USER_CONNECTIONS})"
+            f") matches {after} ORDER BY rank DESC, id DESC LIMIT %s"
+        )
+        params = [fts5_query(query)] + params
+    else:
+        # No full-text index, unranked substring match, newest first
+        sql = (
+            "SELECT id, rank FROM ("
+            "SELECT m.id, 0.0 AS rank FROM chat_message m "
+            f"WHERE m.content LIKE %s ESCAPE '\\' AND m.connection_id IN ({USER_CONNECTIONS})"
+            f") matches {after} ORDER BY rank DESC, id DESC LIMIT %s"
+        )
+        escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params = [f'%{escaped}%'] + params
+
+    if cursor is not None:
+        params += [rank, rank, message_id]
+    params.append(limit)
+
+    with db_connection.cursor() as db_cursor:
+        db_cursor.execute(sql, params)
+        return db_cursor.fetchall()
+
+
+def search_messages(user, query, cursor=None, limit=MESSAGE_SEARCH_PAGE_SIZE):
+    """
+    This function returns a page of the user's messages matching the query, best match first,
+    and the cursor of the next page or None.
+    """
+    query = (query or '').strip()
+    if not query:
+        return [], None
+
+    if cursor is not None:
+        cursor = decode_search_cursor(cursor)
+        if cursor is None:
+            return [], None
+
+    # One extra row tells whether another page follows
+    matches = find_messages(user, query, cursor, limit + 1)
+    has_more = len(matches) > limit
+    matches = matches[:limit]
+
+    messages = Message.objects.in_bulk([message_id for message_id, _ in matches])
+    page = [messages[message_id] for message_id, _ in matches if message_id in messages]
+
+    next_cursor = None
+    if has_more and matches:
+        message_id, rank = matches[-1]
+        next_cursor = encode_search_cursor(rank, message_id)
+
+    return page, next_cursor
+
+
+def restore_message_search(sender, using='default', **kwargs):
+    """
+    post_migrate receiver, puts back FTS5 triggers a table rebuild dropped and reindexes
+    chat_message, since writes made without them are missing from the index.
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite' or FTS_TABLE not in connection.introspection.table_names():
+        return
+
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'chat_message'")
+        existing = {row[0] for row in cursor.fetchall()}
+        missing = [name for name in FTS_TRIGGERS if name not in existing]
+        if not missing:
+            return
+        for name in missing:
+            cursor.execute(FTS_TRIGGERS[name])
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
@@ -0,0 +1,79 @@
+from django.conf import settings
+import hashlib
+import re
+
+
+CONVERSATION_MAX_OPEN = getattr(settings, 'CONVERSATION_MAX_OPEN', 10)
+
+# Channel layers only accept ASCII alphanumerics, hyphens, underscores and periods
+GROUP_NAME = re.compile(r'^[a-zA-Z\d\-_.]{1,80}$')
+
+
+def user_group(username):
+    """
+    This function returns the group every socket of a user joins.
+    Usernames may hold '@' or '+', those are hashed into a valid group name.
+    """
+    if GROUP_NAME.match(username):
+        return f'user.{username}'
+    return 'user-hash.' + hashlib.sha1(username.encode()).hexdigest()
+
+
+def conversation_group(connection_id):
+    """
+    This function returns the group of the sockets that have a conversation open.
+    """
+    return f'conversation.{connection_id}'
+
+
+def group_chat_group(group_id):
+    """
+    This function returns the group every socket of every member of a group chat joins.
+    """
+    return f'group.{group_id}'
+
+
+class ConnectionRegistry:
+    """
+    Conversations each socket of this process has open, oldest first.
+    """
+
+    def __init__(self, max_open):
+        self.max_open = max_open
+        # Channel name -> open connection ids
+        self.conversations = {}
+
+    def register(self, channel_name):
+        self.conversations[channel_name] = {}
+
+    def unregister(self, channel_name):
+        """
+        Forget the socket, returns the connection ids it still had open.
+        """
+        return list(self.conversations.pop(channel_name, {}))
+
+    def open(self, channel_name, connection_id):
+        """
+        Open a conversation on the socket, returns the connection id it had to close or None.
+        """
+        open_ids = self.conversations[channel_name]
+        if connection_id in open_ids:
+            # Most recently opened goes last
+            open_ids[connection_id] = open_ids.pop(connection_id)
+            return None
+
+        open_ids[connection_id] = True
+        if len(open_ids) <= self.max_open:
+            return None
+        oldest = next(iter(open_ids))
+        self.close(channel_name, oldest)
+        return oldest
+
+    def close(self, channel_name, connection_id):
+        return self.conversations.get(channel_name, {}).pop(connection_id, None) is not None
+
+    def is_open(self, channel_name, connection_id):
+        return connection_id in self.conversations.get(channel_name, {})
+
+
+registry = ConnectionRegistry(max_open=CONVERSATION_MAX_OPEN)
@@ -0,0 +1,70 @@
+from datetime import datetime
+from django.conf import settings
+from django.utils import timezone
+from .lru import LRUCache
+from .models import Message, ArchivedMessage
+
+
+RECENT_MESSAGE_IDS_SIZE = getattr(settings, 'RECENT_MESSAGE_IDS_SIZE', 10000)
+CLIENT_MSG_ID_MAX_LENGTH = Message._meta.get_field('client_msg_id').max_length
+
+
+# (sender id, client_msg_id) -> the sender's message-send payload, a retried send is answered without the database
+recent_messages = LRUCache(RECENT_MESSAGE_IDS_SIZE)
+
+
+def clean_client_msg_id(client_msg_id):
+    """
+    This function returns the client's message id if it is usable, None otherwise.
+    """
+    if isinstance(client_msg_id, str) and 0 < len(client_msg_id) <= CLIENT_MSG_ID_MAX_LENGTH:
+        return client_msg_id
+    return None
+
+
+def import_messages(rows, batch_size=5000):
+    """
+    This function inserts messages from dicts with connection_id, sender_id, content, created_at
+    and client_msg_id, batch_size rows per INSERT. Rows whose (sender, client_msg_id) already
+    exists are skipped, so an interrupted import can simply be run again.
+
+    Rows already moved to the archive are skipped as well.
+    Conversation summaries and unread counters are left alone, rebuild_summaries refreshes them.
+    Returns the number of rows processed.
+    """
+    total = 0
+    batch = []
+    for row in rows:
+        created_at = row.get('created_at') or timezone.now()
+        if isinstance(created_at, str):
+            created_at = datetime.fromisoformat(created_at)
+        if timezone.is_naive(created_at):
+            created_at = timezone.make_aware(created_at)
+
+        batch.append(Message(
+            connection_id=row['connection_id'],
+            sender_id=row['sender_id'],
+            content=row.get('content') or '',
+            created_at=created_at,
+            client_msg_id=row['client_msg_id']
+        ))
+        if len(batch) >= batch_size:
+            total += insert_batch(batch)
+            batch = []
+
+    if batch:
+        total += insert_batch(batch)
+
+    return total
+
+
+def insert_batch(batch):
+    archived = set(ArchivedMessage.objects.filter(
+        client_msg_id__in={message.client_msg_id for message in batch}
+    ).values_list('sender_id', 'client_msg_id'))
+
+    Message.objects.bulk_create([
+        message for message in batch
+        if (message.sender_id, message.client_msg_id) not in archived
+    ], ignore_conflicts=True)
+    return len(batch)
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from threading import RLock
+import time
+
+
+class LRUCache:
+    """
+    Thread safe LRU holding at most max_size entries, optionally expiring them after ttl seconds.
+
+    on_discard(key, value) is called, under the lock, for every entry that leaves the cache:
+    evicted, expired, replaced or popped.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=time.monotonic, on_discard=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.on_discard = on_discard
+        # Reentrant, so owners can hold it around several calls and from on_discard
+        self.lock = RLock()
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= self.clock():
+                self.pop(key)
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at=None):
+        """
+        Store value under key, until expires_at on the cache's clock or for ttl when not given.
+        """
+        if expires_at is None and self.ttl is not None:
+            expires_at = self.clock() + self.ttl
+        with self.lock:
+            self.pop(key)
+            self.entries[key] = (expires_at, value)
+            while len(self.entries) > self.max_size:
+                self.pop(next(iter(self.entries)))
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+            if self.on_discard is not None:
+                self.on_discard(key, entry[1])
+            return entry[1]
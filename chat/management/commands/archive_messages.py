@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from chat.archive import archive_batch, hot_cutoff, MESSAGE_ARCHIVE_BATCH_SIZE, MESSAGE_HOT_DAYS
+import time
+
+
+class Command(BaseCommand):
+    help = f'Move messages older than MESSAGE_HOT_DAYS ({MESSAGE_HOT_DAYS}) to the archive table, one batch per transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=MESSAGE_ARCHIVE_BATCH_SIZE)
+        parser.add_argument('--max-batches', type=int, default=0,
+                            help='Stop after this many batches, 0 runs until nothing is left')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        # One cutoff for the whole run, messages ageing meanwhile wait for the next run
+        cutoff = hot_cutoff()
+        max_batches = options['max_batches']
+
+        total = 0
+        batches = 0
+        while not max_batches or batches < max_batches:
+            moved = archive_batch(cutoff, options['batch_size'])
+            if not moved:
+                break
+            total += moved
+            batches += 1
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {total} messages created before {cutoff.isoformat()}'))
@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand
+from django.db.backends.signals import connection_created
+from rest_framework_simplejwt.tokens import AccessToken
+from chat.auth import JWTAuthMiddleware, auth_stats
+from chat.models import User
+import asyncio
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = 'Replay reconnect storms through the socket auth middleware, reports connects/sec and queries per connect'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--devices', type=int, default=3,
+                            help="Sockets per user, each reconnecting with the user's token")
+        parser.add_argument('--invalid', type=float, default=0.05,
+                            help="Fraction of connects with a bad token")
+        parser.add_argument('--storms', type=int, default=3,
+                            help="The first storm finds the cache cold, the others warm")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true',
+                            help="Leave the synthetic users in place for the next run")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        users = self.create_users(options['users'])
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+
+        # Every user's devices plus a few bad tokens, all at once like after a deploy
+        connects = [token for token in tokens for _ in range(options['devices'])]
+        connects += [f'bad.{i}' for i in range(int(len(connects) * options['invalid']))]
+
+        for storm in range(options['storms']):
+            rng.shuffle(connects)
+            stats = auth_stats.copy()
+            elapsed, queries, authenticated = asyncio.run(self.storm(connects))
+            stats = auth_stats - stats
+            self.stdout.write(self.style.SUCCESS(
+                f'storm {storm + 1} ({"cold" if storm == 0 else "warm"}): {len(connects)} connects '
+                f'in {elapsed:.2f}s, {len(connects) / elapsed:.0f} connects/sec, '
+                f'{queries} queries ({queries / len(connects):.3f} per connect), '
+                f'{authenticated} authenticated; ' +
+                ', '.join(f'{name} {count}' for name, count in sorted(stats.items()))
+            ))
+
+        if not options['keep']:
+            User.objects.filter(username__startswith='bench.auth.').delete()
+
+    async def storm(self, tokens):
+        authenticated = 0
+
+        async def app(scope, receive, send):
+            nonlocal authenticated
+            authenticated += scope['user'].is_authenticated
+
+        middleware = JWTAuthMiddleware(app)
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        # Each lookup opens its own connection, count the queries of every one
+        def watch(sender, connection, **kwargs):
+            if count not in connection.execute_wrappers:
+                connection.execute_wrappers.append(count)
+
+        connection_created.connect(watch)
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(*[
+                middleware({'type': 'websocket', 'query_string': f'token={token}'.encode()}, None, None)
+                for token in tokens
+            ])
+            elapsed = time.perf_counter() - started
+        finally:
+            connection_created.disconnect(watch)
+
+        return elapsed, len(queries), authenticated
+
+    def create_users(self, count):
+        existing = set(User.objects.filter(
+            username__startswith='bench.auth.').values_list('username', flat=True))
+        User.objects.bulk_create([
+            User(username=f'bench.auth.{i}') for i in range(count)
+            if f'bench.auth.{i}' not in existing
+        ], batch_size=1000)
+        return list(User.objects.filter(
+            username__startswith='bench.auth.').order_by('id')[:count])
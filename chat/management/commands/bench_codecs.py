@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat import codec
+from chat.codec import JSONCodec, MessagePackCodec, orjson
+from chat.models import User, Connection, Message
+from chat.serializers import UserSerializer, MessageSerializer, SyncMessageSerializer
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compare frame size and encode/decode CPU of the wire codecs on typical frames, no database needed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=2000,
+                            help="Encodes and decodes timed per frame and codec")
+
+    def handle(self, *args, **options):
+        alice = User(id=1, username='alice', first_name='Alice', last_name='Liddell')
+        bob = User(id=2, username='bob', first_name='Bob', last_name='Builder')
+        connection = Connection(id=1, sender=alice, receiver=bob, accepted=True)
+        variants = {
+            str(size): {extension: f'https://cdn.example.com/media/images/message/ab/{"f" * 64}_{size}.{extension}'
+                        for extension in ('webp', 'jpg')}
+            for size in (320, 640, 1280)
+        }
+
+        def message(i, image=False):
+            return Message(
+                id=1000 + i, connection=connection, sender=alice if i % 2 else bob,
+                content='' if image else f'message number {i}, see you at the station around six?',
+                image_url=variants['1280']['jpg'] if image else None,
+                image_variants=variants if image else None,
+                client_msg_id=f'3f2b8c1e-{i:04d}-4a9b-9d2e-7c1f0a6b5e4d', created_at=timezone.now()
+            )
+
+        context = {'user': alice}
+        frames = {
+            'message-send': {'source': 'message-send', 'data': {
+                'messages': MessageSerializer(message(1), context=context).data,
+                'user': UserSerializer(bob).data
+            }},
+            'image message': {'source': 'message-send', 'data': {
+                'messages': MessageSerializer(message(2, image=True), context=context).data,
+                'user': UserSerializer(bob).data
+            }},
+            'message-list page': {'source': 'message-list', 'data': {
+                'messages': MessageSerializer([message(i, i % 5 == 0) for i in range(11)],
+                                              context=context, many=True).data,
+                'before': '2026-01-01T00:00:00+00:00_1000',
+                'user': UserSerializer(bob).data
+            }},
+            'sync chunk': {'source': 'sync', 'data': {
+                'messages': SyncMessageSerializer([message(i, i % 5 == 0) for i in range(200)],
+                                                  context=context, many=True).data,
+                'last': 1199,
+                'done': True
+            }},
+            'presence': {'source': 'presence', 'data': {'bob': 'online', 'carol': 'offline'}},
+            'typing': {'source': 'message-typing', 'data': {'username': 'bob', 'typing': True}},
+        }
+
+        codecs = [('json', JSONCodec(), False)]
+        if orjson is not None:
+            codecs.append(('json (orjson)', JSONCodec(), True))
+        codecs.append(('msgpack', MessagePackCodec(), False))
+
+        repeat = options['repeat']
+        for name, frame in frames.items():
+            sizes = []
+            for codec_name, wire, use_orjson in codecs:
+                # JSONCodec reads the module setting on every encode
+                configured, codec.USE_ORJSON = codec.USE_ORJSON, use_orjson
+                try:
+                    encoded = wire.encode(frame)
+                    started = time.process_time()
+                    for _ in range(repeat):
+                        wire.encode(frame)
+                    encode_us = (time.process_time() - started) / repeat * 1e6
+                finally:
+                    codec.USE_ORJSON = configured
+                started = time.process_time()
+                for _ in range(repeat):
+                    wire.decode(encoded)
+                decode_us = (time.process_time() - started) / repeat * 1e6
+
+                size = len(encoded.encode() if isinstance(encoded, str) else encoded)
+                sizes.append(size)
+                self.stdout.write(
+                    f'{name:18} {codec_name:14} {size:8} bytes ({size / sizes[0]:4.0%}), '
+                    f'encode {encode_us:8.1f}us, decode {decode_us:8.1f}us'
+                )
+        self.stdout.write(self.style.SUCCESS(
+            'Sizes are relative to stdlib json, decode is the same code for both JSON encoders'))
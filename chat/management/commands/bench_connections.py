@@ -0,0 +1,124 @@
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from chat.consumers import ChatConsumer
+from chat.models import User
+from contextlib import redirect_stdout
+import asyncio
+import io
+import json
+import random
+import resource
+import time
+
+
+def percentile(samples, fraction):
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Hold many sockets on one worker and measure connect and round trip latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=5000)
+        parser.add_argument('--devices', type=int, default=2,
+                            help="Sockets per user")
+        parser.add_argument('--concurrency', type=int, default=200,
+                            help="Sockets connecting, or requests in flight, at once")
+        parser.add_argument('--requests', type=int, default=5000)
+        parser.add_argument('--worker-memory-mb', type=int, default=1024,
+                            help="Memory budget used to estimate sockets per worker")
+        parser.add_argument('--in-memory', action='store_true',
+                            help="Use the in-memory channel layer and presence instead of Redis")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true',
+                            help="Leave the synthetic users in place for the next run")
+
+    def handle(self, *args, **options):
+        users = self.create_users(-(-options['sockets'] // options['devices']))
+
+        overrides = {}
+        if options['in_memory']:
+            overrides = {
+                'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                'PRESENCE_BACKEND': 'memory'
+            }
+
+        # The consumers print every frame, keep that out of the report
+        with override_settings(**overrides), redirect_stdout(io.StringIO()):
+            report = asyncio.run(self.run(users, options))
+
+        connects, requests, rss_kb = report
+        per_socket_kb = rss_kb / len(connects)
+        sockets_per_worker = int(options['worker_memory_mb'] * 1024 / per_socket_kb) if per_socket_kb else 0
+        self.stdout.write(
+            f'{len(connects)} sockets: connect p50 {percentile(connects, 0.5) * 1000:.2f}ms, '
+            f'p99 {percentile(connects, 0.99) * 1000:.2f}ms, '
+            f'{per_socket_kb:.1f} KB each'
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(requests)} round trips with every socket open: '
+            f'p50 {percentile(requests, 0.5) * 1000:.2f}ms, '
+            f'p99 {percentile(requests, 0.99) * 1000:.2f}ms, '
+            f'max {requests[-1] * 1000:.2f}ms; '
+            f'~{sockets_per_worker} sockets per worker in {options["worker_memory_mb"]} MB'
+        ))
+
+        if not options['keep']:
+            User.objects.filter(username__startswith='bench.conn.').delete()
+
+    async def run(self, users, options):
+        rng = random.Random(options['seed'])
+        communicators = []
+        connects = []
+
+        async def connect(user):
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/chat/')
+            communicator.scope['user'] = user
+            started = time.perf_counter()
+            connected, _ = await communicator.connect(timeout=30)
+            connects.append(time.perf_counter() - started)
+            if connected:
+                communicators.append(communicator)
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        sockets = [users[i % len(users)] for i in range(options['sockets'])]
+        for start in range(0, len(sockets), options['concurrency']):
+            await asyncio.gather(*[
+                connect(user) for user in sockets[start:start + options['concurrency']]
+            ])
+        rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+        # presence-list reads the database and answers the socket, like most requests
+        frame = json.dumps({'source': 'presence-list'})
+        requests = []
+
+        async def request(communicator):
+            started = time.perf_counter()
+            await communicator.send_to(text_data=frame)
+            while json.loads(await communicator.receive_from(timeout=30))['source'] != 'presence-list':
+                pass
+            requests.append(time.perf_counter() - started)
+
+        # Round trips from random sockets, concurrency at a time
+        for start in range(0, options['requests'], options['concurrency']):
+            batch = rng.sample(communicators, min(options['concurrency'], len(communicators),
+                                                  options['requests'] - start))
+            await asyncio.gather(*[request(communicator) for communicator in batch])
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        connects.sort()
+        requests.sort()
+        return connects, requests, rss_kb
+
+    def create_users(self, count):
+        existing = set(User.objects.filter(
+            username__startswith='bench.conn.').values_list('username', flat=True))
+        User.objects.bulk_create([
+            User(username=f'bench.conn.{i}') for i in range(count)
+            if f'bench.conn.{i}' not in existing
+        ], batch_size=1000)
+        return list(User.objects.filter(
+            username__startswith='bench.conn.').order_by('id')[:count])
@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat import codec
+from chat.codec import CODECS, broadcast_frame, encode_broadcast
+from chat.consumers import ChatConsumer
+from chat.models import User, Connection, Message
+from chat.serializers import UserSerializer
+import msgpack
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = 'Measure message-send serialization and fan-out encoding in messages/sec per core, no database needed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=20000)
+        parser.add_argument('--devices', type=int, default=5,
+                            help="Sockets per user in the multi-device run")
+        parser.add_argument('--msgpack-share', type=float, default=0.5,
+                            help="Fraction of sockets speaking MessagePack")
+        parser.add_argument('--length', type=int, default=120,
+                            help="Characters per message")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        alice = User(id=1, username='alice', first_name='Alice', last_name='Liddell')
+        bob = User(id=2, username='bob', first_name='Bob', last_name='Builder')
+        connection = Connection(id=1, sender=alice, receiver=bob, accepted=True)
+        profiles = UserSerializer(alice).data, UserSerializer(bob).data
+        words = ['hello', 'are', 'you', 'there', 'see', 'you', 'soon', 'ok', 'thanks', 'great']
+
+        messages = []
+        for i in range(options['messages']):
+            content = ''
+            while len(content) < options['length']:
+                content += rng.choice(words) + ' '
+            messages.append(Message(
+                id=i + 1, connection=connection, sender=alice,
+                content=content.strip(), client_msg_id=f'client-{i}', created_at=timezone.now()
+            ))
+
+        self.stdout.write(f'JSON encoder: {"orjson" if codec.USE_ORJSON else "json"}, '
+                          f'codecs enabled: {", ".join(CODECS)}')
+
+        # Both sides of every message are serialized once, whatever the fan-out does after
+        consumer = ChatConsumer()
+        started = time.process_time()
+        payloads = [consumer.message_payloads(message, *profiles) for message in messages]
+        self.stdout.write(f'serialization: {len(messages) / (time.process_time() - started):,.0f} '
+                          f'messages/sec per core')
+
+        for name, devices in (('1-to-1', 1), ('multi-device', options['devices'])):
+            # Both users' sockets, each with its own codec
+            sockets = [
+                CODECS['msgpack'] if 'msgpack' in CODECS and rng.random() < options['msgpack_share']
+                else CODECS['json']
+                for _ in range(devices * 2)
+            ]
+            for strategy in ('every codec at send', 'per codec in use'):
+                rate, layer_bytes = self.fan_out(payloads, sockets, strategy == 'per codec in use')
+                self.stdout.write(self.style.SUCCESS(
+                    f'{name}, {len(sockets)} sockets, {strategy}: fan-out {rate:,.0f} messages/sec '
+                    f'per core, {layer_bytes / len(payloads):.0f} bytes per message through the layer'))
+
+    def fan_out(self, payloads, sockets, lazy):
+        sender_sockets = sockets[:len(sockets) // 2]
+        receiver_sockets = sockets[len(sockets) // 2:]
+        layer_bytes = 0
+
+        started = time.process_time()
+        for data_sender, data_receiver in payloads:
+            for data, receivers in ((data_sender, sender_sockets), (data_receiver, receiver_sockets)):
+                if lazy:
+                    event = {'type': 'broadcast_group', 'frame': broadcast_frame('message-send', data)}
+                    for socket_codec in receivers:
+                        encode_broadcast(event['frame'], socket_codec)
+                else:
+                    # What the sender did before: every enabled codec, used or not
+                    frame = {'source': 'message-send', 'data': data}
+                    event = {'type': 'broadcast_group',
+                             'frames': {name: each.encode(frame) for name, each in CODECS.items()}}
+                    for socket_codec in receivers:
+                        event['frames'][socket_codec.name]
+                # channels_redis packs every event with msgpack
+                layer_bytes += len(msgpack.packb(event, use_bin_type=True))
+        return len(payloads) / (time.process_time() - started), layer_bytes
@@ -0,0 +1,105 @@
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from chat.consumers import ChatConsumer
+from chat.models import User, GroupChat, GroupMember
+from contextlib import redirect_stdout
+import asyncio
+import io
+import json
+import time
+
+
+def percentile(samples, fraction):
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Measure group message send latency, to the sender and to the last member, against group size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[2, 10, 50, 100, 500])
+        parser.add_argument('--messages', type=int, default=200,
+                            help="Messages sent to each group, one at a time")
+        parser.add_argument('--in-memory', action='store_true',
+                            help="Use the in-memory channel layer and presence instead of Redis")
+        parser.add_argument('--keep', action='store_true',
+                            help="Leave the synthetic users and groups in place for the next run")
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options['in_memory']:
+            overrides = {
+                'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                'PRESENCE_BACKEND': 'memory'
+            }
+
+        for size in options['sizes']:
+            group, members = self.create_group(size)
+
+            # The consumers print every frame, keep that out of the report
+            with override_settings(**overrides), redirect_stdout(io.StringIO()):
+                sender, everyone = asyncio.run(self.run(group, members, options['messages']))
+
+            self.stdout.write(self.style.SUCCESS(
+                f'{size} members, {len(sender)} sends: '
+                f'sender p50 {percentile(sender, 0.5) * 1000:.2f}ms, '
+                f'p99 {percentile(sender, 0.99) * 1000:.2f}ms; '
+                f'last member p50 {percentile(everyone, 0.5) * 1000:.2f}ms, '
+                f'p99 {percentile(everyone, 0.99) * 1000:.2f}ms'
+            ))
+
+        if not options['keep']:
+            GroupChat.objects.filter(name__startswith='bench.group.').delete()
+            User.objects.filter(username__startswith='bench.group.').delete()
+
+    async def run(self, group, members, messages):
+        communicators = []
+        for user in members:
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/chat/')
+            communicator.scope['user'] = user
+            await communicator.connect(timeout=30)
+            communicators.append(communicator)
+
+        async def delivered(communicator):
+            while json.loads(await communicator.receive_from(timeout=30))['source'] != 'group-message-send':
+                pass
+            return time.perf_counter()
+
+        sender = []
+        everyone = []
+        for i in range(messages):
+            waiting = [asyncio.ensure_future(delivered(communicator)) for communicator in communicators]
+            started = time.perf_counter()
+            await communicators[0].send_to(text_data=json.dumps({
+                'source': 'group-message-send',
+                'groupId': group.id,
+                'message': f'message {i}'
+            }))
+            arrived = await asyncio.gather(*waiting)
+            sender.append(arrived[0] - started)
+            everyone.append(max(arrived) - started)
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        sender.sort()
+        everyone.sort()
+        return sender, everyone
+
+    def create_group(self, size):
+        name = f'bench.group.{size}'
+        group = GroupChat.objects.filter(name=name).first()
+        if group is not None:
+            return group, [member.user for member in group.members.select_related('user').order_by('id')]
+
+        members = User.objects.bulk_create([
+            User(username=f'{name}.{i}') for i in range(size)
+        ])
+        group = GroupChat.objects.create(name=name, created_by=members[0])
+        GroupMember.objects.bulk_create([
+            GroupMember(group=group, user=user,
+                        role=GroupMember.OWNER if i == 0 else GroupMember.MEMBER)
+            for i, user in enumerate(members)
+        ])
+        return group, members
@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand
+from django.db import connection as db_connection
+from chat.models import User
+from chat.search import search_users, prefix_index
+import random
+import time
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'an', 'el', 'jo', 'su', 'ti', 'ne', 'ma', 'ri', 'do', 'va', 'ch', 'be']
+
+
+def percentile(samples, fraction):
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Measure search latency over synthetic users, run it against a scratch database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000)
+        parser.add_argument('--queries', type=int, default=2000)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true',
+                            help="Leave the synthetic users in place for the next run")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        names = self.create_users(rng, options['users'], options['batch_size'])
+        searcher = User.objects.filter(username__startswith='bench.').first()
+
+        if db_connection.vendor != 'postgresql':
+            started = time.perf_counter()
+            prefix_index.build()
+            self.stdout.write(f'prefix index: {len(prefix_index.entries)} tokens '
+                              f'built in {time.perf_counter() - started:.2f}s')
+
+        # Mostly prefixes of real names as typed, some that match nothing
+        queries = []
+        for _ in range(options['queries']):
+            name = rng.choice(names)
+            queries.append(name[:rng.randint(1, 6)] if rng.random() < 0.9 else name[::-1] + 'zq')
+
+        samples = []
+        results = 0
+        for query in queries:
+            started = time.perf_counter()
+            users, _ = search_users(searcher, query)
+            samples.append(time.perf_counter() - started)
+            results += len(users)
+        samples.sort()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{db_connection.vendor}, {User.objects.count()} users, {len(samples)} searches, '
+            f'{results / len(samples):.1f} results each: '
+            f'p50 {percentile(samples, 0.5) * 1000:.2f}ms, '
+            f'p99 {percentile(samples, 0.99) * 1000:.2f}ms, '
+            f'max {samples[-1] * 1000:.2f}ms'
+        ))
+
+        if not options['keep']:
+            # In batches, one DELETE of a million ids overflows SQLite's variable limit
+            user_ids = list(User.objects.filter(
+                username__startswith='bench.').values_list('id', flat=True))
+            for start in range(0, len(user_ids), options['batch_size']):
+                User.objects.filter(id__in=user_ids[start:start + options['batch_size']]).delete()
+
+    def create_users(self, rng, count, batch_size):
+        """
+        Create the missing synthetic users, returns every synthetic first name for the queries.
+        """
+        existing = User.objects.filter(username__startswith='bench.').count()
+
+        def name():
+            return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+        names = []
+        batch = []
+        for i in range(count):
+            first_name, last_name = name(), name()
+            names.append(first_name)
+            if i < existing:
+                continue
+            batch.append(User(username=f'bench.{first_name}{last_name}.{i}',
+                              first_name=first_name.title(), last_name=last_name.title()))
+            if len(batch) >= batch_size:
+                User.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            User.objects.bulk_create(batch)
+        return names
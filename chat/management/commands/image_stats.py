@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from chat.models import StoredImage
+
+
+class Command(BaseCommand):
+    help = 'Report the hit rate and bytes saved by the image dedup store'
+
+    def handle(self, *args, **options):
+        for kind in StoredImage.objects.values_list('kind', flat=True).distinct().order_by('kind'):
+            totals = StoredImage.objects.filter(kind=kind).aggregate(
+                images=Count('id'),
+                stored_bytes=Sum('stored_bytes'),
+                hits=Sum('hits'),
+                bytes_saved=Sum('bytes_saved')
+            )
+            # Every stored image was one miss
+            uploads = totals['images'] + totals['hits']
+            hit_rate = totals['hits'] / uploads if uploads else 0
+            self.stdout.write(
+                f"{kind}: {totals['images']} images, {totals['stored_bytes']} bytes stored, "
+                f"{totals['hits']} hits, hit rate {hit_rate:.1%}, {totals['bytes_saved']} bytes saved"
+            )
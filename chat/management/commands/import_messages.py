@@ -0,0 +1,44 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from chat.ingest import import_messages
+import hashlib
+import json
+import sys
+
+
+class Command(BaseCommand):
+    help = 'Import chat history from JSON lines, safe to run again on the same file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSON lines file, - for stdin')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--skip-summaries', action='store_true',
+                            help="Don't rebuild the conversation summaries afterwards")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        source = sys.stdin if path == '-' else open(path, encoding='utf8')
+        try:
+            total = import_messages(self.rows(source), options['batch_size'])
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+        self.stdout.write(self.style.SUCCESS(f'Imported {total} rows, already stored messages were skipped'))
+
+        if not options['skip_summaries']:
+            call_command('rebuild_summaries', stdout=self.stdout)
+
+    def rows(self, source):
+        """
+        One message per line: connection_id, sender_id, content, created_at and optionally client_msg_id.
+        Lines without an id get one from their content, so a rerun skips them.
+        """
+        for line in source:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            if not row.get('client_msg_id'):
+                row['client_msg_id'] = 'import:' + hashlib.sha1(line.encode()).hexdigest()
+            yield row
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from chat.fulltext import FTS_TABLE, has_fts_table
+
+
+class Command(BaseCommand):
+    help = 'Index the existing messages for message-search, new messages are indexed as they are written'
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'postgresql':
+            self.rebuild_postgresql()
+        elif connection.vendor == 'sqlite':
+            self.rebuild_sqlite()
+        else:
+            raise CommandError(
+                f'No full-text index on {connection.vendor}, message-search falls back to LIKE')
+
+    def rebuild_postgresql(self):
+        # The expression index covers every row once built, this only restores a missing one
+        # without the write lock the migration's CREATE INDEX takes
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_message_content_fts_idx "
+                "ON chat_message USING gin (to_tsvector('simple', content))"
+            )
+        self.stdout.write(self.style.SUCCESS('chat_message_content_fts_idx is in place'))
+
+    def rebuild_sqlite(self):
+        if not has_fts_table():
+            raise CommandError(f'{FTS_TABLE} does not exist, run migrate first')
+
+        # FTS5 reindexes its external content in one statement. Inside one transaction searches
+        # never see a half built index, and no trigger touches rows that aren't indexed yet
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+            cursor.execute('SELECT COUNT(*) FROM chat_message')
+            total = cursor.fetchone()[0]
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {total} messages into {FTS_TABLE}'))
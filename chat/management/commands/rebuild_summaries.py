@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+from chat.models import Connection, Message, ConversationSummary
+
+
+def rebuild_summaries(connection_model, message_model, summary_model, batch_size=1000):
+    """
+    This function rebuilds the conversation summaries from the message history and returns how many
+    it wrote. The models are passed in, so migration 0003 can backfill with its historical models.
+    """
+    last_message = message_model.objects.filter(
+        connection=OuterRef('id')
+    ).order_by('-created_at', '-id')
+
+    connections = connection_model.objects.filter(
+        accepted=True
+    ).annotate(
+        last_message_id=Subquery(last_message.values('id')[:1]),
+        last_message_content=Subquery(last_message.values('content')[:1]),
+        last_message_created_at=Subquery(
+            last_message.values('created_at')[:1])
+    ).order_by('id')
+
+    batch = []
+    total = 0
+    for connection in connections.iterator(chunk_size=batch_size):
+        batch.append(summary_model(
+            connection_id=connection.id,
+            sender_id=connection.sender_id,
+            receiver_id=connection.receiver_id,
+            last_message_id=connection.last_message_id,
+            preview=connection.last_message_content,
+            last_activity_at=connection.last_message_created_at or connection.updated_at
+        ))
+        if len(batch) >= batch_size:
+            total += save_summaries(summary_model, batch)
+            batch = []
+    if batch:
+        total += save_summaries(summary_model, batch)
+    return total
+
+
+def save_summaries(summary_model, batch):
+    # Unread counters are live state, only the history derived fields are rebuilt
+    summary_model.objects.bulk_create(
+        batch,
+        update_conflicts=True,
+        unique_fields=['connection'],
+        update_fields=['sender', 'receiver', 'last_message',
+                       'preview', 'last_activity_at']
+    )
+    return len(batch)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the conversation summaries from the existing message history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = rebuild_summaries(
+            Connection, Message, ConversationSummary, options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {total} summaries'))
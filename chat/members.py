@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .lru import LRUCache
+from .models import GroupMember
+
+
+GROUP_MEMBERSHIP_CACHE_SIZE = getattr(settings, 'GROUP_MEMBERSHIP_CACHE_SIZE', 1024)
+GROUP_MEMBERSHIP_TTL_SECONDS = getattr(settings, 'GROUP_MEMBERSHIP_TTL_SECONDS', 30)
+
+
+class MembershipCache:
+    """
+    LRU of group id -> {user id: role}, so sending to a group checks
+    membership without loading its members. Entries expire after ttl so changes
+    made by other processes show up, changes made here invalidate right away.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.entries = LRUCache(max_size, ttl)
+
+    def get(self, group_id):
+        roles = self.entries.get(group_id)
+        if roles is not None:
+            return roles
+
+        # Only ids and roles, a large group never builds User objects here
+        roles = dict(GroupMember.objects.filter(
+            group_id=group_id).values_list('user_id', 'role'))
+        self.entries.set(group_id, roles)
+        return roles
+
+    def invalidate(self, group_id):
+        self.entries.pop(group_id)
+
+
+memberships = MembershipCache(
+    max_size=GROUP_MEMBERSHIP_CACHE_SIZE,
+    ttl=GROUP_MEMBERSHIP_TTL_SECONDS
+)
+
+
+def get_role(group_id, user_id):
+    """
+    This function returns the user's role in the group, None if they aren't a member.
+    """
+    return memberships.get(group_id).get(user_id)
+
+
+@receiver(post_save, sender=GroupMember)
+@receiver(post_delete, sender=GroupMember)
+def invalidate_membership(sender, instance, **kwargs):
+    memberships.invalidate(instance.group_id)
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.4 on 2026-10-18 08:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='image_url',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='thumbnail',
+            field=models.TextField(default='staticfiles/thumbnails/default.png'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['connection', 'created_at', 'id'], name='chat_msg_conn_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.4 on 2026-10-18 08:23
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_summaries(apps, schema_editor):
+    # The friend list only reads summaries, existing friendships need theirs before it does
+    from chat.management.commands.rebuild_summaries import rebuild_summaries
+    rebuild_summaries(
+        apps.get_model('chat', 'Connection'),
+        apps.get_model('chat', 'Message'),
+        apps.get_model('chat', 'ConversationSummary')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_image_url_alter_user_thumbnail_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('preview', models.TextField(blank=True, null=True)),
+                ('last_activity_at', models.DateTimeField()),
+                ('sender_unread', models.PositiveIntegerField(default=0)),
+                ('receiver_unread', models.PositiveIntegerField(default=0)),
+                ('connection', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='chat.connection')),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('receiver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sender', '-last_activity_at'], name='chat_summary_sender_idx'), models.Index(fields=['receiver', '-last_activity_at'], name='chat_summary_receiver_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
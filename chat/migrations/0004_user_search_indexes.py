@@ -0,0 +1,35 @@
+from django.db import migrations
+
+
+SEARCH_COLUMNS = ['username', 'first_name', 'last_name']
+
+
+def create_search_indexes(apps, schema_editor):
+    # Trigram indexes are PostgreSQL only, other databases use the in-process prefix index
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in SEARCH_COLUMNS:
+        # Matches the UPPER(column::text) LIKE UPPER(...) that icontains generates
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS chat_user_{column}_trgm_idx '
+            f'ON chat_user USING gin ((UPPER({column}::text)) gin_trgm_ops)'
+        )
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for column in SEARCH_COLUMNS:
+        schema_editor.execute(f'DROP INDEX IF EXISTS chat_user_{column}_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
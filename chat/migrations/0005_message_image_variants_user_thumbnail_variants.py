@@ -0,0 +1,23 @@
+# Generated by Django 4.2.4 on 2026-10-18 08:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_user_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='image_variants',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='thumbnail_variants',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
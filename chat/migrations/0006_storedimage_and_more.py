@@ -0,0 +1,31 @@
+# Generated by Django 4.2.4 on 2026-10-18 08:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_image_variants_user_thumbnail_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('kind', models.CharField(max_length=20)),
+                ('image_url', models.TextField()),
+                ('variants', models.JSONField()),
+                ('stored_bytes', models.PositiveBigIntegerField(default=0)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('bytes_saved', models.PositiveBigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='storedimage',
+            constraint=models.UniqueConstraint(fields=('content_hash', 'kind'), name='chat_storedimage_hash_kind_uniq'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.4 on 2026-10-18 08:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_groupchat_groupmember_groupmessage_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='receiver_last_read_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='sender_last_read_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='groupmember',
+            name='last_read_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'id'], name='chat_groupmsg_group_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['connection', 'id'], name='chat_msg_conn_id_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+from django.db import migrations
+
+
+def create_message_search(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        # An expression index, PostgreSQL keeps it current on every insert and update
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS chat_message_content_fts_idx "
+            "ON chat_message USING gin (to_tsvector('simple', content))"
+        )
+    elif connection.vendor == 'sqlite':
+        # External content FTS5 table over chat_message, triggers keep it in step.
+        # Rows that already exist are indexed by the rebuild_message_search command
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts "
+            "USING fts5(content, content='chat_message', content_rowid='id')"
+        )
+        schema_editor.execute(
+            "CREATE TRIGGER IF NOT EXISTS chat_message_fts_insert AFTER INSERT ON chat_message BEGIN "
+            "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END"
+        )
+        schema_editor.execute(
+            "CREATE TRIGGER IF NOT EXISTS chat_message_fts_delete AFTER DELETE ON chat_message BEGIN "
+            "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END"
+        )
+        schema_editor.execute(
+            "CREATE TRIGGER IF NOT EXISTS chat_message_fts_update AFTER UPDATE OF content ON chat_message BEGIN "
+            "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+            "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END"
+        )
+
+
+def drop_message_search(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS chat_message_content_fts_idx')
+    elif connection.vendor == 'sqlite':
+        for trigger in ('insert', 'delete', 'update'):
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS chat_message_fts_{trigger}')
+        schema_editor.execute('DROP TABLE IF EXISTS chat_message_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_conversationsummary_receiver_last_read_id_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_message_search, drop_message_search),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.4 on 2026-10-18 08:55
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='client_msg_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('sender', 'client_msg_id'), name='chat_msg_sender_client_id_uniq'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.4 on 2026-10-18 08:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_message_client_msg_id_alter_message_created_at_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('content', models.TextField()),
+                ('image_url', models.TextField(blank=True, null=True)),
+                ('image_variants', models.JSONField(blank=True, null=True)),
+                ('client_msg_id', models.CharField(blank=True, max_length=64, null=True)),
+                ('created_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='chat.connection')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['connection', 'created_at', 'id'], name='chat_archmsg_conn_created_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='archivedmessage',
+            constraint=models.UniqueConstraint(fields=('sender', 'client_msg_id'), name='chat_archmsg_sender_client_uniq'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations
+from importlib import import_module
+
+# SQLite rebuilds chat_message for 0010's AlterField and AddConstraint, which drops its triggers.
+# Later rebuilds are repaired by chat.fulltext.restore_message_search after every migrate
+message_search = import_module('chat.migrations.0009_message_search_index')
+
+
+def restore_message_search(apps, schema_editor):
+    message_search.create_message_search(apps, schema_editor)
+    if schema_editor.connection.vendor == 'sqlite':
+        # Messages written while the triggers were missing aren't indexed, reindex from chat_message
+        schema_editor.execute(
+            "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_archivedmessage_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(restore_message_search, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,8 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q, Case, When, Value
+from django.utils import timezone
+from collections import Counter
 
 
 def upload_thumbnail(instance, filename):
@@ -12,6 +15,8 @@ def upload_thumbnail(instance, filename):
 
 class User(AbstractUser):
     thumbnail = models.TextField(default='staticfiles/thumbnails/default.png')
+    # {size: {format: url}} made by save_image
+    thumbnail_variants = models.JSONField(blank=True, null=True)
 
 
 class Connection(models.Model):
@@ -34,7 +39,294 @@ class Message(models.Model):
         User, related_name='my_messages', on_delete=models.CASCADE)
     content = models.TextField()
     image_url = models.TextField(blank=True, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    image_variants = models.JSONField(blank=True, null=True)
+    # Set by the client, a retried send with the same id returns the stored message
+    client_msg_id = models.CharField(max_length=64, blank=True, null=True)
+    # Not auto_now_add, imported history keeps its own timestamps
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            # NULLs never conflict, messages without an id are unaffected
+            models.UniqueConstraint(fields=['sender', 'client_msg_id'],
+                                    name='chat_msg_sender_client_id_uniq'),
+        ]
+        indexes = [
+            # Keyset pagination of a conversation walks this index
+            models.Index(fields=['connection', 'created_at', 'id'],
+                         name='chat_msg_conn_created_id_idx'),
+            # Unread counts are the messages past a read mark
+            models.Index(fields=['connection', 'id'],
+                         name='chat_msg_conn_id_idx'),
+        ]
 
     def __str__(self):
         return f'{self.sender} -> ({self.connection.sender} & {self.connection.receiver}): {self.content}'
+
+
+class ArchivedMessage(models.Model):
+    """
+    Messages older than the hot window, moved out of Message by archive_messages.
+    Ids are kept so pagination cursors and read marks stay valid.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    connection = models.ForeignKey(
+        Connection, related_name='archived_messages', on_delete=models.CASCADE)
+    sender = models.ForeignKey(
+        User, related_name='+', on_delete=models.CASCADE)
+    content = models.TextField()
+    image_url = models.TextField(blank=True, null=True)
+    image_variants = models.JSONField(blank=True, null=True)
+    client_msg_id = models.CharField(max_length=64, blank=True, null=True)
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['sender', 'client_msg_id'],
+                                    name='chat_archmsg_sender_client_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['connection', 'created_at', 'id'],
+                         name='chat_archmsg_conn_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.sender} (archived): {self.content}'
+
+
+class ConversationSummary(models.Model):
+    """
+    Denormalized last message and unread counts of a connection, kept up to date on message write.
+    """
+    connection = models.OneToOneField(
+        Connection, related_name='summary', on_delete=models.CASCADE)
+    # Copied from the connection so the friend list can range scan by user
+    sender = models.ForeignKey(
+        User, related_name='+', on_delete=models.CASCADE)
+    receiver = models.ForeignKey(
+        User, related_name='+', on_delete=models.CASCADE)
+    last_message = models.ForeignKey(
+        Message, related_name='+', on_delete=models.SET_NULL, blank=True, null=True)
+    preview = models.TextField(blank=True, null=True)
+    last_activity_at = models.DateTimeField()
+    sender_unread = models.PositiveIntegerField(default=0)
+    receiver_unread = models.PositiveIntegerField(default=0)
+    # Read receipts: the id of the newest message each side has read
+    sender_last_read_id = models.PositiveBigIntegerField(default=0)
+    receiver_last_read_id = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender', '-last_activity_at'],
+                         name='chat_summary_sender_idx'),
+            models.Index(fields=['receiver', '-last_activity_at'],
+                         name='chat_summary_receiver_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.connection}: {self.preview}'
+
+    @classmethod
+    def ensure(cls, connection):
+        summary, _ = cls.objects.get_or_create(connection=connection, defaults={
+            'sender_id': connection.sender_id,
+            'receiver_id': connection.receiver_id,
+            'last_activity_at': connection.updated_at
+        })
+        return summary
+
+    @classmethod
+    def record_message(cls, message):
+        """
+        Point the summary at a new message, call it in the same transaction that created the message.
+        """
+        cls.record_messages([message])
+
+    @classmethod
+    def record_messages(cls, messages):
+        """
+        Same as record_message for many messages, one update per connection.
+
+        The unread counts always grow, but the last message only moves forward. A send
+        committing after a newer one leaves the summary pointing at the newer message.
+        """
+        latest = {}
+        unread = Counter()
+        for message in messages:
+            connection = message.connection
+            if message.sender_id == connection.sender_id:
+                unread[(connection.id, 'receiver_unread')] += 1
+            else:
+                unread[(connection.id, 'sender_unread')] += 1
+            if connection.id not in latest or latest[connection.id].id < message.id:
+                latest[connection.id] = message
+
+        for connection_id, message in latest.items():
+            newer = Q(last_message_id__lt=message.id) | Q(last_message__isnull=True)
+            fields = {
+                field: Case(When(newer, then=Value(value)), default=F(field),
+                            output_field=cls._meta.get_field(field))
+                for field, value in (
+                    ('last_message_id', message.id),
+                    ('preview', message.content),
+                    ('last_activity_at', message.created_at)
+                )
+            }
+            for unread_field in ('sender_unread', 'receiver_unread'):
+                count = unread[(connection_id, unread_field)]
+                if count:
+                    fields[unread_field] = F(unread_field) + count
+
+            if not cls.objects.filter(connection_id=connection_id).update(**fields):
+                cls.ensure(message.connection)
+                cls.objects.filter(connection_id=connection_id).update(**fields)
+
+    @classmethod
+    def mark_read(cls, connection, user, message_id=None):
+        """
+        Move the user's read mark up to message_id, or to the last message when it is None.
+        The mark never moves back. Returns (read mark, unread count), None if it didn't move.
+        """
+        side = 'sender' if user.id == connection.sender_id else 'receiver'
+        last_read_field = f'{side}_last_read_id'
+        unread_field = f'{side}_unread'
+
+        with transaction.atomic():
+            # Locked so a message recorded meanwhile can't be lost from the count
+            summary = cls.objects.select_for_update().filter(
+                connection=connection).first()
+            if summary is None or summary.last_message_id is None:
+                return None
+
+            last_read = summary.last_message_id
+            if message_id is not None:
+                last_read = min(message_id, last_read)
+            if last_read <= getattr(summary, last_read_field):
+                return None
+
+            unread = 0
+            if last_read < summary.last_message_id:
+                unread = Message.objects.filter(
+                    connection=connection, id__gt=last_read
+                ).exclude(sender=user).count()
+
+            cls.objects.filter(id=summary.id).update(**{
+                last_read_field: last_read,
+                unread_field: unread
+            })
+
+        return last_read, unread
+
+
+class GroupChat(models.Model):
+    """
+    A conversation between any number of users, who is in it and with which role lives in GroupMember.
+    """
+    name = models.CharField(max_length=100)
+    created_by = models.ForeignKey(
+        User, related_name='+', on_delete=models.SET_NULL, blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+class GroupMember(models.Model):
+    OWNER = 'owner'
+    ADMIN = 'admin'
+    MEMBER = 'member'
+    ROLES = [
+        (OWNER, 'Owner'),
+        (ADMIN, 'Admin'),
+        (MEMBER, 'Member'),
+    ]
+    # Roles that can add members
+    MANAGERS = (OWNER, ADMIN)
+
+    group = models.ForeignKey(
+        GroupChat, related_name='members', on_delete=models.CASCADE)
+    user = models.ForeignKey(
+        User, related_name='group_memberships', on_delete=models.CASCADE)
+    role = models.CharField(max_length=10, choices=ROLES, default=MEMBER)
+    joined_at = models.DateTimeField(auto_now_add=True)
+    # Id of the newest group message this member has read, unread counts are derived from it
+    last_read_id = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['group', 'user'],
+                                    name='chat_groupmember_group_user_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user} in {self.group} ({self.role})'
+
+    @classmethod
+    def mark_read(cls, group_id, user, message_id):
+        """
+        Move the member's read mark up to message_id, never back.
+        Returns (read mark, unread count), None if it didn't move.
+        """
+        last_read = GroupMessage.objects.filter(
+            group_id=group_id, id__lte=message_id
+        ).order_by('-id').values_list('id', flat=True).first()
+        if last_read is None:
+            return None
+
+        if not cls.objects.filter(
+            group_id=group_id, user=user, last_read_id__lt=last_read
+        ).update(last_read_id=last_read):
+            return None
+
+        unread = GroupMessage.objects.filter(
+            group_id=group_id, id__gt=last_read
+        ).exclude(sender=user).count()
+
+        return last_read, unread
+
+
+class GroupMessage(models.Model):
+    group = models.ForeignKey(
+        GroupChat, related_name='messages', on_delete=models.CASCADE)
+    sender = models.ForeignKey(
+        User, related_name='my_group_messages', on_delete=models.CASCADE)
+    content = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Same keyset pagination as Message
+            models.Index(fields=['group', 'created_at', 'id'],
+                         name='chat_groupmsg_created_idx'),
+            models.Index(fields=['group', 'id'],
+                         name='chat_groupmsg_group_id_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.sender} -> {self.group}: {self.content}'
+
+
+class StoredImage(models.Model):
+    """
+    Processed image keyed by the hash of its uploaded bytes, reused instead of encoding and uploading it again.
+    """
+    content_hash = models.CharField(max_length=64)
+    # 'thumbnail' or 'message', they are encoded to different sizes
+    kind = models.CharField(max_length=20)
+    image_url = models.TextField()
+    variants = models.JSONField()
+    stored_bytes = models.PositiveBigIntegerField(default=0)
+    hits = models.PositiveIntegerField(default=0)
+    bytes_saved = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_hash', 'kind'],
+                                    name='chat_storedimage_hash_kind_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.kind} {self.content_hash}'
@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+import asyncio
+
+
+class ImagePipeline:
+    """
+    Bounded worker pool that decodes, re-encodes and uploads images off the consumer's event loop.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='image')
+        self.max_pending = max_pending
+        self.pending = 0
+        self.tasks = set()
+
+    def reserve(self):
+        # Back-pressure: refuse new work instead of queueing without bound
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        return True
+
+    def release(self):
+        self.pending -= 1
+
+    async def run(self, func, *args):
+        """
+        Run func in the pool, the caller must hold a slot from reserve().
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, self.call, func, args)
+        finally:
+            self.release()
+
+    def call(self, func, args):
+        # Same connection hygiene as database_sync_to_async
+        close_old_connections()
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+
+    def spawn(self, coroutine):
+        # Keep a reference so the follow-up outlives the socket that started it
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+
+image_pipeline = ImagePipeline(
+    workers=getattr(settings, 'IMAGE_PIPELINE_WORKERS', 4),
+    max_pending=getattr(settings, 'IMAGE_PIPELINE_MAX_PENDING', 32)
+)
@@ -0,0 +1,296 @@
+from collections import defaultdict
+from threading import Lock
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import Q
+from .codec import broadcast_frame
+from .groups import user_group
+from .models import Connection
+import asyncio
+import time
+
+
+PRESENCE_TTL_SECONDS = getattr(settings, 'PRESENCE_TTL_SECONDS', 75)
+PRESENCE_FANOUT_SECONDS = getattr(settings, 'PRESENCE_FANOUT_SECONDS', 1)
+
+
+class MemoryPresence:
+    """
+    Per-process presence for tests and single process runs, sharded so users don't contend on one lock.
+    """
+
+    def __init__(self, shards=16):
+        self.shards = [({}, Lock()) for _ in range(shards)]
+        self.published = set()
+        self.published_lock = Lock()
+
+    def shard(self, username):
+        return self.shards[hash(username) % len(self.shards)]
+
+    async def connect(self, username, channel_name, expires_at):
+        devices, lock = self.shard(username)
+        with lock:
+            user_devices = devices.setdefault(username, {})
+            came_online = not user_devices
+            user_devices[channel_name] = expires_at
+        return came_online
+
+    async def heartbeat(self, username, channel_name, expires_at):
+        # A socket the sweeper expired is still open, it comes back like a new one
+        return await self.connect(username, channel_name, expires_at)
+
+    async def disconnect(self, username, channel_name):
+        devices, lock = self.shard(username)
+        with lock:
+            user_devices = devices.get(username)
+            if not user_devices or user_devices.pop(channel_name, None) is None:
+                return False
+            if user_devices:
+                return False
+            del devices[username]
+            return True
+
+    async def expire(self, now):
+        gone = []
+        for devices, lock in self.shards:
+            with lock:
+                for username in list(devices):
+                    user_devices = devices[username]
+                    for channel_name, expires_at in list(user_devices.items()):
+                        if expires_at <= now:
+                            del user_devices[channel_name]
+                    if not user_devices:
+                        del devices[username]
+                        gone.append(username)
+        return gone
+
+    async def publish(self, username, online):
+        with self.published_lock:
+            if online == (username in self.published):
+                return False
+            if online:
+                self.published.add(username)
+            else:
+                self.published.discard(username)
+            return True
+
+    async def online(self, usernames, now):
+        online = set()
+        for username in usernames:
+            devices, lock = self.shard(username)
+            with lock:
+                if any(expires_at > now for expires_at in devices.get(username, {}).values()):
+                    online.add(username)
+        return online
+
+
+class RedisPresence:
+    """
+    Presence shared by every worker, kept in the channel layer's Redis.
+
+    presence:user:<username> is a sorted set of that user's sockets scored by expiry,
+    presence:devices holds every socket so any worker can sweep the expired ones.
+    presence:published:<username> exists while friends were last told the user is online.
+    """
+
+    def __init__(self, url, prefix='presence'):
+        import redis.asyncio
+        self.redis = redis.asyncio.from_url(url)
+        self.prefix = prefix
+        self.devices_key = f'{prefix}:devices'
+
+    def user_key(self, username):
+        return f'{self.prefix}:user:{username}'
+
+    def published_key(self, username):
+        return f'{self.prefix}:published:{username}'
+
+    def device(self, username, channel_name):
+        return f'{username}\n{channel_name}'
+
+    async def connect(self, username, channel_name, expires_at):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.user_key(username), {channel_name: expires_at})
+            pipe.zadd(self.devices_key, {
+                      self.device(username, channel_name): expires_at})
+            pipe.zcard(self.user_key(username))
+            results = await pipe.execute()
+        return results[-1] == 1
+
+    async def heartbeat(self, username, channel_name, expires_at):
+        # Refreshes the socket's expiry, or adds it back if the sweeper expired it while it was still open
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.user_key(username), {channel_name: expires_at})
+            pipe.zadd(self.devices_key, {
+                      self.device(username, channel_name): expires_at})
+            pipe.zcard(self.user_key(username))
+            added, _, remaining = await pipe.execute()
+        return added == 1 and remaining == 1
+
+    async def disconnect(self, username, channel_name):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self.user_key(username), channel_name)
+            pipe.zrem(self.devices_key, self.device(username, channel_name))
+            pipe.zcard(self.user_key(username))
+            removed, _, remaining = await pipe.execute()
+        return removed == 1 and remaining == 0
+
+    async def expire(self, now):
+        gone = []
+        expired = await self.redis.zrangebyscore(self.devices_key, 0, now, start=0, num=1000)
+        for device in expired:
+            # ZREM is atomic, only the worker that removes the socket reports it
+            if not await self.redis.zrem(self.devices_key, device):
+                continue
+            username, channel_name = device.decode().split('\n', 1)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.zrem(self.user_key(username), channel_name)
+                pipe.zcard(self.user_key(username))
+                _, remaining = await pipe.execute()
+            if remaining == 0:
+                gone.append(username)
+        return gone
+
+    async def publish(self, username, online):
+        # SETNX and DEL are atomic, of two workers flushing the same change only one publishes it
+        if online:
+            return bool(await self.redis.setnx(self.published_key(username), 1))
+        return await self.redis.delete(self.published_key(username)) == 1
+
+    async def online(self, usernames, now):
+        usernames = list(usernames)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for username in usernames:
+                pipe.zcount(self.user_key(username), now, '+inf')
+            counts = await pipe.execute()
+        return {username for username, count in zip(usernames, counts) if count}
+
+
+@database_sync_to_async
+def get_friend_usernames(usernames):
+    """
+    This function returns {username: [friend usernames]} for all usernames in one query.
+    """
+    friends = defaultdict(list)
+    usernames = set(usernames)
+    connections = Connection.objects.filter(
+        Q(sender__username__in=usernames) | Q(receiver__username__in=usernames),
+        accepted=True
+    ).values_list('sender__username', 'receiver__username')
+    for sender, receiver in connections:
+        if sender in usernames:
+            friends[sender].append(receiver)
+        if receiver in usernames:
+            friends[receiver].append(sender)
+    return friends
+
+
+class PresenceService:
+    """
+    Tracks sockets per user and tells online friends when a user comes online or goes offline.
+
+    Only online/offline transitions fan out. They are collected for PRESENCE_FANOUT_SECONDS,
+    a user flapping within that window only publishes its latest state, and every online
+    friend gets a single 'presence' frame per flush.
+
+    The last published state lives in the backend, so a worker never repeats a state
+    another worker already published, nor holds back a change because of its own history.
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self.pending = {}
+        self.flush_task = None
+        self.sweep_task = None
+
+    @property
+    def backend(self):
+        # Created on first use, importing the consumers doesn't need Redis
+        if self._backend is None:
+            self._backend = create_backend()
+        return self._backend
+
+    async def connect(self, username, channel_name):
+        self.start_sweeper()
+        expires_at = time.time() + PRESENCE_TTL_SECONDS
+        if await self.backend.connect(username, channel_name, expires_at):
+            self.changed(username, True)
+
+    async def heartbeat(self, username, channel_name):
+        expires_at = time.time() + PRESENCE_TTL_SECONDS
+        # Only a socket that had expired causes a fan-out, a normal heartbeat just refreshes it
+        if await self.backend.heartbeat(username, channel_name, expires_at):
+            self.changed(username, True)
+
+    async def disconnect(self, username, channel_name):
+        if await self.backend.disconnect(username, channel_name):
+            self.changed(username, False)
+
+    async def online(self, usernames):
+        return await self.backend.online(usernames, time.time())
+
+    async def online_friends(self, username):
+        friends = await get_friend_usernames([username])
+        return sorted(await self.online(friends[username]))
+
+    def changed(self, username, online):
+        self.pending[username] = online
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(PRESENCE_FANOUT_SECONDS)
+        await self.flush()
+        if self.pending:
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        ready = {}
+        for username, online in pending.items():
+            # Repeats of the published state are dropped, real changes always go out
+            if await self.backend.publish(username, online):
+                ready[username] = online
+
+        if not ready:
+            return
+
+        friends = await get_friend_usernames(ready)
+        online = await self.online({
+            friend for username in ready for friend in friends[username]
+        })
+
+        # One frame per online friend, covering every change they care about
+        statuses = defaultdict(dict)
+        for username, is_online in ready.items():
+            for friend in friends[username]:
+                if friend in online:
+                    statuses[friend][username] = 'online' if is_online else 'offline'
+
+        channel_layer = get_channel_layer()
+        for friend, friend_statuses in statuses.items():
+            await channel_layer.group_send(user_group(friend), {
+                'type': 'broadcast_group',
+                'frame': broadcast_frame('presence', friend_statuses)
+            })
+
+    def start_sweeper(self):
+        if self.sweep_task is None or self.sweep_task.done():
+            self.sweep_task = asyncio.ensure_future(self.sweep())
+
+    async def sweep(self):
+        # Sockets that stopped sending heartbeats without a clean disconnect
+        while True:
+            await asyncio.sleep(PRESENCE_TTL_SECONDS / 2)
+            for username in await self.backend.expire(time.time()):
+                self.changed(username, False)
+
+
+def create_backend():
+    if getattr(settings, 'PRESENCE_BACKEND', 'memory') == 'redis':
+        return RedisPresence(settings.PRESENCE_REDIS_URL)
+    return MemoryPresence()
+
+
+presence = PresenceService()
@@ -0,0 +1,175 @@
+from bisect import bisect_left, insort
+from collections import Counter
+from threading import Lock
+from django.conf import settings
+from django.db import connection as db_connection
+from django.db.models import Q, Case, When, Value, IntegerField
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import User, Connection
+
+
+SEARCH_RESULTS_LIMIT = getattr(settings, 'SEARCH_RESULTS_LIMIT', 20)
+SEARCH_DEBOUNCE_SECONDS = getattr(settings, 'SEARCH_DEBOUNCE_SECONDS', 0.15)
+
+# Process wide count of searches superseded before (pending) or while (in_flight) running
+search_stats = Counter()
+
+
+class PrefixIndex:
+    """
+    In-process sorted index of lowercased name tokens, used where the database has no trigram index.
+    """
+    # Short queries match a lot of tokens, stop scanning once there is enough to rank
+    SCAN_FACTOR = 5
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = None
+        self.user_tokens = {}
+
+    def tokens(self, username, first_name, last_name):
+        return [
+            (value.lower(), rank)
+            for rank, value in enumerate((username, first_name, last_name)) if value
+        ]
+
+    def build(self):
+        entries = []
+        user_tokens = {}
+        users = User.objects.values_list(
+            'id', 'username', 'first_name', 'last_name').iterator()
+        for user_id, *names in users:
+            user_tokens[user_id] = self.tokens(*names)
+            for token, rank in user_tokens[user_id]:
+                entries.append((token, rank, user_id))
+        entries.sort()
+        self.entries = entries
+        self.user_tokens = user_tokens
+
+    def search(self, query, limit):
+        with self.lock:
+            if self.entries is None:
+                self.build()
+            entries = self.entries
+
+            # Every token starting with the query sits right after bisect_left(query)
+            matches = {}
+            index = bisect_left(entries, (query,))
+            while index < len(entries) and entries[index][0].startswith(query):
+                token, rank, user_id = entries[index]
+                if token == query:
+                    rank = -1
+                matches[user_id] = min(rank, matches.get(user_id, rank))
+                if len(matches) >= limit * self.SCAN_FACTOR:
+                    break
+                index += 1
+
+        ranked = sorted(matches.items(), key=lambda match: match[1])
+        return [user_id for user_id, _ in ranked[:limit]]
+
+    def discard(self, user_id):
+        for token, rank in self.user_tokens.pop(user_id, []):
+            index = bisect_left(self.entries, (token, rank, user_id))
+            if index < len(self.entries) and self.entries[index] == (token, rank, user_id):
+                del self.entries[index]
+
+    def update(self, user):
+        with self.lock:
+            if self.entries is None:
+                return
+            tokens = self.tokens(user.username, user.first_name, user.last_name)
+            # Most saves (last_login, thumbnail) leave the names alone
+            if self.user_tokens.get(user.id) == tokens:
+                return
+            self.discard(user.id)
+            for token, rank in tokens:
+                insort(self.entries, (token, rank, user.id))
+            self.user_tokens[user.id] = tokens
+
+    def remove(self, user):
+        with self.lock:
+            if self.entries is None:
+                return
+            self.discard(user.id)
+
+
+prefix_index = PrefixIndex()
+
+
+@receiver(post_save, sender=User)
+def update_prefix_index(sender, instance, **kwargs):
+    prefix_index.update(instance)
+
+
+@receiver(post_delete, sender=User)
+def remove_from_prefix_index(sender, instance, **kwargs):
+    prefix_index.remove(instance)
+
+
+def find_users(query, limit):
+    """
+    This function returns up to limit users matching the query, best match first.
+    """
+    if db_connection.vendor != 'postgresql':
+        user_ids = prefix_index.search(query, limit)
+        users = User.objects.in_bulk(user_ids)
+        return [users[user_id] for user_id in user_ids if user_id in users]
+
+    # icontains is served by the pg_trgm indexes on UPPER(column)
+    return list(User.objects.filter(
+        Q(username__icontains=query) |
+        Q(first_name__icontains=query) |
+        Q(last_name__icontains=query)
+    ).annotate(
+        rank=Case(
+            When(username__iexact=query, then=Value(0)),
+            When(username__istartswith=query, then=Value(1)),
+            When(Q(first_name__istartswith=query) |
+                 Q(last_name__istartswith=query), then=Value(2)),
+            default=Value(3),
+            output_field=IntegerField()
+        )
+    ).order_by('rank', 'username')[:limit])
+
+
+def get_statuses(user, users):
+    """
+    This function returns the connection status between user and each of users in one query.
+    """
+    statuses = {}
+    user_ids = [other.id for other in users]
+    connections = Connection.objects.filter(
+        Q(sender=user, receiver_id__in=user_ids) |
+        Q(receiver=user, sender_id__in=user_ids)
+    ).values_list('sender_id', 'receiver_id', 'accepted')
+
+    # Same precedence as before: pending-them, pending-me, then connected
+    priority = {'pending-them': 0, 'pending-me': 1, 'connected': 2}
+    for sender_id, receiver_id, accepted in connections:
+        if accepted:
+            status = 'connected'
+            other_id = receiver_id if sender_id == user.id else sender_id
+        elif receiver_id == user.id:
+            status = 'pending-them'
+            other_id = sender_id
+        else:
+            status = 'pending-me'
+            other_id = receiver_id
+        current = statuses.get(other_id)
+        if current is None or priority[status] < priority[current]:
+            statuses[other_id] = status
+    return statuses
+
+
+def search_users(user, query, limit=SEARCH_RESULTS_LIMIT):
+    query = (query or '').strip().lower()
+    if not query:
+        return [], {}
+
+    # Ask for one more in case the searching user is among the matches
+    users = [
+        other for other in find_users(query, limit + 1) if other.id != user.id
+    ][:limit]
+
+    return users, get_statuses(user, users)
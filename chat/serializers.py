@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import User, Connection, Message
+from .models import User, Connection, Message, GroupChat, GroupMember, GroupMessage
 
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -19,7 +19,7 @@ class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username', 'email',
-                  'thumbnail', 'name']
+                  'thumbnail', 'thumbnail_variants', 'name']
 
     def get_full_name(self, obj):
         return obj.get_full_name()
@@ -31,16 +31,11 @@ class SearchSerializer(UserSerializer):
     class Meta:
         model = User
         fields = ['id', 'username',
-                  'thumbnail', 'name', 'status']
+                  'thumbnail', 'thumbnail_variants', 'name', 'status']
 
     def get_status(self, obj):
-        if (obj.pending_them):
-            return 'pending-them'
-        elif (obj.pending_me):
-            return 'pending-me'
-        elif (obj.connected):
-            return 'connected'
-        return 'not-connected'
+        # Statuses are looked up for the whole result set at once
+        return self.context['statuses'].get(obj.id, 'not-connected')
 
 
 class RequestSerializer(serializers.ModelSerializer):
@@ -58,37 +53,111 @@ class FriendSerializer(serializers.ModelSerializer):
     friend = serializers.SerializerMethodField('get_friend')
     preview = serializers.SerializerMethodField('get_preview')
     updated_at = serializers.SerializerMethodField('get_updated_at')
+    unread = serializers.SerializerMethodField('get_unread')
+    last_read = serializers.SerializerMethodField('get_last_read')
+    friend_last_read = serializers.SerializerMethodField('get_friend_last_read')
 
     class Meta:
         model = Connection
-        fields = ['id', 'friend', 'preview', 'updated_at']
+        fields = ['id', 'friend', 'preview', 'updated_at', 'unread',
+                  'last_read', 'friend_last_read']
 
     def get_friend(self, obj):
-        if obj.sender == self.context['user']:
+        if obj.sender_id == self.context['user'].id:
             return UserSerializer(obj.receiver).data
         return UserSerializer(obj.sender).data
 
+    def get_summary(self, obj):
+        # The friend list loads the summary with the connection, a new friend has none yet
+        return getattr(obj, 'summary', None)
+
     def get_preview(self, obj):
         # Get the last message, if no message return You are connected
-        last_message = obj.messages.last()
-        if last_message:
-            return last_message.content
+        summary = self.get_summary(obj)
+        if summary and summary.last_message_id:
+            return summary.preview
         return 'You are connected'
 
     def get_updated_at(self, obj):
-        last_message = obj.messages.last()
-        if last_message:
-            return last_message.created_at.isoformat()
+        summary = self.get_summary(obj)
+        if summary:
+            return summary.last_activity_at.isoformat()
         return obj.updated_at.isoformat()
 
+    def get_unread(self, obj):
+        summary = self.get_summary(obj)
+        if not summary:
+            return 0
+        if obj.sender_id == self.context['user'].id:
+            return summary.sender_unread
+        return summary.receiver_unread
+
+    def get_last_read(self, obj):
+        summary = self.get_summary(obj)
+        if not summary:
+            return 0
+        if obj.sender_id == self.context['user'].id:
+            return summary.sender_last_read_id
+        return summary.receiver_last_read_id
+
+    def get_friend_last_read(self, obj):
+        # Messages up to this id show as seen
+        summary = self.get_summary(obj)
+        if not summary:
+            return 0
+        if obj.sender_id == self.context['user'].id:
+            return summary.receiver_last_read_id
+        return summary.sender_last_read_id
+
 
 class MessageSerializer(serializers.ModelSerializer):
     is_my_message = serializers.SerializerMethodField('get_is_my_message')
 
     class Meta:
         model = Message
-        fields = ['id', 'sender', 'content',
-                  'image_url', 'created_at', 'is_my_message']
+        fields = ['id', 'sender', 'content', 'image_url', 'image_variants',
+                  'client_msg_id', 'created_at', 'is_my_message']
 
     def get_is_my_message(self, obj):
-        return obj.sender == self.context['user']
+        return obj.sender_id == self.context['user'].id
+
+
+class SyncMessageSerializer(MessageSerializer):
+    class Meta:
+        model = Message
+        fields = ['id', 'connection', 'sender', 'content', 'image_url',
+                  'image_variants', 'client_msg_id', 'created_at', 'is_my_message']
+
+
+class GroupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = GroupChat
+        fields = ['id', 'name', 'created_by', 'created_at', 'updated_at']
+
+
+class GroupMemberSerializer(serializers.ModelSerializer):
+    user = UserSerializer()
+
+    class Meta:
+        model = GroupMember
+        fields = ['user', 'role', 'joined_at']
+
+
+class MembershipSerializer(serializers.ModelSerializer):
+    group = GroupSerializer()
+    unread = serializers.SerializerMethodField('get_unread')
+
+    class Meta:
+        model = GroupMember
+        fields = ['group', 'role', 'joined_at', 'last_read_id', 'unread']
+
+    def get_unread(self, obj):
+        # Annotated by the group list query
+        return getattr(obj, 'unread', 0)
+
+
+class GroupMessageSerializer(serializers.ModelSerializer):
+    # Everyone in the group gets the same frame, clients compare sender to tell their own
+    class Meta:
+        model = GroupMessage
+        fields = ['id', 'group', 'sender', 'content', 'created_at']
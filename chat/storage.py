@@ -0,0 +1,108 @@
+from threading import Lock
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+import boto3
+
+
+class S3Storage:
+    """
+    S3 compatible storage, the client and its connection pool are created once and shared by all threads.
+    """
+
+    def __init__(self, bucket, endpoint_url, region, base_url,
+                 access_key, secret_key, max_pool_connections):
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.base_url = base_url
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.max_pool_connections = max_pool_connections
+        self.lock = Lock()
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self.lock:
+                if self._client is None:
+                    # Clients are thread safe, sessions are not, so build it once under the lock
+                    session = boto3.session.Session()
+                    self._client = session.client(
+                        's3',
+                        endpoint_url=self.endpoint_url,
+                        region_name=self.region,
+                        aws_access_key_id=self.access_key,
+                        aws_secret_access_key=self.secret_key,
+                        config=boto3.session.Config(
+                            signature_version='s3v4',
+                            max_pool_connections=self.max_pool_connections
+                        )
+                    )
+        return self._client
+
+    def save(self, data, path):
+        self.client.put_object(Bucket=self.bucket, Key=path,
+                               Body=data, ACL='public-read')
+        return self.base_url + path
+
+
+class LocalStorage:
+    """
+    Stores files under MEDIA_ROOT, for running without the CDN.
+    """
+
+    def __init__(self):
+        self.storage = FileSystemStorage()
+
+    def save(self, data, path):
+        name = self.storage.save(path, ContentFile(data))
+        return self.storage.url(name)
+
+
+class MemoryStorage:
+    """
+    Keeps files in a dict, for tests.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.files = {}
+
+    def save(self, data, path):
+        with self.lock:
+            self.files[path] = data
+        return f'memory://{path}'
+
+
+_storage = None
+_storage_lock = Lock()
+
+
+def create_storage():
+    if settings.IMAGE_STORAGE == 'local':
+        return LocalStorage()
+    if settings.IMAGE_STORAGE == 'memory':
+        return MemoryStorage()
+    return S3Storage(
+        bucket=settings.CDN_BUCKET,
+        endpoint_url=settings.CDN_ENDPOINT_URL,
+        region=settings.CDN_REGION,
+        base_url=settings.CDN_BASE_URL,
+        access_key=settings.CDN_ACCESS_KEY,
+        secret_key=settings.CDN_SECRET_ACCESS_KEY,
+        max_pool_connections=settings.CDN_MAX_POOL_CONNECTIONS
+    )
+
+
+def get_storage():
+    """
+    This function returns the process wide storage, created on first use from IMAGE_STORAGE.
+    """
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
@@ -1,3 +1,1142 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from collections import defaultdict
+from datetime import timedelta
+from django.core.management import call_command
+from django.db import connection as db_connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from io import BytesIO, StringIO
+from unittest import mock
+from PIL import Image
+from rest_framework_simplejwt.tokens import AccessToken
+from .archive import archive_batch, hot_cutoff
+from .auth import JWTAuthMiddleware, TokenCache
+from .cache import invalidate_users
+from .codec import CODECS, JSONCodec, MessagePackCodec, negotiate, orjson, broadcast_frame, encode_broadcast
+from .consumers import ChatConsumer, IMAGE_PIPELINE_MAX_PENDING_PER_SOCKET, WEBSOCKET_COALESCE_MAX_FRAMES
+from .groups import ConnectionRegistry, registry, conversation_group, group_chat_group, CONVERSATION_MAX_OPEN
+from .fulltext import FTS_TABLE, search_messages, restore_message_search
+from .lru import LRUCache
+from .members import memberships
+from .management.commands.rebuild_summaries import rebuild_summaries
+from .models import User, Connection, Message, ArchivedMessage, ConversationSummary, GroupChat, GroupMember, GroupMessage, StoredImage
+from .pipeline import ImagePipeline, image_pipeline
+from .uploads import Upload, uploads, IMAGE_UPLOAD_SPOOL_BYTES
+from .storage import MemoryStorage
+from .utils import encode_cursor, encode_variants, save_image, stored_images, dedup_stats
+from .presence import MemoryPresence, PresenceService
+from .typing_indicators import TypingState, TYPING_THROTTLE_SECONDS, TYPING_TIMEOUT_SECONDS
+import asyncio
+import base64
+import json
+import time
 
-# Create your tests here.
+
+class MessageSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice')
+        cls.bob = User.objects.create(username='bob')
+        cls.connection = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True)
+
+    def test_triggers_survive_migrations(self):
+        if db_connection.vendor != 'sqlite':
+            self.skipTest('The FTS5 triggers only exist on SQLite')
+        with db_connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'chat_message'")
+            triggers = {row[0] for row in cursor.fetchall()}
+        self.assertEqual(triggers, {f'{FTS_TABLE}_insert', f'{FTS_TABLE}_delete', f'{FTS_TABLE}_update'})
+
+    def test_message_sent_after_migrate_is_found(self):
+        message = Message.objects.create(
+            connection=self.connection, sender=self.alice, content='lunch at noon?')
+
+        page, _ = search_messages(self.bob, 'lunch')
+        self.assertEqual([found.id for found in page], [message.id])
+
+        message.delete()
+        page, _ = search_messages(self.bob, 'lunch')
+        self.assertEqual(page, [])
+
+
+class ArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice')
+        cls.bob = User.objects.create(username='bob')
+        cls.connection = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True)
+
+    def send(self, content, days_ago, client_msg_id=None):
+        return Message.objects.create(
+            connection=self.connection, sender=self.alice, content=content,
+            client_msg_id=client_msg_id, created_at=timezone.now() - timedelta(days=days_ago))
+
+    def test_reused_client_msg_id_is_not_lost(self):
+        self.send('first', 200, 'X')
+        self.send('newest', 0)
+        cutoff = hot_cutoff()
+        self.assertEqual(archive_batch(cutoff), 1)
+
+        # Sent before archived ids were checked, the same id as the archived message
+        second = self.send('second', 150, 'X')
+        self.assertEqual(archive_batch(cutoff), 0)
+        self.assertTrue(Message.objects.filter(id=second.id).exists())
+        self.assertEqual(ArchivedMessage.objects.get().content, 'first')
+
+    def test_archived_client_msg_id_is_not_sent_again(self):
+        self.send('first', 200, 'X')
+        self.send('newest', 0)
+        archive_batch(hot_cutoff())
+
+        connections = {self.connection.id: self.connection}
+        items = [
+            {'connectionId': self.connection.id, 'message': 'retry', 'clientMsgId': 'X'},
+            {'connectionId': self.connection.id, 'message': 'new', 'clientMsgId': 'Y'},
+        ]
+        messages = ChatConsumer().new_messages(self.alice, connections, items)
+        self.assertEqual([message.client_msg_id for message in messages], ['Y'])
+
+    def test_only_a_flagged_retry_reads_the_archive(self):
+        self.send('first', 200, 'X')
+        self.send('newest', 0)
+        archive_batch(hot_cutoff())
+        ConversationSummary.ensure(self.connection)
+
+        consumer = ChatConsumer()
+        create_message = unwrap(consumer.create_message)
+        with CaptureQueriesContext(db_connection) as queries:
+            result = create_message(consumer, self.alice, {
+                'connectionId': self.connection.id, 'message': 'new'}, 'Y')
+        self.assertTrue(result[4])
+        self.assertFalse([query for query in queries if 'chat_archivedmessage' in query['sql']])
+
+        result = create_message(consumer, self.alice, {
+            'connectionId': self.connection.id, 'message': 'first', 'retry': True}, 'X')
+        self.assertEqual(result[0], ArchivedMessage.objects.get().id)
+        self.assertFalse(result[4])
+
+
+class SummaryTests(TestCase):
+    def test_late_commit_keeps_the_newest_last_message(self):
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        connection = Connection.objects.create(sender=alice, receiver=bob, accepted=True)
+        ConversationSummary.ensure(connection)
+
+        older = Message.objects.create(connection=connection, sender=alice, content='older')
+        newer = Message.objects.create(connection=connection, sender=bob, content='newer')
+        ConversationSummary.record_message(newer)
+        # The older send commits last
+        ConversationSummary.record_message(older)
+
+        summary = ConversationSummary.objects.get()
+        self.assertEqual((summary.last_message_id, summary.preview), (newer.id, 'newer'))
+        self.assertEqual(summary.last_activity_at, newer.created_at)
+        self.assertEqual((summary.sender_unread, summary.receiver_unread), (1, 1))
+
+class SummaryBackfillTests(TransactionTestCase):
+    def test_existing_friendships_get_summaries(self):
+        executor = MigrationExecutor(db_connection)
+        executor.migrate([('chat', '0002_message_image_url_alter_user_thumbnail_and_more')])
+        apps = executor.loader.project_state(
+            [('chat', '0002_message_image_url_alter_user_thumbnail_and_more')]).apps
+
+        OldUser = apps.get_model('chat', 'User')
+        OldConnection = apps.get_model('chat', 'Connection')
+        OldMessage = apps.get_model('chat', 'Message')
+        alice = OldUser.objects.create(username='alice')
+        bob = OldUser.objects.create(username='bob')
+        accepted = OldConnection.objects.create(sender=alice, receiver=bob, accepted=True)
+        OldConnection.objects.create(sender=bob, receiver=OldUser.objects.create(username='carol'))
+        OldMessage.objects.create(connection=accepted, sender=alice, content='hi')
+        last = OldMessage.objects.create(connection=accepted, sender=bob, content='hello')
+
+        executor = MigrationExecutor(db_connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+        summary = ConversationSummary.objects.get()
+        self.assertEqual(summary.connection_id, accepted.id)
+        self.assertEqual(summary.last_message_id, last.id)
+        self.assertEqual(summary.preview, 'hello')
+
+
+def unwrap(method):
+    # database_sync_to_async method -> the plain function it wraps
+    return method.func.__self__.func
+
+
+class FriendListQueryTests(TestCase):
+    def friend_list_queries(self, friends):
+        user = User.objects.create(username=f'user{friends}')
+        others = User.objects.bulk_create([
+            User(username=f'friend{friends}.{i}') for i in range(friends)
+        ])
+        connections = Connection.objects.bulk_create([
+            # Both directions, the friend list reads either side of a connection
+            Connection(sender=user, receiver=other, accepted=True) if i % 2
+            else Connection(sender=other, receiver=user, accepted=True)
+            for i, other in enumerate(others)
+        ])
+        Message.objects.bulk_create([
+            Message(connection=connection, sender=user, content=f'hi {connection.id}')
+            for connection in connections[::2]
+        ])
+        rebuild_summaries(Connection, Message, ConversationSummary)
+
+        consumer = ChatConsumer()
+        with CaptureQueriesContext(db_connection) as queries:
+            friend_list = unwrap(consumer.get_friend_list)(consumer, user)
+
+        self.assertEqual(len(friend_list), friends)
+        self.assertEqual(
+            {friend['friend']['username'] for friend in friend_list},
+            {other.username for other in others})
+        return len(queries)
+
+    def test_constant_queries(self):
+        counts = [self.friend_list_queries(friends) for friends in (1, 100, 1000)]
+        self.assertEqual(counts, [1, 1, 1])
+
+
+class CodecTests(SimpleTestCase):
+    frame = {
+        'source': 'message-send',
+        'data': {'messages': {'id': 7, 'content': 'héllo 👋', 'image_variants': None}, 'unread': [1, 2.5, True]}
+    }
+
+    def test_json_round_trip(self):
+        codec = JSONCodec()
+        self.assertEqual(codec.decode(codec.encode(self.frame)), self.frame)
+        if orjson is not None:
+            with mock.patch('chat.codec.USE_ORJSON', True):
+                self.assertEqual(codec.decode(codec.encode(self.frame)), self.frame)
+
+    def test_msgpack_round_trip(self):
+        codec = MessagePackCodec()
+        frame = dict(self.frame, image=b'\x89PNG\x00')
+        encoded = codec.encode(frame)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(codec.decode(encoded), frame)
+
+    def test_batch_splices_encoded_frames(self):
+        frames = [self.frame, {'source': 'message-typing', 'data': {'typing': True}}]
+        for codec in (JSONCodec(), MessagePackCodec()):
+            with self.subTest(codec=codec.name):
+                batch = codec.batch([codec.encode(frame) for frame in frames])
+                self.assertEqual(codec.decode(batch), {'source': 'batch', 'data': frames})
+                self.assertEqual(codec.decode(codec.batch([])), {'source': 'batch', 'data': []})
+
+    def test_broadcast_is_encoded_once_per_codec_in_use(self):
+        broadcast = broadcast_frame(self.frame['source'], self.frame['data'])
+        # Through the layer it is a plain map, channels_redis packs it with msgpack
+        broadcast = MessagePackCodec().decode(MessagePackCodec().encode(broadcast))
+
+        json_codec = CODECS['json']
+        with mock.patch.object(json_codec, 'encode', wraps=json_codec.encode) as encode:
+            frames = {encode_broadcast(broadcast, json_codec) for _ in range(5)}
+        self.assertEqual(encode.call_count, 1)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(json_codec.decode(frames.pop()), self.frame)
+        self.assertNotEqual(broadcast_frame('x', {})['id'], broadcast_frame('x', {})['id'])
+
+    def test_negotiate(self):
+        codec, subprotocol = negotiate({'subprotocols': ['chat.v2', 'msgpack']})
+        self.assertEqual((codec.name, subprotocol), ('msgpack', 'msgpack'))
+
+        codec, subprotocol = negotiate({'query_string': b'token=abc&codec=msgpack'})
+        self.assertEqual((codec.name, subprotocol), ('msgpack', None))
+
+        for scope in ({}, {'query_string': b'codec=xml'}, {'subprotocols': ['xml']}):
+            codec, subprotocol = negotiate(scope)
+            self.assertEqual((codec.name, subprotocol), ('json', None))
+
+
+class PresenceTests(SimpleTestCase):
+    def test_heartbeat_brings_back_an_expired_socket(self):
+        backend = MemoryPresence()
+        now = time.time()
+
+        self.assertTrue(async_to_sync(backend.connect)('alice', 'socket.1', now + 10))
+        self.assertFalse(async_to_sync(backend.heartbeat)('alice', 'socket.1', now + 20))
+
+        # Backgrounded past the TTL, the sweeper expires the socket while it is still open
+        self.assertEqual(async_to_sync(backend.expire)(now + 30), ['alice'])
+        self.assertEqual(async_to_sync(backend.online)(['alice'], now + 30), set())
+
+        self.assertTrue(async_to_sync(backend.heartbeat)('alice', 'socket.1', now + 100))
+        self.assertEqual(async_to_sync(backend.online)(['alice'], now + 30), {'alice'})
+
+    def test_workers_share_the_published_state(self):
+        backend = MemoryPresence()
+        first, second = PresenceService(backend), PresenceService(backend)
+        published = []
+
+        async def get_friend_usernames(ready):
+            published.append(dict(ready))
+            return defaultdict(list)
+
+        def flush(service, username, online):
+            service.pending[username] = online
+            async_to_sync(service.flush)()
+
+        with mock.patch('chat.presence.get_friend_usernames', get_friend_usernames):
+            flush(first, 'alice', True)
+            # Another worker already told the friends
+            flush(second, 'alice', True)
+            flush(second, 'alice', False)
+            # Right after the previous change, still a real one
+            flush(first, 'alice', True)
+
+        self.assertEqual(published, [{'alice': True}, {'alice': False}, {'alice': True}])
+
+    def test_backend_is_created_on_first_use(self):
+        service = PresenceService()
+        self.assertIsNone(service._backend)
+        with self.settings(PRESENCE_BACKEND='memory'):
+            self.assertIsInstance(service.backend, MemoryPresence)
+            self.assertIs(service.backend, service.backend)
+
+class SyncTests(TestCase):
+    def test_late_commit_below_the_cursor_is_synced(self):
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        connection = Connection.objects.create(sender=alice, receiver=bob, accepted=True)
+        Message.objects.create(
+            connection=connection, sender=alice, content='old',
+            created_at=timezone.now() - timedelta(minutes=5))
+        first = Message.objects.create(connection=connection, sender=alice, content='first')
+        cursor = Message.objects.create(connection=connection, sender=bob, content='cursor', id=first.id + 2)
+
+        consumer = ChatConsumer()
+        get_sync_start = unwrap(consumer.get_sync_start)
+        get_sync_chunk = unwrap(consumer.get_sync_chunk)
+        messages = Message.objects.filter(connection_id__in=[connection.id])
+        # Rescans from the first recent message, the old one stays out
+        self.assertEqual(get_sync_start(consumer, messages, cursor.id), first.id - 1)
+
+        # Its id was taken before the cursor's, it commits after the client synced up to the cursor
+        late = Message.objects.create(connection=connection, sender=alice, content='late', id=first.id + 1)
+
+        start = get_sync_start(consumer, messages, cursor.id)
+        synced, last, done = get_sync_chunk(consumer, bob, messages, start)
+        self.assertEqual([message['id'] for message in synced], [first.id, late.id, cursor.id])
+        self.assertEqual((last, done), (cursor.id, True))
+
+        self.assertEqual(get_sync_start(consumer, messages, 0), 0)
+
+    async def test_group_messages_sync_from_their_own_cursor(self):
+        alice = await User.objects.acreate(username='alice')
+        bob = await User.objects.acreate(username='bob')
+        group = await GroupChat.objects.acreate(name='team', created_by=alice)
+        other = await GroupChat.objects.acreate(name='other', created_by=bob)
+        await GroupMember.objects.acreate(group=group, user=alice, role=GroupMember.OWNER)
+        await GroupMember.objects.acreate(group=other, user=bob, role=GroupMember.OWNER)
+        old = await GroupMessage.objects.acreate(group=group, sender=alice, content='old')
+        # Past the rescan window, created_at is auto_now_add
+        await GroupMessage.objects.filter(id=old.id).aupdate(
+            created_at=timezone.now() - timedelta(minutes=5))
+        seen = await GroupMessage.objects.acreate(group=group, sender=alice, content='seen')
+        new = await GroupMessage.objects.acreate(group=group, sender=alice, content='new')
+        await GroupMessage.objects.acreate(group=other, sender=bob, content='not a member')
+
+        consumer = ChatConsumer()
+        consumer.scope = {'user': alice}
+        frames = []
+
+        async def send_data(source, data):
+            frames.append((source, data))
+        consumer.send_data = send_data
+
+        # Older clients don't send the group cursor and only get 1-to-1 messages
+        await consumer.receive_sync({'lastMessageId': 0})
+        self.assertEqual([source for source, _ in frames], ['sync'])
+
+        frames.clear()
+        await consumer.receive_sync({'lastMessageId': 0, 'lastGroupMessageId': seen.id})
+        source, data = frames[-1]
+        self.assertEqual(source, 'group-sync')
+        # The cursor's message is inside the rescan window, the client drops it by id
+        self.assertEqual([message['id'] for message in data['messages']], [seen.id, new.id])
+        self.assertEqual((data['last'], data['done']), (new.id, True))
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_evicts_least_recently_used(self):
+        discarded = []
+        cache = LRUCache(2, on_discard=lambda key, value: discarded.append(key))
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual((cache.get('b'), cache.get('a'), cache.get('c')), (None, 1, 3))
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(discarded, ['b', 'a'])
+
+    def test_expires(self):
+        now = [100]
+        cache = LRUCache(10, ttl=5, clock=lambda: now[0])
+        cache.set('a', 1)
+        cache.set('b', 2, expires_at=120)
+        now[0] = 105
+        self.assertEqual((cache.get('a', 'missing'), cache.get('b')), ('missing', 2))
+        self.assertEqual(len(cache), 1)
+
+
+class MessageSearchRestoreTests(TestCase):
+    def test_post_migrate_restores_dropped_triggers(self):
+        if db_connection.vendor != 'sqlite':
+            self.skipTest('The FTS5 triggers only exist on SQLite')
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        connection = Connection.objects.create(sender=alice, receiver=bob, accepted=True)
+
+        # What a table rebuild in a future migration does
+        with db_connection.cursor() as cursor:
+            cursor.execute(f'DROP TRIGGER {FTS_TABLE}_insert')
+        message = Message.objects.create(connection=connection, sender=alice, content='unindexed')
+        self.assertEqual(search_messages(bob, 'unindexed')[0], [])
+
+        restore_message_search(sender=None)
+        self.assertEqual([found.id for found in search_messages(bob, 'unindexed')[0]], [message.id])
+        Message.objects.create(connection=connection, sender=alice, content='indexed again')
+        self.assertEqual(len(search_messages(bob, 'indexed')[0]), 1)
+
+    def test_rebuild_command_reindexes_everything(self):
+        if db_connection.vendor != 'sqlite':
+            self.skipTest('The FTS5 index only exists on SQLite')
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        connection = Connection.objects.create(sender=alice, receiver=bob, accepted=True)
+        Message.objects.bulk_create([
+            Message(connection=connection, sender=alice, content=f'note {i}') for i in range(30)
+        ])
+        with db_connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('delete-all')")
+
+        call_command('rebuild_message_search', stdout=StringIO())
+        self.assertEqual(len(search_messages(bob, 'note', limit=50)[0]), 30)
+
+
+class ImageSlotTests(SimpleTestCase):
+    async def test_failed_send_releases_the_slot(self):
+        consumer = ChatConsumer()
+        consumer.pending_images = 0
+        image = BytesIO(b'image')
+        pending = image_pipeline.pending
+
+        async def fail(*args):
+            raise RuntimeError('database went away')
+
+        with mock.patch.object(consumer, 'create_message', fail):
+            with self.assertRaises(RuntimeError):
+                await consumer.send_message(User(id=1, username='alice'), {'connectionId': 1}, image)
+
+        self.assertEqual((image_pipeline.pending, consumer.pending_images), (pending, 0))
+        self.assertTrue(image.closed)
+
+    def test_pipeline_refuses_past_max_pending(self):
+        pipeline = ImagePipeline(workers=1, max_pending=2)
+        self.assertTrue(pipeline.reserve())
+        self.assertTrue(pipeline.reserve())
+        self.assertFalse(pipeline.reserve())
+
+        def fail():
+            raise ValueError('not an image')
+
+        # A failed job gives its slot back too
+        with self.assertRaises(ValueError):
+            async_to_sync(pipeline.run)(fail)
+        self.assertEqual(pipeline.pending, 1)
+        self.assertTrue(pipeline.reserve())
+
+    async def test_busy_socket_is_told_to_retry(self):
+        consumer = ChatConsumer()
+        consumer.pending_images = IMAGE_PIPELINE_MAX_PENDING_PER_SOCKET
+        sent = []
+
+        async def send_data(source, data):
+            sent.append((source, data))
+        consumer.send_data = send_data
+        image = BytesIO(b'image')
+        pending = image_pipeline.pending
+
+        with mock.patch.object(consumer, 'create_message') as create_message:
+            await consumer.send_message(User(id=1, username='alice'), {'connectionId': 1}, image)
+        create_message.assert_not_called()
+        self.assertEqual(sent, [('image-busy', {'source': 'message-send'})])
+        self.assertEqual(image_pipeline.pending, pending)
+        self.assertTrue(image.closed)
+
+    async def test_placeholder_goes_out_before_the_image(self):
+        consumer = ChatConsumer()
+        consumer.pending_images = 0
+        events = []
+
+        async def create_message(user, data, client_msg_id=None):
+            return 7, 'bob', {'messages': {'id': 7}}, {'messages': {'id': 7}}, True
+
+        async def send_group(group, source, data):
+            events.append(source)
+
+        async def send_conversation(connection_id, source, data):
+            events.append(source)
+
+        def process_image_message(message_id, image):
+            # Runs in the pipeline, after the placeholder went out
+            events.append('processed')
+            return 1, 'alice', 'bob', {}, {}
+
+        consumer.create_message = create_message
+        consumer.send_group = send_group
+        consumer.send_conversation = send_conversation
+        consumer.process_image_message = process_image_message
+        image = BytesIO(b'image')
+        pending = image_pipeline.pending
+
+        await consumer.send_message(User(id=1, username='alice'), {'connectionId': 1}, image)
+        await asyncio.gather(*image_pipeline.tasks)
+        self.assertEqual(events, ['message-send', 'message-send', 'processed', 'message-update'])
+        self.assertEqual((image_pipeline.pending, consumer.pending_images), (pending, 0))
+        self.assertTrue(image.closed)
+
+
+class UploadTests(SimpleTestCase):
+    def setUp(self):
+        self.consumer = ChatConsumer()
+        self.consumer.scope = {'user': User(id=1, username='alice')}
+        self.consumer.pending_images = 0
+        self.sent = []
+
+        async def send_data(source, data):
+            self.sent.append((source, data))
+        self.consumer.send_data = send_data
+        self.addCleanup(self.forget_uploads)
+
+    def forget_uploads(self):
+        for key in list(uploads.uploads):
+            uploads.pop(*key).close()
+
+    def test_buffered_bytes_are_bounded(self):
+        size = 10 * 1024 * 1024
+        upload = Upload('big', size, {})
+        self.addCleanup(upload.close)
+        chunk = b'\0' * (64 * 1024)
+        for offset in range(0, size, len(chunk)):
+            self.assertTrue(upload.write(offset, chunk))
+            # Past the spool size the bytes live on disk, memory holds at most the spool
+            if upload.received > IMAGE_UPLOAD_SPOOL_BYTES:
+                self.assertTrue(upload.file._rolled)
+        self.assertTrue(upload.complete)
+        self.assertEqual(upload.open().seek(0, 2), size)
+
+    async def test_busy_pipeline_refuses_at_start(self):
+        with mock.patch.object(image_pipeline, 'pending', image_pipeline.max_pending):
+            await self.consumer.receive_upload_start({
+                'uploadId': 'u1', 'size': 10, 'target': 'message-send', 'connectionId': 1})
+        self.assertEqual(self.sent, [('upload-error', {'uploadId': 'u1', 'reason': 'busy'})])
+        self.assertIsNone(uploads.get('alice', 'u1'))
+
+    async def test_malformed_upload_is_refused(self):
+        await self.consumer.receive_upload_start({
+            'uploadId': 'u1', 'size': 10, 'target': 'message-send', 'connectionId': 1, 'message': 5})
+        await self.consumer.receive_upload_start({
+            'uploadId': 'u2', 'size': 10, 'target': 'message-send'})
+        self.assertEqual([data['reason'] for _, data in self.sent], ['invalid', 'invalid'])
+
+    async def test_slot_is_held_from_start_to_send(self):
+        pending = image_pipeline.pending
+        await self.consumer.receive_upload_start({
+            'uploadId': 'u1', 'size': 4, 'target': 'message-send', 'connectionId': 1})
+        self.assertEqual(self.sent[-1], ('upload-start', {'uploadId': 'u1', 'offset': 0}))
+        self.assertEqual(image_pipeline.pending, pending + 1)
+
+        sends = []
+
+        async def send_message(user, data, image, reserved=False):
+            sends.append((data.get('message'), image.read(), reserved))
+            self.consumer.release_image()
+        self.consumer.send_message = send_message
+
+        await self.consumer.receive_upload_chunk_data({'uploadId': 'u1', 'offset': 0}, b'\x89PNG')
+        self.assertEqual(sends, [(None, b'\x89PNG', True)])
+        self.assertEqual((image_pipeline.pending, self.consumer.pending_images), (pending, 0))
+
+    async def test_interrupted_upload_resumes_from_its_offset(self):
+        def frame(offset, chunk):
+            header = json.dumps({'uploadId': 'u1', 'offset': offset}).encode()
+            return len(header).to_bytes(4, 'big') + header + chunk
+
+        start = {'uploadId': 'u1', 'size': 6, 'target': 'thumbnail'}
+        await self.consumer.receive_upload_start(start)
+        pending = image_pipeline.pending
+        await self.consumer.receive_upload_chunk(frame(0, b'abc'))
+
+        # A chunk past the gap is refused with the offset to resume from
+        await self.consumer.receive_upload_chunk(frame(4, b'ef'))
+        self.assertEqual(self.sent[-1], ('upload-offset', {'uploadId': 'u1', 'offset': 3}))
+
+        # Reconnected, starting again resumes without taking a second slot
+        await self.consumer.receive_upload_start(start)
+        self.assertEqual(self.sent[-1], ('upload-start', {'uploadId': 'u1', 'offset': 3}))
+        self.assertEqual(image_pipeline.pending, pending)
+
+        thumbnails = []
+
+        async def start_thumbnail(user, image, reserved=False):
+            thumbnails.append((image.read(), reserved))
+            self.consumer.release_image()
+        self.consumer.start_thumbnail = start_thumbnail
+
+        await self.consumer.receive_upload_chunk(frame(3, b'def'))
+        self.assertEqual(thumbnails, [(b'abcdef', True)])
+        self.assertEqual(image_pipeline.pending, pending - 1)
+
+    async def test_abandoned_upload_gives_its_slot_back(self):
+        pending = image_pipeline.pending
+        await self.consumer.receive_upload_start({
+            'uploadId': 'u1', 'size': 4, 'target': 'thumbnail'})
+        self.assertEqual(image_pipeline.pending, pending + 1)
+        uploads.pop('alice', 'u1').close()
+        self.assertEqual(image_pipeline.pending, pending)
+
+
+class CaptionlessMessageTests(TestCase):
+    def test_image_message_without_caption(self):
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        connection = Connection.objects.create(sender=alice, receiver=bob, accepted=True)
+        ConversationSummary.ensure(connection)
+
+        consumer = ChatConsumer()
+        result = unwrap(consumer.create_message)(consumer, alice, {'connectionId': connection.id})
+        self.assertEqual(Message.objects.get(id=result[0]).content, '')
+
+
+class AuthCacheTests(TestCase):
+    def storm(self, tokens):
+        users = []
+
+        async def app(scope, receive, send):
+            users.append(scope['user'])
+
+        async def connect_all():
+            middleware = JWTAuthMiddleware(app)
+            await asyncio.gather(*[
+                middleware({'type': 'websocket', 'query_string': f'token={token}'.encode()}, None, None)
+                for token in tokens
+            ])
+
+        with CaptureQueriesContext(db_connection) as queries:
+            async_to_sync(connect_all)()
+        return users, len(queries)
+
+    def test_reconnect_storm_queries_per_connect(self):
+        users = [User.objects.create(username=f'storm{i}') for i in range(10)]
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+        # Five devices per user and a bad token reconnecting at once
+        storm = tokens * 5 + ['bad'] * 5
+
+        connected, queries = self.storm(storm)
+        self.assertEqual(queries, len(users))
+        self.assertEqual(sum(user.is_authenticated for user in connected), len(tokens) * 5)
+
+        # Cached, verified and rejected tokens alike
+        connected, queries = self.storm(storm)
+        self.assertEqual(queries, 0)
+        self.assertEqual({user.username for user in connected if user.is_authenticated},
+                         {user.username for user in users})
+
+        # A saved user is loaded again, once
+        users[0].first_name = 'Changed'
+        users[0].save()
+        connected, queries = self.storm([tokens[0]] * 3)
+        self.assertEqual(queries, 1)
+        self.assertEqual({user.first_name for user in connected}, {'Changed'})
+
+    def test_token_index_follows_the_cache(self):
+        cache = TokenCache(max_size=2)
+        now = time.time()
+        cache.set('a', now + 60, 1, ['a'])
+        cache.set('b', now + 60, 1, ['b'])
+        cache.set('bad', now + 60)
+        # 'a' was evicted, the user's index lost it with it
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.user_tokens[1], {'b'})
+
+        cache.forget_user(1)
+        self.assertIsNone(cache.get('b'))
+        self.assertNotIn(1, cache.user_tokens)
+        self.assertEqual(cache.get('bad'), (now + 60, None, None))
+
+        # Entries end at their own expiry, the token's when it comes first
+        cache.set('c', now - 1, 2, ['c'])
+        self.assertIsNone(cache.get('c'))
+        self.assertNotIn(2, cache.user_tokens)
+
+    def test_bad_and_inactive_tokens_are_cached_as_rejected(self):
+        inactive = User.objects.create(username='inactive', is_active=False)
+        storm = ['garbage', str(AccessToken.for_user(inactive))]
+        connected, queries = self.storm(storm * 3)
+        self.assertEqual(queries, 1)
+        self.assertFalse([user for user in connected if user.is_authenticated])
+
+        connected, queries = self.storm(storm)
+        self.assertEqual(queries, 0)
+
+
+class ConnectionRegistryTests(SimpleTestCase):
+    def test_socket_keeps_its_most_recent_conversations(self):
+        registry = ConnectionRegistry(max_open=2)
+        registry.register('socket.1')
+        self.assertIsNone(registry.open('socket.1', 1))
+        self.assertIsNone(registry.open('socket.1', 2))
+        # Reopening moves it to the back, so 2 is now the oldest
+        self.assertIsNone(registry.open('socket.1', 1))
+        self.assertEqual(registry.open('socket.1', 3), 2)
+        self.assertFalse(registry.is_open('socket.1', 2))
+
+        self.assertTrue(registry.close('socket.1', 1))
+        self.assertFalse(registry.close('socket.1', 1))
+        self.assertEqual(registry.unregister('socket.1'), [3])
+        self.assertFalse(registry.is_open('socket.1', 3))
+
+    async def test_only_open_conversations_are_subscribed(self):
+        consumer = ChatConsumer()
+        consumer.channel_name = 'socket.1'
+        consumer.channel_layer = InMemoryChannelLayer()
+        registry.register(consumer.channel_name)
+        self.addCleanup(registry.unregister, consumer.channel_name)
+
+        for connection_id in range(1, CONVERSATION_MAX_OPEN + 2):
+            await consumer.open_conversation(connection_id)
+
+        groups = consumer.channel_layer.groups
+        self.assertNotIn(conversation_group(1), groups)
+        self.assertEqual(
+            {group for group, channels in groups.items() if 'socket.1' in channels},
+            {conversation_group(i) for i in range(2, CONVERSATION_MAX_OPEN + 2)})
+
+
+class MessageListTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+        ConversationSummary.ensure(self.connection)
+        # Ids can repeat between tests, cached connections must not
+        invalidate_users(self.alice.id, self.bob.id)
+
+        self.consumer = ChatConsumer()
+        self.get_message_list = unwrap(self.consumer.get_message_list)
+
+    def send(self, count, days_ago=0, created_at=None):
+        now = timezone.now()
+        return [
+            Message.objects.create(
+                connection=self.connection, sender=self.alice, content=f'{days_ago}.{i}',
+                created_at=created_at or now - timedelta(days=days_ago, seconds=count - i))
+            for i in range(count)
+        ]
+
+    def page(self, **data):
+        _, page, _ = self.get_message_list(
+            self.consumer, self.bob, {'connectionId': self.connection.id, **data})
+        return [message['id'] for message in page['messages']], page
+
+    def walk(self, **data):
+        ids, page = self.page(**data)
+        pages = [ids]
+        while page['before']:
+            ids, page = self.page(before=page['before'])
+            pages.append(ids)
+        return pages
+
+    def test_before_cursor_walks_every_message_without_count(self):
+        messages = self.send(25)
+        # Same created_at, the id breaks the tie
+        messages += self.send(3, created_at=timezone.now())
+
+        with CaptureQueriesContext(db_connection) as queries:
+            pages = self.walk()
+        self.assertEqual([len(ids) for ids in pages], [10, 10, 8])
+        self.assertEqual(sum(pages, []), [message.id for message in sorted(
+            messages, key=lambda message: (message.created_at, message.id), reverse=True)])
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql'].upper()])
+
+    def test_after_cursor_returns_the_next_newer_page(self):
+        messages = self.send(15)
+        _, page = self.page(before=encode_cursor(messages[-1]))
+        ids, page = self.page(after=encode_cursor(messages[2]))
+        # Newest first like every page, the ten right after the cursor
+        self.assertEqual(ids, [message.id for message in messages[3:13]][::-1])
+        self.assertEqual(page['after'], encode_cursor(messages[12]))
+
+    def test_cursor_pages_continue_into_the_archive(self):
+        old = self.send(12, days_ago=200)
+        hot = self.send(5)
+        self.assertEqual(archive_batch(hot_cutoff()), 12)
+
+        pages = self.walk()
+        self.assertEqual(sum(pages, []), [message.id for message in old + hot][::-1])
+
+    def test_page_numbers_skip_the_hot_messages_in_the_archive(self):
+        old = self.send(12, days_ago=200)
+        hot = self.send(15)
+        archive_batch(hot_cutoff())
+
+        newest_first = [message.id for message in old + hot][::-1]
+        for page in range(3):
+            ids, result = self.page(page=page)
+            self.assertEqual(ids, newest_first[page * 10:page * 10 + 10])
+            self.assertEqual(result['next'], page + 1 if page < 2 else 0)
+
+
+def png(size, mode='RGB', color=(200, 30, 30)):
+    buffer = BytesIO()
+    Image.new(mode, size, color).save(buffer, format='PNG')
+    buffer.seek(0)
+    return buffer
+
+
+class ImageVariantTests(SimpleTestCase):
+    def test_every_size_in_both_formats_largest_first(self):
+        variants = list(encode_variants(png((2000, 1000)), [64, 1024, 256]))
+        self.assertEqual([(size, image_format) for size, image_format, _ in variants], [
+            (1024, 'WEBP'), (1024, 'JPEG'), (256, 'WEBP'), (256, 'JPEG'), (64, 'WEBP'), (64, 'JPEG')])
+
+        for size, image_format, data in variants:
+            image = Image.open(BytesIO(data))
+            self.assertEqual(image.format, image_format)
+            # Longest side fits the size, the aspect ratio is kept
+            self.assertEqual(image.size, (size, size // 2))
+
+    def test_transparency_survives_in_webp_only(self):
+        variants = {image_format: Image.open(BytesIO(data)) for _, image_format, data in
+                    encode_variants(png((100, 100), 'RGBA', (0, 0, 0, 0)), [64])}
+        self.assertEqual(variants['WEBP'].mode, 'RGBA')
+        self.assertEqual(variants['WEBP'].getpixel((10, 10))[3], 0)
+        # JPEG has no alpha, transparent pixels are flattened onto white
+        self.assertEqual(variants['JPEG'].mode, 'RGB')
+        self.assertTrue(all(channel > 240 for channel in variants['JPEG'].getpixel((10, 10))))
+
+
+class ImageDedupTests(TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage()
+        patcher = mock.patch('chat.utils.get_storage', return_value=self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Process wide, earlier tests may have filled them
+        stored_images.entries.clear()
+        dedup_stats.clear()
+
+    def test_same_bytes_are_processed_once(self):
+        image_url, variants = save_image(png((300, 200)), 'thumbnail')
+        stored = dict(self.storage.files)
+        self.assertEqual(len(stored), 4)
+        self.assertEqual(set(variants), {'64', '256'})
+        self.assertEqual(image_url, variants['256']['jpg'])
+
+        # Another user uploads the same bytes, base64 this time
+        again = save_image(base64.b64encode(png((300, 200)).read()).decode(), 'thumbnail')
+        self.assertEqual(again, (image_url, variants))
+        self.assertEqual(self.storage.files, stored)
+
+        stored_image = StoredImage.objects.get()
+        self.assertEqual(stored_image.hits, 1)
+        self.assertEqual(stored_image.bytes_saved, sum(len(data) for data in stored.values()))
+        self.assertEqual((dedup_stats['hits'], dedup_stats['misses']), (1, 1))
+
+    def test_hit_survives_a_cold_cache(self):
+        first = save_image(png((300, 200)), 'message')
+        stored_images.entries.clear()
+        self.assertEqual(save_image(png((300, 200)), 'message'), first)
+        # Different bytes, or the same bytes as another kind, are processed again
+        save_image(png((300, 200), color=(0, 0, 255)), 'message')
+        save_image(png((300, 200)), 'thumbnail')
+        self.assertEqual(StoredImage.objects.count(), 3)
+
+
+class CoalesceTests(SimpleTestCase):
+    def consumer(self, coalesce, codec='json'):
+        consumer = ChatConsumer()
+        consumer.codec = CODECS[codec]
+        consumer.coalesce = coalesce
+        consumer.outbox = []
+        consumer.flush_task = None
+        consumer.written = []
+
+        async def send(text_data=None, bytes_data=None):
+            consumer.written.append(text_data if text_data is not None else bytes_data)
+        consumer.send = send
+        return consumer
+
+    async def test_frames_close_together_go_out_as_one_batch(self):
+        for codec in ('json', 'msgpack'):
+            consumer = self.consumer(True, codec)
+            for i in range(3):
+                await consumer.send_data('message-send', {'id': i})
+            self.assertEqual(consumer.written, [])
+
+            await consumer.flush_task
+            self.assertEqual(len(consumer.written), 1)
+            self.assertEqual(consumer.codec.decode(consumer.written[0]), {'source': 'batch', 'data': [
+                {'source': 'message-send', 'data': {'id': i}} for i in range(3)]})
+
+            # A lone frame is not wrapped
+            await consumer.send_data('message-send', {'id': 3})
+            await consumer.flush_task
+            self.assertEqual(consumer.codec.decode(consumer.written[1]),
+                             {'source': 'message-send', 'data': {'id': 3}})
+
+    async def test_full_outbox_is_flushed_right_away(self):
+        consumer = self.consumer(True)
+        for i in range(WEBSOCKET_COALESCE_MAX_FRAMES):
+            await consumer.send_data('message-send', {'id': i})
+        self.assertEqual(len(consumer.written), 1)
+        self.assertEqual(len(json.loads(consumer.written[0])['data']), WEBSOCKET_COALESCE_MAX_FRAMES)
+        consumer.flush_task.cancel()
+
+    async def test_other_clients_get_every_frame_as_is(self):
+        consumer = self.consumer(False)
+        await consumer.send_data('message-send', {'id': 1})
+        await consumer.send_data('message-send', {'id': 2})
+        self.assertEqual([json.loads(frame)['data']['id'] for frame in consumer.written], [1, 2])
+
+
+class MessageBatchTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.carol = User.objects.create(username='carol')
+        self.with_bob = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+        self.with_carol = Connection.objects.create(sender=self.carol, receiver=self.alice, accepted=True)
+        self.pending = Connection.objects.create(sender=self.bob, receiver=self.carol)
+        for connection in (self.with_bob, self.with_carol):
+            ConversationSummary.ensure(connection)
+
+        self.consumer = ChatConsumer()
+        self.create_messages = unwrap(self.consumer.create_messages)
+
+    def test_batch_is_one_insert_and_one_event_per_user(self):
+        items = [
+            {'connectionId': self.with_bob.id, 'message': 'one', 'clientMsgId': 'a'},
+            {'connectionId': self.with_carol.id, 'message': 'two', 'clientMsgId': 'b'},
+            {'connectionId': self.with_bob.id, 'message': 'three', 'clientMsgId': 'c'},
+            # Not alice's to send on
+            {'connectionId': self.pending.id, 'message': 'nope'},
+            'not a message',
+        ]
+        with CaptureQueriesContext(db_connection) as queries:
+            payloads = self.create_messages(self.consumer, self.alice, items)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT')]), 1)
+
+        self.assertEqual({username: [payload['messages']['content'] for payload in user_payloads]
+                          for username, user_payloads in payloads.items()},
+                         {'alice': ['one', 'two', 'three'], 'bob': ['one', 'three'], 'carol': ['two']})
+        self.assertEqual([payload['messages']['is_my_message'] for payload in payloads['bob']], [False, False])
+
+        summary = ConversationSummary.objects.get(connection=self.with_bob)
+        self.assertEqual((summary.preview, summary.receiver_unread), ('three', 2))
+
+    def test_retried_batch_only_inserts_what_is_missing(self):
+        items = [
+            {'connectionId': self.with_bob.id, 'message': 'one', 'clientMsgId': 'a'},
+            {'connectionId': self.with_bob.id, 'message': 'one again', 'clientMsgId': 'a'},
+        ]
+        self.create_messages(self.consumer, self.alice, items[:1])
+        payloads = self.create_messages(self.consumer, self.alice, items + [
+            {'connectionId': self.with_bob.id, 'message': 'two', 'clientMsgId': 'b'}])
+        self.assertEqual([payload['messages']['content'] for payload in payloads['bob']], ['two'])
+        self.assertEqual(list(Message.objects.order_by('id').values_list('content', flat=True)), ['one', 'two'])
+
+
+class TypingTests(SimpleTestCase):
+    def test_burst_sends_a_start_and_throttled_refreshes(self):
+        typing = TypingState()
+        self.assertTrue(typing.start('bob', 100))
+        self.assertFalse(typing.start('bob', 100 + TYPING_THROTTLE_SECONDS / 2))
+        self.assertTrue(typing.start('bob', 100 + TYPING_THROTTLE_SECONDS))
+        self.assertEqual(typing.remaining('bob', 100 + TYPING_THROTTLE_SECONDS), TYPING_TIMEOUT_SECONDS)
+        self.assertEqual(typing.active(), ['bob'])
+
+        self.assertTrue(typing.stop('bob'))
+        self.assertFalse(typing.stop('bob'))
+        self.assertIsNone(typing.remaining('bob', 100))
+
+    def consumer(self):
+        consumer = ChatConsumer()
+        consumer.scope = {'user': User(id=1, username='alice')}
+        consumer.username = 'alice'
+        consumer.typing = TypingState()
+        consumer.typing_tasks = {}
+        consumer.sent = []
+
+        async def get_connection_id(user, username):
+            return 7 if username == 'bob' else None
+
+        async def send_conversation(connection_id, source, data):
+            consumer.sent.append((connection_id, data))
+        consumer.get_connection_id = get_connection_id
+        consumer.send_conversation = send_conversation
+        return consumer
+
+    async def test_keystrokes_reach_the_conversation_once_per_burst(self):
+        consumer = self.consumer()
+        for _ in range(20):
+            await consumer.receive_message_typing({'username': 'bob'})
+        # Strangers get nothing
+        await consumer.receive_message_typing({'username': 'mallory'})
+        await consumer.receive_message_typing({'username': 'bob', 'typing': False})
+        await consumer.receive_message_typing({'username': 'bob', 'typing': False})
+
+        self.assertEqual(consumer.sent, [
+            (7, {'bob': {'username': 'alice', 'typing': True}}),
+            (7, {'bob': {'username': 'alice', 'typing': False}}),
+        ])
+        await asyncio.gather(*consumer.typing_tasks.values())
+
+    async def test_burst_stops_on_its_own(self):
+        consumer = self.consumer()
+        with mock.patch('chat.typing_indicators.TYPING_TIMEOUT_SECONDS', 0.01):
+            await consumer.receive_message_typing({'username': 'bob'})
+            await asyncio.gather(*consumer.typing_tasks.values())
+        self.assertEqual([data['bob']['typing'] for _, data in consumer.sent], [True, False])
+        self.assertEqual(consumer.typing_tasks, {})
+
+
+class GroupFanOutTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        users = User.objects.bulk_create([User(username=f'member{i}') for i in range(499)])
+        self.group = GroupChat.objects.create(name='big', created_by=self.owner)
+        GroupMember.objects.bulk_create(
+            [GroupMember(group=self.group, user=self.owner, role=GroupMember.OWNER)] +
+            [GroupMember(group=self.group, user=user) for user in users])
+        # bulk_create sends no post_save, and group ids repeat between tests
+        memberships.invalidate(self.group.id)
+        self.stranger = User.objects.create(username='stranger')
+
+    def test_send_never_loads_the_members(self):
+        consumer = ChatConsumer()
+        create_group_message = unwrap(consumer.create_group_message)
+        create_group_message(consumer, self.owner, self.group.id, 'warm up')
+
+        with CaptureQueriesContext(db_connection) as queries:
+            serialized = create_group_message(consumer, self.owner, self.group.id, 'hello')
+        self.assertEqual(serialized['messages']['content'], 'hello')
+        # The insert and the chat's updated_at, with the savepoint around them
+        self.assertEqual(len(queries), 4)
+        self.assertFalse([query for query in queries if 'chat_user' in query['sql']])
+        self.assertFalse([query for query in queries if 'chat_groupmember' in query['sql']])
+
+        self.assertIsNone(create_group_message(consumer, self.stranger, self.group.id, 'hi'))
+
+    async def test_one_layer_event_per_send(self):
+        consumer = ChatConsumer()
+        consumer.scope = {'user': self.owner}
+        consumer.channel_layer = mock.AsyncMock()
+
+        await consumer.receive_group_message_send({'groupId': self.group.id, 'message': 'hello'})
+        consumer.channel_layer.group_send.assert_awaited_once()
+        group, event = consumer.channel_layer.group_send.await_args.args
+        self.assertEqual(group, group_chat_group(self.group.id))
+        self.assertEqual(event['frame']['frame']['source'], 'group-message-send')
+
+    async def test_joined_sockets_subscribe_to_the_chat(self):
+        consumer = ChatConsumer()
+        consumer.channel_name = 'socket.1'
+        consumer.channel_layer = InMemoryChannelLayer()
+        consumer.codec = CODECS['json']
+        consumer.coalesce = False
+        consumer.group_ids = set()
+        consumer.send = mock.AsyncMock()
+
+        event = {'type': 'group_joined', 'groupId': self.group.id,
+                 'frame': broadcast_frame('group-new', {'group': {'id': self.group.id}})}
+        await consumer.group_joined(event)
+        await consumer.group_joined(event)
+        self.assertEqual(consumer.channel_layer.groups[group_chat_group(self.group.id)].keys(), {'socket.1'})
+        self.assertEqual(consumer.send.await_count, 2)
+
+
+class ReadReceiptTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+        ConversationSummary.ensure(self.connection)
+        invalidate_users(self.alice.id, self.bob.id)
+
+        self.messages = []
+        for i in range(5):
+            message = Message.objects.create(connection=self.connection, sender=self.alice, content=str(i))
+            ConversationSummary.record_message(message)
+            self.messages.append(message)
+
+    def summary(self):
+        return ConversationSummary.objects.get(connection=self.connection)
+
+    def test_read_mark_only_moves_forward(self):
+        self.assertEqual(self.summary().receiver_unread, 5)
+
+        read = ConversationSummary.mark_read(self.connection, self.bob, self.messages[2].id)
+        self.assertEqual(read, (self.messages[2].id, 2))
+        self.assertEqual((self.summary().receiver_last_read_id, self.summary().receiver_unread),
+                         (self.messages[2].id, 2))
+
+        self.assertIsNone(ConversationSummary.mark_read(self.connection, self.bob, self.messages[1].id))
+        # Past the last message, or no id at all, means everything
+        self.assertEqual(ConversationSummary.mark_read(self.connection, self.bob, 10 ** 9),
+                         (self.messages[-1].id, 0))
+        # Alice's side is untouched
+        self.assertEqual((self.summary().sender_last_read_id, self.summary().sender_unread), (0, 0))
+
+    def test_scrolling_writes_one_receipt(self):
+        consumer = ChatConsumer()
+        consumer.scope = {'user': self.bob}
+        consumer.username = 'bob'
+        consumer.read_marks = {}
+        consumer.read_task = None
+        sent = []
+
+        async def send_conversation(connection_id, source, data):
+            sent.append((source, data))
+
+        async def send_group(group, source, data):
+            sent.append((source, data))
+        consumer.send_conversation = send_conversation
+        consumer.send_group = send_group
+
+        async def scroll():
+            for message in self.messages[:4] + self.messages[:2]:
+                await consumer.receive_message_read(
+                    {'connectionId': self.connection.id, 'messageId': message.id})
+            await consumer.read_task
+
+        with mock.patch('chat.consumers.READ_RECEIPT_DELAY_SECONDS', 0):
+            async_to_sync(scroll)()
+
+        receipt = {'connectionId': self.connection.id, 'username': 'bob', 'messageId': self.messages[3].id}
+        self.assertEqual(sent, [
+            ('message-read', {'alice': receipt}),
+            ('message-read', {**receipt, 'unread': 1}),
+        ])
+        self.assertEqual(self.summary().receiver_last_read_id, self.messages[3].id)
+
+    def test_group_read_mark(self):
+        group = GroupChat.objects.create(name='team', created_by=self.alice)
+        GroupMember.objects.create(group=group, user=self.alice, role=GroupMember.OWNER)
+        GroupMember.objects.create(group=group, user=self.bob)
+        messages = [GroupMessage.objects.create(group=group, sender=self.alice, content=str(i)) for i in range(3)]
+        GroupMessage.objects.create(group=group, sender=self.bob, content='mine')
+
+        self.assertEqual(GroupMember.mark_read(group.id, self.bob, messages[0].id), (messages[0].id, 2))
+        self.assertIsNone(GroupMember.mark_read(group.id, self.bob, messages[0].id))
+        self.assertEqual(GroupMember.mark_read(group.id, self.bob, messages[2].id), (messages[2].id, 0))
@@ -0,0 +1,46 @@
+from django.conf import settings
+
+
+TYPING_THROTTLE_SECONDS = getattr(settings, 'TYPING_THROTTLE_SECONDS', 3)
+TYPING_TIMEOUT_SECONDS = getattr(settings, 'TYPING_TIMEOUT_SECONDS', 5)
+
+
+class TypingState:
+    """
+    Typing bursts of one socket, per peer. A burst forwards one start, a refresh
+    at most every TYPING_THROTTLE_SECONDS, and one stop, explicit or on timeout.
+    """
+
+    def __init__(self):
+        self.expires_at = {}
+        self.sent_at = {}
+        # Peer username -> their connection id, None when not connected, checked once per socket
+        self.allowed = {}
+
+    def start(self, peer, now):
+        """
+        Record a keystroke, returns True when the peer should be told.
+        """
+        self.expires_at[peer] = now + TYPING_TIMEOUT_SECONDS
+        sent_at = self.sent_at.get(peer)
+        if sent_at is not None and now - sent_at < TYPING_THROTTLE_SECONDS:
+            return False
+        self.sent_at[peer] = now
+        return True
+
+    def stop(self, peer):
+        """
+        End the burst, returns True when the peer was told it started.
+        """
+        self.expires_at.pop(peer, None)
+        return self.sent_at.pop(peer, None) is not None
+
+    def remaining(self, peer, now):
+        # None once the burst was stopped
+        expires_at = self.expires_at.get(peer)
+        if expires_at is None:
+            return None
+        return expires_at - now
+
+    def active(self):
+        return list(self.sent_at)
@@ -0,0 +1,129 @@
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+from django.conf import settings
+from .pipeline import image_pipeline
+import json
+import time
+
+
+IMAGE_UPLOAD_MAX_BYTES = getattr(
+    settings, 'IMAGE_UPLOAD_MAX_BYTES', 20 * 1024 * 1024)
+IMAGE_UPLOAD_SPOOL_BYTES = getattr(
+    settings, 'IMAGE_UPLOAD_SPOOL_BYTES', 512 * 1024)
+IMAGE_UPLOAD_MAX_PER_USER = getattr(settings, 'IMAGE_UPLOAD_MAX_PER_USER', 4)
+IMAGE_UPLOAD_TTL_SECONDS = getattr(settings, 'IMAGE_UPLOAD_TTL_SECONDS', 300)
+
+
+def parse_chunk(bytes_data):
+    """
+    This function splits a binary upload frame into its JSON header and image bytes.
+
+    Frame layout: 4 byte big-endian header length, the JSON header
+    ({"uploadId": ..., "offset": ...}), then the chunk itself.
+    """
+    if len(bytes_data) < 4:
+        raise ValueError('Frame too short')
+    header_length = int.from_bytes(bytes_data[:4], 'big')
+    header = json.loads(bytes_data[4:4 + header_length])
+    if not isinstance(header, dict):
+        raise ValueError('Header is not an object')
+    # A view, the chunk is only copied once into the upload's file
+    chunk = memoryview(bytes_data)[4 + header_length:]
+    return header, chunk
+
+
+class Upload:
+    """
+    An image being received in chunks, kept in memory up to IMAGE_UPLOAD_SPOOL_BYTES and on disk past it.
+    """
+
+    def __init__(self, upload_id, size, data):
+        self.upload_id = upload_id
+        self.size = size
+        self.data = data
+        self.file = SpooledTemporaryFile(max_size=IMAGE_UPLOAD_SPOOL_BYTES)
+        self.received = 0
+        self.updated_at = time.monotonic()
+        # Holds an image pipeline slot from upload-start until the image is handed over
+        self.reserved = False
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def write(self, offset, chunk):
+        # Chunks must arrive in order, a mismatch tells the client where to resume
+        if offset != self.received or self.received + len(chunk) > self.size:
+            return False
+        self.file.write(chunk)
+        self.received += len(chunk)
+        self.updated_at = time.monotonic()
+        return True
+
+    def open(self):
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        if self.reserved:
+            self.reserved = False
+            image_pipeline.release()
+        self.file.close()
+
+
+class UploadRegistry:
+    """
+    Uploads in progress, keyed by username so a reconnecting client can resume on another socket.
+
+    Offsets and spooled files live in this process only. A socket that reconnects to another
+    worker finds no upload, upload-start answers offset 0 there and the client starts over.
+    Resuming across workers needs sticky routing per user.
+    """
+
+    def __init__(self, max_per_user, ttl):
+        self.max_per_user = max_per_user
+        self.ttl = ttl
+        self.lock = Lock()
+        self.uploads = {}
+
+    def start(self, username, upload_id, size, data):
+        """
+        Begin an upload or resume the matching one, returns None when the user has too many open.
+        """
+        self.expire()
+        key = (username, upload_id)
+        with self.lock:
+            upload = self.uploads.get(key)
+            if upload and upload.size == size:
+                return upload
+            if upload:
+                upload.close()
+                del self.uploads[key]
+            open_uploads = sum(1 for name, _ in self.uploads if name == username)
+            if open_uploads >= self.max_per_user:
+                return None
+            upload = Upload(upload_id, size, data)
+            self.uploads[key] = upload
+            return upload
+
+    def get(self, username, upload_id):
+        with self.lock:
+            return self.uploads.get((username, upload_id))
+
+    def pop(self, username, upload_id):
+        with self.lock:
+            return self.uploads.pop((username, upload_id), None)
+
+    def expire(self):
+        deadline = time.monotonic() - self.ttl
+        with self.lock:
+            stale = [key for key, upload in self.uploads.items()
+                     if upload.updated_at < deadline]
+            for key in stale:
+                self.uploads.pop(key).close()
+
+
+uploads = UploadRegistry(
+    max_per_user=IMAGE_UPLOAD_MAX_PER_USER,
+    ttl=IMAGE_UPLOAD_TTL_SECONDS
+)
@@ -1,64 +1,158 @@
-from PIL import Image
+from PIL import Image, ImageOps
 from io import BytesIO
-import os
-import boto3
-import environ
-import time
+from datetime import datetime
+from collections import Counter
+from django.conf import settings
+from django.db.models import F
+from .lru import LRUCache
+from .models import StoredImage
+from .storage import get_storage
+import hashlib
 import base64
 
 
-def save_image(image_str, type, user, receiver=None):
+IMAGE_EXTENSIONS = {
+    'WEBP': 'webp',
+    'JPEG': 'jpg'
+}
+
+
+# Content hash -> StoredImage fields, in front of the StoredImage table
+stored_images = LRUCache(getattr(settings, 'IMAGE_DEDUP_CACHE_SIZE', 1024))
+
+# Process wide dedup counters: hits, misses and bytes_saved
+dedup_stats = Counter()
+
+
+def hash_image(image_file):
+    """
+    This function returns the sha256 of an image file without reading it into memory at once.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: image_file.read(64 * 1024), b''):
+        digest.update(chunk)
+    image_file.seek(0)
+    return digest.hexdigest()
+
+
+def find_stored_image(content_hash, type):
+    key = (content_hash, type)
+    entry = stored_images.get(key)
+    if entry is None:
+        stored = StoredImage.objects.filter(
+            content_hash=content_hash, kind=type).first()
+        if stored is None:
+            return None
+        entry = (stored.image_url, stored.variants, stored.stored_bytes)
+        stored_images.set(key, entry)
+
+    image_url, variants, stored_bytes = entry
+    dedup_stats['hits'] += 1
+    dedup_stats['bytes_saved'] += stored_bytes
+    StoredImage.objects.filter(content_hash=content_hash, kind=type).update(
+        hits=F('hits') + 1, bytes_saved=F('bytes_saved') + stored_bytes)
+    return image_url, variants
+
+
+def save_image(image_file, type):
+    """
+    This function takes in a base64 encoded image string or an image file, saves every
+    size/format variant of it to the configured storage and returns (main url, variants).
+    Images that were stored before are not processed again.
     """
-    This function takes in a base64 encoded image string and saves it to the CDN.
+    if isinstance(image_file, str):
+        image_file = BytesIO(base64.b64decode(image_file))
+
+    # The same bytes always give the same variants, reuse them on a hit
+    content_hash = hash_image(image_file)
+    stored = find_stored_image(content_hash, type)
+    if stored is not None:
+        return stored
+    dedup_stats['misses'] += 1
+
+    # Content addressed, so concurrent uploads can't overwrite each other
+    path = f"media/images/{type}/{content_hash[:2]}/{content_hash}"
+
+    storage = get_storage()
+    variants = {}
+    stored_bytes = 0
+    for size, image_format, image_byte in encode_variants(image_file, settings.IMAGE_VARIANT_SIZES[type]):
+        extension = IMAGE_EXTENSIONS[image_format]
+        url = storage.save(image_byte, f"{path}_{size}.{extension}")
+        variants.setdefault(str(size), {})[extension] = url
+        stored_bytes += len(image_byte)
+
+    # The largest JPEG stays the plain url for clients that don't read variants
+    largest = str(max(settings.IMAGE_VARIANT_SIZES[type]))
+    image_url = variants[largest]['jpg']
+
+    StoredImage.objects.get_or_create(content_hash=content_hash, kind=type, defaults={
+        'image_url': image_url,
+        'variants': variants,
+        'stored_bytes': stored_bytes
+    })
+    stored_images.set((content_hash, type),
+                      (image_url, variants, stored_bytes))
+
+    return image_url, variants
+
+
+def encode_variants(image_file, sizes):
+    """
+    This function decodes the image once and yields (size, format, bytes) for each size, largest first.
     """
-    image_data = base64.b64decode(image_str)
-    image = Image.open(BytesIO(image_data))
+    sizes = sorted(sizes, reverse=True)
+    image = Image.open(image_file)
 
-    # Convert back to base64 with smaller size
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG", quality=30)
+    # Let the JPEG decoder scale down while decoding, no need for full resolution
+    image.draft('RGB', (sizes[0], sizes[0]))
+    image = ImageOps.exif_transpose(image)
 
-    # Convert back to bytes
-    image_byte = buffer.getvalue()
+    # Palette, grayscale and CMYK inputs can't all be saved as both formats
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
 
-    # Create a unique filename based on the current time and the user's username:
-    filename = f"{int(time.time())}_{user.username}.jpg"
+    for size in sizes:
+        # Each variant shrinks the previous one, which is cheaper than starting over
+        image.thumbnail((size, size), Image.LANCZOS)
 
-    # Define the path to the file
-    if type == 'thumbnail':
-        path = f"media/user/{user.username}/profile_picture/{filename}"
-    elif type == 'message':
-        path = f"media/user/{user.username}/messages/{receiver.username}/{filename}"
+        buffer = BytesIO()
+        image.save(buffer, format="WEBP", quality=settings.IMAGE_WEBP_QUALITY)
+        yield size, 'WEBP', buffer.getvalue()
 
-    return upload_to_cdn(image_byte, path)
+        # JPEG has no alpha, flatten onto white
+        flat = image
+        if image.mode == 'RGBA':
+            flat = Image.new('RGB', image.size, (255, 255, 255))
+            flat.paste(image, mask=image.getchannel('A'))
 
+        buffer = BytesIO()
+        flat.save(buffer, format="JPEG",
+                  quality=settings.IMAGE_JPEG_QUALITY, optimize=True)
+        yield size, 'JPEG', buffer.getvalue()
 
-def upload_to_cdn(image, path):
-    env = environ.Env()
-    environ.Env.read_env()
 
-    session = boto3.Session(
-        aws_access_key_id=os.getenv(
-            'CDN_ACCESS_KEY', env('CDN_ACCESS_KEY')),
-        aws_secret_access_key=os.getenv(
-            'CDN_SECRET_ACCESS_KEY', env('CDN_SECRET_ACCESS_KEY')),
-        region_name='sgp1'
-    )
+def close_image(image_file):
+    # Uploaded images are temporary files, base64 strings need no cleanup
+    if hasattr(image_file, 'close'):
+        image_file.close()
 
-    client = session.client('s3',
-                            endpoint_url='https://sgp1.digitaloceanspaces.com',
-                            config=boto3.session.Config(
-                                signature_version='s3v4'),
-                            region_name='sgp1',
-                            aws_access_key_id=os.getenv(
-                                'CDN_ACCESS_KEY', env('CDN_ACCESS_KEY')),
-                            aws_secret_access_key=os.getenv(
-                                'CDN_SECRET_ACCESS_KEY', env('CDN_SECRET_ACCESS_KEY')),
-                            )
 
-    client.put_object(Bucket='tahcemitlaer', Key=path,
-                      Body=image, ACL='public-read')
+def encode_cursor(message):
+    """
+    This function builds an opaque pagination cursor from a message's (created_at, id).
+    """
+    return f"{message.created_at.isoformat()}_{message.id}"
 
-    image_cdn_url = "https://tahcemitlaer.sgp1.cdn.digitaloceanspaces.com/" + path
 
-    return image_cdn_url
+def decode_cursor(cursor):
+    """
+    This function parses a cursor built by encode_cursor, returns None if it is malformed.
+    """
+    try:
+        created_at, message_id = str(cursor).rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(message_id)
+    except ValueError:
+        return None
@@ -7,14 +7,14 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 django_asgi_app = get_asgi_application()
 
-from django_channels_jwt_auth_middleware.auth import JWTAuthMiddlewareStack
+from chat.auth import JWTAuthMiddleware
 from chat.routing import websocket_urlpatterns
 
 
 application = ProtocolTypeRouter({
     'http': django_asgi_app,
     'websocket': AllowedHostsOriginValidator(
-        JWTAuthMiddlewareStack(
+        JWTAuthMiddleware(
             URLRouter(websocket_urlpatterns)
         )
     )
@@ -53,6 +53,105 @@ REST_FRAMEWORK = {
 MEDIA_ROOT = BASE_DIR / 'media'
 MEDIA_URL = '/media/'
 
+# User search, results returned per query
+SEARCH_RESULTS_LIMIT = 20
+# Wait this long for more keystrokes before running a search
+SEARCH_DEBOUNCE_SECONDS = 0.15
+
+# Image storage, 's3' uploads to the CDN, 'local' writes under MEDIA_ROOT, 'memory' is for tests
+IMAGE_STORAGE = os.getenv('IMAGE_STORAGE', 's3')
+
+# CDN (S3 compatible), one client and connection pool per process
+CDN_BUCKET = os.getenv('CDN_BUCKET', 'tahcemitlaer')
+CDN_REGION = os.getenv('CDN_REGION', 'sgp1')
+CDN_ENDPOINT_URL = os.getenv(
+    'CDN_ENDPOINT_URL', 'https://sgp1.digitaloceanspaces.com')
+CDN_BASE_URL = os.getenv(
+    'CDN_BASE_URL', 'https://tahcemitlaer.sgp1.cdn.digitaloceanspaces.com/')
+CDN_ACCESS_KEY = os.getenv('CDN_ACCESS_KEY', env('CDN_ACCESS_KEY', default=None))
+CDN_SECRET_ACCESS_KEY = os.getenv(
+    'CDN_SECRET_ACCESS_KEY', env('CDN_SECRET_ACCESS_KEY', default=None))
+CDN_MAX_POOL_CONNECTIONS = int(os.getenv('CDN_MAX_POOL_CONNECTIONS', 10))
+
+# Image variants made from every upload, longest side in px
+IMAGE_VARIANT_SIZES = {
+    'thumbnail': [64, 256],
+    'message': [64, 256, 1024],
+}
+IMAGE_JPEG_QUALITY = 75
+IMAGE_WEBP_QUALITY = 70
+
+# Processed images remembered in memory by content hash
+IMAGE_DEDUP_CACHE_SIZE = 1024
+
+# Image processing pool and its back-pressure limits
+IMAGE_PIPELINE_WORKERS = 4
+IMAGE_PIPELINE_MAX_PENDING = 32
+IMAGE_PIPELINE_MAX_PENDING_PER_SOCKET = 4
+
+# Binary chunked image uploads, spooled to disk past IMAGE_UPLOAD_SPOOL_BYTES.
+# Held per worker process, only a reconnect to the same worker resumes
+IMAGE_UPLOAD_MAX_BYTES = 20 * 1024 * 1024
+IMAGE_UPLOAD_SPOOL_BYTES = 512 * 1024
+IMAGE_UPLOAD_MAX_PER_USER = 4
+IMAGE_UPLOAD_TTL_SECONDS = 300
+
+# WebSocket frame encoder, 'orjson' is used when installed
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'json')
+
+# Wire formats clients can pick with a subprotocol or ?codec=
+WEBSOCKET_CODECS = ['json', 'msgpack']
+# Broadcasts cross the channel layer unencoded, each worker encodes them once per codec its sockets use
+WEBSOCKET_BROADCAST_CACHE_SIZE = 1024
+
+# Most messages one message-send-batch frame may carry
+MESSAGE_BATCH_MAX_SIZE = 100
+
+# Sockets connected with ?coalesce=1 get frames sent within this window merged into one 'batch' frame
+WEBSOCKET_COALESCE_SECONDS = 0.005
+WEBSOCKET_COALESCE_MAX_FRAMES = 50
+
+# Reconnect catch-up, messages per 'sync' frame and frames per request
+SYNC_CHUNK_SIZE = 200
+SYNC_MAX_CHUNKS = 50
+# Messages created this long before a sync cursor are sent again, they may have committed after it
+SYNC_RESCAN_SECONDS = 10
+
+# Typing indicators: refresh peers at most this often, stop after this long without keystrokes
+TYPING_THROTTLE_SECONDS = 3
+TYPING_TIMEOUT_SECONDS = 5
+
+# Conversations one socket can have open, each joins the conversation's channel group
+CONVERSATION_MAX_OPEN = 10
+
+# Group chats: member limit, and how long a process trusts its cached member list
+GROUP_MAX_MEMBERS = 500
+GROUP_MEMBERSHIP_CACHE_SIZE = 1024
+GROUP_MEMBERSHIP_TTL_SECONDS = 30
+
+# Read receipts reported by a socket within this window are written and sent as one
+READ_RECEIPT_DELAY_SECONDS = 1
+
+# message-search results per page
+MESSAGE_SEARCH_PAGE_SIZE = 20
+
+# Per-user cache of profiles and accepted connections, shared through Redis when a URL is set
+USER_CACHE_SIZE = 4096
+USER_CACHE_TTL_SECONDS = 60
+USER_CACHE_REDIS_URL = os.getenv('USER_CACHE_REDIS_URL')
+
+# Verified socket tokens are cached with their user, rejected ones for a shorter time
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL_SECONDS = 60
+AUTH_NEGATIVE_TTL_SECONDS = 10
+
+# Recently sent client message ids per process, retries of these are answered from memory
+RECENT_MESSAGE_IDS_SIZE = 10000
+
+# Messages older than this many days are moved to the archive table by archive_messages
+MESSAGE_HOT_DAYS = 90
+MESSAGE_ARCHIVE_BATCH_SIZE = 1000
+
 # Daphne
 ASGI_APPLICATION = 'core.asgi.application'
 
@@ -74,6 +173,13 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Presence, kept in the channel layer's Redis ('memory' for tests and single process runs)
+PRESENCE_BACKEND = os.getenv('PRESENCE_BACKEND', 'redis')
+PRESENCE_REDIS_URL = redis_host['address']
+# Clients heartbeat well within the TTL, changes are collected and fanned out once per second
+PRESENCE_TTL_SECONDS = 75
+PRESENCE_FANOUT_SECONDS = 1
+
 
 # Application definition
 